@@ -3,71 +3,183 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import hashlib
 import json
-from flask import jsonify, request
+import math
+from flask import Response, jsonify, make_response, request, stream_with_context
 from app.services import db, ai
-from app.utils.logger import logger
+from app.services.scenario_pool import DEFAULT_DIFFICULTY, DEFAULT_TOPIC
+from app.services.validation import Validator
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+DEFAULT_FIELDS = ['id', 'title', 'description', 'tasks']
+AI_BUSY = "The AI service is busy, please try again shortly"
 
 
 class Handler:
-    def __init__(self, kubectl_executor, ai_chat):
+    def __init__(self, kubectl_executor, ai_chat, cluster_cache=None, scenario_pool=None, environments=None):
         self.kubectl_executor = kubectl_executor
         self.ai_chat = ai_chat
+        self.scenario_pool = scenario_pool
+        self.environments = environments
+        self.validator = Validator(kubectl_executor, cluster_cache)
 
     def handle_generate_scenarios(self):
         logger.info("Generating scenarios")
         data = request.json
         prompt = data.get('prompt', '')
+        topic = data.get('topic') or DEFAULT_TOPIC
+        difficulty = data.get('difficulty') or DEFAULT_DIFFICULTY
+        count = data.get('count', 1)
+        if not isinstance(count, int) or not 1 <= count <= ai.MAX_SCENARIOS:
+            return jsonify({'error': f"count must be between 1 and {ai.MAX_SCENARIOS}"}), 400
 
         try:
-            generated_scenarios = self.ai_chat.generate_scenarios(prompt)
-            stored_scenarios = []
-
-            for scenario in generated_scenarios.scenarios:
-                scenario_dict = scenario.dict()
-                id = db.store_scenario(scenario_dict)
-                stored_scenarios.append({
-                    'id': id,
-                    'title': scenario_dict['title'],
-                    'description': scenario_dict['description']
-                })
+            pooled = []
+            # Requests without a custom prompt are served from the
+            # pre-generated pool as far as its stock goes.
+            if not prompt.strip() and self.scenario_pool and self.scenario_pool.serves(topic, difficulty):
+                while len(pooled) < count:
+                    scenario_id = self.scenario_pool.take(topic, difficulty)
+                    if scenario_id is None:
+                        break
+                    scenario = db.get_scenario(scenario_id)
+                    if scenario is None:
+                        # Deleted after it was claimed; generate instead.
+                        continue
+                    pooled.append(self._scenario_summary(scenario_id, scenario))
+                logger.info("Served %s scenarios from the pool", len(pooled))
+            generated = self._generate_scenarios(prompt, count - len(pooled))
 
+            # Clients that accept NDJSON get each scenario as soon as it is
+            # stored instead of waiting for the whole batch.
+            if request.accept_mimetypes.best_match(
+                    ['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+                def lines():
+                    for item in pooled:
+                        yield json.dumps(item) + '\n'
+                    for item in generated:
+                        if isinstance(item, ai.AIUnavailable):
+                            item = {'error': AI_BUSY, 'retry_after': math.ceil(item.retry_after or 1)}
+                        elif isinstance(item, Exception):
+                            item = {'error': 'Failed to generate scenario'}
+                        yield json.dumps(item) + '\n'
+                return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+            stored_scenarios, errors = list(pooled), []
+            for item in generated:
+                (errors if isinstance(item, Exception) else stored_scenarios).append(item)
+            if not stored_scenarios:
+                raise errors[0]
             logger.info("Scenarios generated and stored successfully")
             return jsonify(stored_scenarios)
+        except ai.AIUnavailable as e:
+            logger.warning("AI unavailable while generating scenarios: %s", e)
+            return self._ai_unavailable(e)
         except Exception as e:
-            logger.error(f"Error generating scenarios: {e}")
+            logger.error("Error generating scenarios: %s", e)
             return jsonify({"error": "Failed to generate scenarios"}), 500
 
+    def _generate_scenarios(self, prompt, count):
+        if count <= 0:
+            return
+        for result in self.ai_chat.iter_scenarios(prompt, count):
+            if isinstance(result, Exception):
+                logger.error("Error generating scenario: %s", result)
+                yield result
+                continue
+            scenario_dict = result.model_dump()
+            yield self._scenario_summary(db.store_scenario(scenario_dict), scenario_dict)
+
+    def _ai_unavailable(self, error):
+        retry_after = math.ceil(error.retry_after or 1)
+        return jsonify({'error': AI_BUSY, 'retry_after': retry_after}), 503, {'Retry-After': str(retry_after)}
+
+    def _scenario_summary(self, id, scenario):
+        return {
+            'id': id,
+            'title': scenario['title'],
+            'description': scenario['description']
+        }
+
     def get_all_scenarios(self):
         logger.info("Fetching all scenarios")
         try:
-            scenarios = db.get_all_scenarios()
+            limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+            cursor = request.args.get('cursor', type=int)
+            fields = request.args.get('fields')
+            fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else DEFAULT_FIELDS
+            unknown = [f for f in fields if f not in db.SCENARIO_FIELDS]
+            if unknown:
+                return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+
+            # The table's max id and change counter identify its contents, so
+            # an unchanged listing is answered without reading any rows.
+            max_id, version = db.get_scenarios_stamp()
+            etag = hashlib.sha1(
+                f"{max_id}:{version}:{limit}:{cursor}:{','.join(fields)}".encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+            page = db.list_scenarios(limit + 1, cursor, fields)
+            next_cursor = page[limit - 1]['id'] if len(page) > limit else None
+            response = jsonify({'scenarios': page[:limit], 'next_cursor': next_cursor})
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
             logger.info("All scenarios fetched successfully")
-            return jsonify(scenarios)
+            return response
         except Exception as e:
-            logger.error(f"Error fetching all scenarios: {e}")
+            logger.error("Error fetching all scenarios: %s", e)
             return jsonify({"error": "Failed to fetch scenarios"}), 500
 
     def handle_get_scenario(self, id):
-        logger.info(f"Fetching scenario with id: {id}")
+        logger.info("Fetching scenario with id: %s", id)
         try:
             scenario = db.get_scenario(id)
             if scenario:
-                logger.info(f"Scenario with id {id} fetched successfully")
+                logger.info("Scenario with id %s fetched successfully", id)
                 return jsonify(scenario)
-            logger.warning(f"Scenario with id {id} not found")
+            logger.warning("Scenario with id %s not found", id)
             return jsonify({'error': 'Scenario not found'}), 404
         except Exception as e:
-            logger.error(f"Error fetching scenario with id {id}: {e}")
+            logger.error("Error fetching scenario with id %s: %s", id, e)
             return jsonify({"error": "Failed to fetch scenario"}), 500
 
     def handle_validate(self, id):
-        logger.info(f"Validating scenario with id: {id}")
+        logger.info("Validating scenario with id: %s", id)
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        fail_fast = bool(data.get('failFast')) or request.args.get('fail_fast') in ('1', 'true')
+
         try:
-            # Implementation for validating a scenario
-            pass
+            scenario = db.get_scenario(id)
+            if not scenario:
+                logger.warning("Scenario with id %s not found", id)
+                return jsonify({'error': 'Scenario not found'}), 404
+
+            namespace = data.get('namespace')
+            if namespace:
+                env = self.environments.lookup(namespace) if self.environments else None
+                if env is None or env.scenario_id != id:
+                    return jsonify({'error': 'Unknown environment for this scenario'}), 400
+
+            result = self.validator.validate(scenario, fail_fast=fail_fast, namespace=namespace)
+
+            completed_tasks = [r['task'] for r in result['results']
+                               if r['task'] is not None and r['status'] == 'passed']
+            status = 'completed' if result['passed'] else 'in_progress'
+            db.update_scenario_progress(id, status, completed_tasks)
+
+            return jsonify(result)
         except Exception as e:
-            logger.error(f"Error validating scenario with id {id}: {e}")
+            logger.error("Error validating scenario with id %s: %s", id, e)
             return jsonify({"error": "Failed to validate scenario"}), 500
 
     def handle_ai_chat(self):
@@ -80,6 +192,9 @@ class Handler:
             response = self.ai_chat.generate_response(message, scenario_id)
             logger.info("AI chat response generated successfully")
             return jsonify({'response': response})
+        except ai.AIUnavailable as e:
+            logger.warning("AI unavailable for chat request: %s", e)
+            return self._ai_unavailable(e)
         except Exception as e:
-            logger.error(f"Error handling AI chat request: {e}")
+            logger.error("Error handling AI chat request: %s", e)
             return jsonify({"error": "Failed to handle AI chat request"}), 500
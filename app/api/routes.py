@@ -3,35 +3,68 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-from flask import jsonify, request
+import time
+from flask import Response, g, jsonify, request
 from app.services import db
 from app.api.handlers import Handler
-from app.utils.logger import logger
+from app.utils import metrics
+from app.utils.logger import get_logger
 
+logger = get_logger(__name__)
 
-def setup_routes(app, kubectl_executor, ai_chat):
-    handler = Handler(kubectl_executor, ai_chat)
+REQUEST_SECONDS = metrics.histogram(
+    'kpa_http_request_duration_seconds', 'HTTP request latency by route template, method and status',
+    ['route', 'method', 'status'])
+
+
+def setup_routes(app, kubectl_executor, ai_chat, cluster_cache=None, scenario_pool=None, environments=None):
+    handler = Handler(kubectl_executor, ai_chat, cluster_cache, scenario_pool, environments)
+
+    metrics.gauge('kpa_validation_cache', 'Validation result cache size and hit/miss/eviction counts', ['stat'],
+                  callback=lambda: {(k,): v for k, v in handler.validator.results.stats().items()})
+    if scenario_pool is not None:
+        metrics.gauge('kpa_scenario_pool_stock', 'Pre-generated scenarios in stock per topic/difficulty',
+                      ['bucket'], callback=lambda: scenario_pool.stats()['stock'])
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    # Labelled by the route template, so /api/scenarios/1 and /api/scenarios/2
+    # share a series.
+    @app.after_request
+    def record_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=route,
+                                    method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
     @app.route('/api/scenarios/<int:id>', methods=['GET'])
     def get_scenario(id):
-        logger.info(f"Fetching scenario with id: {id}")
+        logger.info("Fetching scenario with id: %s", id)
         try:
             response = handler.handle_get_scenario(id)
-            logger.info(f"Scenario with id {id} fetched successfully")
+            logger.info("Scenario with id %s fetched successfully", id)
             return response
         except Exception as e:
-            logger.error(f"Error fetching scenario with id {id}: {e}")
+            logger.error("Error fetching scenario with id %s: %s", id, e)
             return jsonify({"error": "Failed to fetch scenario"}), 500
 
     @app.route('/api/scenarios/<int:id>/validate', methods=['POST'])
     def validate_scenario(id):
-        logger.info(f"Validating scenario with id: {id}")
+        logger.info("Validating scenario with id: %s", id)
         try:
             response = handler.handle_validate(id)
-            logger.info(f"Scenario with id {id} validated successfully")
+            logger.info("Scenario with id %s validated successfully", id)
             return response
         except Exception as e:
-            logger.error(f"Error validating scenario with id {id}: {e}")
+            logger.error("Error validating scenario with id %s: %s", id, e)
             return jsonify({"error": "Failed to validate scenario"}), 500
 
     @app.route('/api/ai-chat', methods=['POST'])
@@ -42,7 +75,7 @@ def setup_routes(app, kubectl_executor, ai_chat):
             logger.info("AI chat request handled successfully")
             return response
         except Exception as e:
-            logger.error(f"Error handling AI chat request: {e}")
+            logger.error("Error handling AI chat request: %s", e)
             return jsonify({"error": "Failed to handle AI chat request"}), 500
 
     @app.route('/api/generate-scenarios', methods=['POST'])
@@ -53,31 +86,31 @@ def setup_routes(app, kubectl_executor, ai_chat):
             logger.info("Scenarios generated successfully")
             return response
         except Exception as e:
-            logger.error(f"Error generating scenarios: {e}")
+            logger.error("Error generating scenarios: %s", e)
             return jsonify({"error": "Failed to generate scenarios"}), 500
 
     @app.route('/api/scenarios', methods=['GET'])
     def get_scenarios():
         logger.info("Fetching all scenarios")
         try:
-            scenarios = db.get_all_scenarios()
+            response = handler.get_all_scenarios()
             logger.info("All scenarios fetched successfully")
-            return jsonify(scenarios)
+            return response
         except Exception as e:
-            logger.error(f"Error fetching all scenarios: {e}")
+            logger.error("Error fetching all scenarios: %s", e)
             return jsonify({"error": "Failed to fetch scenarios"}), 500
 
     @app.route('/api/scenarios/<int:id>', methods=['DELETE'])
     def delete_scenario(id):
-        logger.info(f"Deleting scenario with id: {id}")
+        logger.info("Deleting scenario with id: %s", id)
         try:
             success = db.delete_scenario(id)
             if success:
-                logger.info(f"Scenario with id {id} deleted successfully")
+                logger.info("Scenario with id %s deleted successfully", id)
                 return jsonify({"message": "Scenario deleted successfully"}), 200
             else:
-                logger.error(f"Failed to delete scenario with id: {id}")
+                logger.error("Failed to delete scenario with id: %s", id)
                 return jsonify({"error": "Failed to delete scenario"}), 500
         except Exception as e:
-            logger.error(f"Error deleting scenario with id {id}: {e}")
+            logger.error("Error deleting scenario with id %s: %s", id, e)
             return jsonify({"error": "Failed to delete scenario"}), 500
@@ -3,14 +3,65 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-from flask import Flask, render_template
+from flask import Flask, jsonify, render_template
 from app.api.routes import setup_routes
-from app.services.db import init_db
+from app.services import ai, context
+from app.services.db import ensure_db
 from app.services.ai import ChatHandler
+from app.services.cluster_cache import ClusterCache
+from app.services.environments import EnvironmentProvisioner
 from app.services.kubectl import Executor
-from app.utils.logger import logger
+from app.services.scenario_pool import ScenarioPool
+from app.utils.logger import get_logger
 from app.websocket import init_socketio
+import importlib
 import os
+import threading
+import time
+
+logger = get_logger(__name__)
+
+# 'development' runs the Werkzeug debug server; 'production' runs gunicorn.
+SERVER_MODE = os.environ.get('KPA_SERVER', 'development')
+HOST = os.environ.get('KPA_HOST', '0.0.0.0' if SERVER_MODE == 'production' else '127.0.0.1')
+PORT = int(os.environ.get('KPA_PORT', '8080'))
+SERVER_THREADS = int(os.environ.get('KPA_SERVER_THREADS', '100'))
+
+
+# Runs the slow start-up steps on a background thread once the app is
+# serving, so the liveness probe answers straight away and /readyz reports
+# when everything is loaded. Requests arriving earlier load what they need
+# on first use.
+class WarmUp:
+    def __init__(self, steps):
+        self.steps = steps
+        self.done = []
+        self.error = None
+        self.ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name='warm-up', daemon=True).start()
+
+    def run(self):
+        started = time.monotonic()
+        for name, step in self.steps:
+            try:
+                step()
+            except Exception as e:
+                logger.error("Warm-up step %s failed: %s", name, e)
+                self.error = f"{name}: {e}"
+                return
+            self.done.append(name)
+        self.ready.set()
+        logger.info("Warm-up finished in %.2fs", time.monotonic() - started)
+
+    def state(self):
+        return {
+            'ready': self.ready.is_set(),
+            'done': list(self.done),
+            'pending': [name for name, _ in self.steps if name not in self.done],
+            'error': self.error,
+        }
 
 
 def create_app():
@@ -19,25 +70,45 @@ def create_app():
                 template_folder=os.path.join(curr_dir, 'web/templates'),
                 static_folder=os.path.join(curr_dir, 'web/static'))
 
-    # Initialize database
-    logger.info("Initializing database")
-    init_db('kpa.db')
-    logger.info("Database initialized successfully")
-
     # Initialize services
     logger.info("Initializing services")
     kubectl_executor = Executor()
-    ai_chat = ChatHandler(kubectl_executor)
+    cluster_cache = ClusterCache(kubectl_executor.kube_client)
+    kubectl_executor.use_cache(cluster_cache)
+    ai_chat = ChatHandler(kubectl_executor, cluster_cache)
+    scenario_pool = ScenarioPool(ai_chat, kubectl_executor)
+    environments = EnvironmentProvisioner(kubectl_executor)
     logger.info("Services initialized successfully")
 
+    # Background services start from the warm-up thread, after what they
+    # depend on has loaded.
+    def start_watch_cache():
+        cluster_cache.start()
+        if not cluster_cache.wait_synced():
+            logger.warning("Watch cache not synced at start-up; reads use the API until it is")
+
+    steps = [('database', ensure_db)]
+    if kubectl_executor.kube_client is not None:
+        steps.append(('kubernetes', kubectl_executor.kube_client.load))
+    steps += [
+        ('openai', ai.get_clients),
+        ('tokenizer', context.encoding),
+        ('schemas', lambda: importlib.import_module('app.services.schemas')),
+        ('watch cache', start_watch_cache),
+        ('scenario pool', scenario_pool.start),
+        ('environments', environments.start),
+    ]
+    warm_up = WarmUp(steps)
+    warm_up.start()
+
     # Setup routes
     logger.info("Setting up routes")
-    setup_routes(app, kubectl_executor, ai_chat)
+    setup_routes(app, kubectl_executor, ai_chat, cluster_cache, scenario_pool, environments)
     logger.info("Routes set up successfully")
 
     # Initialize SocketIO
     logger.info("Initializing SocketIO")
-    init_socketio(app)
+    init_socketio(app, ai_chat, environments)
     logger.info("SocketIO initialized successfully")
 
     @app.route('/')
@@ -47,15 +118,51 @@ def create_app():
 
     @app.route('/scenario/<int:id>')
     def scenario(id):
-        logger.info(f"Rendering index.html for scenario id: {id}")
+        logger.info("Rendering index.html for scenario id: %s", id)
+        # Start setting up an environment while the page loads.
+        environments.prepare(id)
         return render_template('index.html')
 
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        state = warm_up.state()
+        return jsonify(state), 200 if state['ready'] else 503
+
     return app
 
 
+# Socket.IO keeps each client's state in the process it connected to, so
+# gunicorn runs a single threaded worker. Scale out with more processes or
+# replicas behind a load balancer with sticky sessions, sharing
+# KPA_SOCKETIO_MESSAGE_QUEUE and KPA_DATABASE_URL.
+def run_production():
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{HOST}:{PORT}")
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', SERVER_THREADS)
+            # Socket.IO connections stay open far longer than a request.
+            self.cfg.set('timeout', 0)
+
+        def load(self):
+            return create_app()
+
+    Server().run()
+
+
 if __name__ == '__main__':
-    logger.info("Starting application")
-    app = create_app()
-    from app.websocket import socketio
-    socketio.run(app, debug=True, port=8080)
-    logger.info("Application started successfully")
+    logger.info("Starting application in %s mode", SERVER_MODE)
+    if SERVER_MODE == 'production':
+        run_production()
+    else:
+        app = create_app()
+        from app.websocket import socketio
+        socketio.run(app, debug=True, host=HOST, port=PORT)
+    logger.info("Application stopped")
@@ -3,88 +3,579 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-from pydantic import BaseModel, Field
 from typing import List, Optional
-from openai import OpenAI
 from app.services import db
-from app.utils.logger import logger
+from app.services.context import ContextBuilder
+from app.services.response_cache import ResponseCache
+from app.utils.logger import get_logger
+from app.utils.metrics import counter, gauge, histogram
+from contextlib import contextmanager
+import asyncio
 import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+logger = get_logger(__name__)
+
+MODEL = "gpt-4o-mini-2024-07-18"
+# Bump when the explain/troubleshoot prompts or schemas change so cached
+# answers from the old prompts stop being served.
+PROMPT_VERSION = "1"
+GENERATION_CONCURRENCY = int(os.environ.get('KPA_GENERATION_CONCURRENCY', '5'))
+GENERATION_ATTEMPTS = 3
+MAX_SCENARIOS = 10
+
+REQUEST_TIMEOUT = float(os.environ.get('KPA_AI_TIMEOUT', '60'))
+GENERATION_TIMEOUT = float(os.environ.get('KPA_AI_GENERATION_TIMEOUT', '120'))
+MAX_CONNECTIONS = int(os.environ.get('KPA_AI_MAX_CONNECTIONS', '20'))
+RATE_LIMIT = float(os.environ.get('KPA_AI_RATE_LIMIT', '5'))
+RATE_BURST = int(os.environ.get('KPA_AI_RATE_BURST', '10'))
+MAX_QUEUE_WAIT = float(os.environ.get('KPA_AI_MAX_QUEUE_WAIT', '30'))
+MAX_ATTEMPTS = int(os.environ.get('KPA_AI_MAX_ATTEMPTS', '4'))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+BREAKER_THRESHOLD = int(os.environ.get('KPA_AI_BREAKER_THRESHOLD', '5'))
+BREAKER_RESET = float(os.environ.get('KPA_AI_BREAKER_RESET', '30'))
+# Longest wait for the next scenario of a batch before giving up on the
+# rest: every attempt of one scenario timing out after queueing.
+RESULT_WAIT = GENERATION_TIMEOUT * GENERATION_ATTEMPTS + MAX_QUEUE_WAIT
+
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+REQUEST_SECONDS = histogram(
+    'kpa_openai_request_seconds', 'Latency of OpenAI calls including queueing and retries',
+    ['operation', 'outcome'])
+RETRIES = counter('kpa_openai_retries_total', 'OpenAI calls retried', ['operation', 'reason'])
+TOKENS = counter('kpa_openai_tokens_total', 'Tokens used by OpenAI calls', ['operation', 'type'])
+
+
+# Raised instead of calling OpenAI when the service is rate limiting us or
+# failing; routes answer it with 503 and Retry-After.
+class AIUnavailable(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(value):
+    # OpenAI reset headers look like "1s", "6m0s" or "120ms".
+    if not value:
+        return None
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+# Requests are admitted at `rate` per second with bursts of `capacity`.
+# Tokens may go negative: each caller reserves the next free slot and
+# sleeps until it comes round, so a burst queues up and drains evenly
+# instead of hitting the API all at once.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.paused_until - now)
+
+    def release(self):
+        with self._lock:
+            self.tokens += 1
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Follows the x-ratelimit-* headers so our pace matches the account's
+    # real per-minute limit and what is left of it.
+    def observe(self, headers):
+        limit = headers.get('x-ratelimit-limit-requests')
+        remaining = headers.get('x-ratelimit-remaining-requests')
+        reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit and limit.isdigit() and int(limit) > 0:
+                self.rate = int(limit) / 60
+            if remaining and remaining.isdigit():
+                self.tokens = min(self.tokens, int(remaining))
+                if int(remaining) == 0 and reset:
+                    self.paused_until = max(self.paused_until, now + reset)
+
+
+# Opens after `threshold` consecutive failures and rejects calls for
+# `reset_timeout` seconds; then one probe call is let through, and its
+# outcome closes or re-opens the circuit.
+class CircuitBreaker:
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    # Returns True when the call let through is the probe of a half-open
+    # circuit, which must report back with record_success or record_failure.
+    def check(self):
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise AIUnavailable("AI service circuit is open", retry_after=remaining)
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("AI circuit opened after %s consecutive failures", self.failures)
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self._lock:
+            return 'closed' if self.opened_at is None else 'open'
+
+
+# Every OpenAI call goes through here: it waits for a rate-limit slot,
+# respects the circuit breaker, and retries rate limits, connection errors
+# and 5xx responses with exponential backoff and full jitter.
+class AIGateway:
+    def __init__(self, bucket, breaker, attempts=MAX_ATTEMPTS):
+        self.bucket = bucket
+        self.breaker = breaker
+        self.attempts = attempts
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def call(self, fn, *args, operation='chat', **kwargs):
+        with self._measure(operation):
+            attempt = 0
+            while True:
+                attempt += 1
+                wait, probe = self._admit()
+                time.sleep(wait)
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    time.sleep(self._failed(e, attempt, operation, probe))
+                    continue
+                self.breaker.record_success()
+                record_usage(result, operation)
+                return result
+
+    async def acall(self, fn, *args, operation='chat', **kwargs):
+        with self._measure(operation):
+            attempt = 0
+            while True:
+                attempt += 1
+                wait, probe = self._admit()
+                await asyncio.sleep(wait)
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    await asyncio.sleep(self._failed(e, attempt, operation, probe))
+                    continue
+                self.breaker.record_success()
+                record_usage(result, operation)
+                return result
+
+    @contextmanager
+    def _measure(self, operation):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        except AIUnavailable:
+            outcome = 'unavailable'
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, operation=operation, outcome=outcome)
 
-client = OpenAI()
-
-
-# A dictionary containing 'commands' (list of strings) and 'explanation' (string)"
-class KubernetesScenarioSolution(BaseModel):
-    explanation: str
-    commands: List[str]
-
-
-class KubernetesScenario(BaseModel):
-    title: str
-    description: str
-    setup_commands: List[str]
-    tasks: List[str]
-    hints: List[str]
-    solution: KubernetesScenarioSolution
-    verification_commands: List[str]
-
-
-class ScenarioReflection(BaseModel):
-    perceived_weaknesses: List[str]
-    learning_opportunities: List[str]
-
-
-class ScenarioResponse(BaseModel):
-    scenarios: List[KubernetesScenario]
+    def _admit(self):
+        try:
+            probe = self.breaker.check()
+        except AIUnavailable:
+            self.rejected += 1
+            raise
+        wait = self.bucket.reserve()
+        if wait > MAX_QUEUE_WAIT:
+            self.bucket.release()
+            self.rejected += 1
+            raise AIUnavailable("Too many AI requests queued", retry_after=wait)
+        self.calls += 1
+        return wait, probe
+
+    # Returns how long to back off before the next attempt, or raises when
+    # the error is not worth retrying or the attempts are used up.
+    def _failed(self, error, attempt, operation, probe=False):
+        from openai import APIConnectionError, APIStatusError, RateLimitError
+        if isinstance(error, RateLimitError):
+            retry_after = self._retry_after(error.response.headers) or self._backoff(attempt)
+            self.bucket.pause(retry_after)
+            if attempt >= self.attempts:
+                raise AIUnavailable("AI service is rate limited", retry_after=retry_after) from error
+            logger.warning("AI request rate limited, retrying in %.1fs", retry_after)
+            self.retries += 1
+            RETRIES.inc(operation=operation, reason='rate_limited')
+            return 0
+        if isinstance(error, APIConnectionError) or (
+                isinstance(error, APIStatusError) and error.status_code >= 500):
+            self.breaker.record_failure()
+            if attempt >= self.attempts:
+                raise AIUnavailable("AI service is unavailable", retry_after=self.breaker.reset_timeout) from error
+            delay = self._backoff(attempt)
+            logger.warning("AI request failed (%s), retrying in %.1fs", error, delay)
+            self.retries += 1
+            RETRIES.inc(operation=operation, reason='error')
+            return delay
+        if probe:
+            # Otherwise the circuit would stay half-open with no verdict.
+            self.breaker.record_failure()
+        raise error
+
+    def _retry_after(self, headers):
+        if headers.get('retry-after-ms'):
+            try:
+                return float(headers['retry-after-ms']) / 1000
+            except ValueError:
+                pass
+        return parse_duration(headers.get('retry-after'))
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'circuit': self.breaker.state,
+            'rate': round(self.bucket.rate, 3)
+        }
+
+
+def record_usage(result, operation):
+    usage = getattr(result, 'usage', None)
+    if usage is not None:
+        TOKENS.inc(usage.prompt_tokens or 0, operation=operation, type='prompt')
+        TOKENS.inc(usage.completion_tokens or 0, operation=operation, type='completion')
+
+
+gateway = AIGateway(TokenBucket(RATE_LIMIT, RATE_BURST), CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET))
+gauge('kpa_openai_circuit_open', 'Whether the OpenAI circuit breaker is open',
+      callback=lambda: int(gateway.breaker.state == 'open'))
+
+
+def _observe(response):
+    gateway.bucket.observe(response.headers)
+
+
+async def _aobserve(response):
+    gateway.bucket.observe(response.headers)
+
+
+_BATCH_DONE = object()
+_clients = None
+_clients_lock = threading.Lock()
+
+
+# The OpenAI SDK is slow to import and the clients need OPENAI_API_KEY, so
+# both are left until the first call (or warm-up) needs them. Retries are
+# left to the gateway, so the SDK's own are turned off.
+def get_clients():
+    global _clients
+    if _clients is None:
+        with _clients_lock:
+            if _clients is None:
+                import httpx
+                from openai import AsyncOpenAI, OpenAI
+                limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+                timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=5.0)
+                client = OpenAI(max_retries=0, timeout=timeout, http_client=httpx.Client(
+                    limits=limits, timeout=timeout, event_hooks={'response': [_observe]}))
+                async_client = AsyncOpenAI(max_retries=0, timeout=timeout, http_client=httpx.AsyncClient(
+                    limits=limits, timeout=timeout, event_hooks={'response': [_aobserve]}))
+                _clients = (client, async_client)
+    return _clients
+
+
+def get_client():
+    return get_clients()[0]
+
+
+def get_async_client():
+    return get_clients()[1]
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# One event loop on a background thread runs every async OpenAI call, so the
+# async client's connection pool is shared and outlives each batch.
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-async", daemon=True).start()
+    return _loop
 
 
 class ChatHandler:
-    def __init__(self, kubectl_executor):
+    def __init__(self, kubectl_executor, cluster_cache=None):
         self.kubectl_executor = kubectl_executor
-
-    def generate_scenarios(self, prompt: str) -> ScenarioResponse:
-        logger.info("Generating scenarios")
-        notes = db.get_notes()
-        last_scenario_id = db.get_last_scenario_id()
-        previous_scenarios = [
-            db.get_scenario(i) for i in range(max(1, last_scenario_id - 4), last_scenario_id + 1)
-            if db.get_scenario(i) is not None
-        ]
-        
-        num_scenarios = 1
-
-        system_prompt = f"""
+        self.cluster_cache = cluster_cache
+        self.context = ContextBuilder(summarize=self._summarize)
+        self.explanations = ResponseCache('explain', MODEL, PROMPT_VERSION)
+        # Troubleshooting questions carry command output where one word
+        # (CrashLoopBackOff or ImagePullBackOff) changes the answer, so
+        # only identical questions share one.
+        self.troubleshooting = ResponseCache('troubleshoot', MODEL, PROMPT_VERSION, similar=False)
+        gauge('kpa_ai_response_cache', 'AI response cache lookups by kind and result', ['kind', 'stat'],
+              callback=self._response_cache_stats)
+
+    def _response_cache_stats(self):
+        values = {}
+        for cache in (self.explanations, self.troubleshooting):
+            for stat, value in cache.stats().items():
+                if stat != 'kind':
+                    values[(cache.kind, stat)] = value
+        return values
+
+    def _scenario_messages(self, prompt: str) -> List[dict]:
+        notes = self.context.relevant_notes(prompt, self.context.budget // 2)
+        previous_scenarios = self.context.previous_scenarios(self.context.budget // 4)
+
+        system_prompt = """
         You are a Kubernetes expert creating practice scenarios. Based on the user notes and previous
-        scenarios, generate {num_scenarios} Kubernetes practice scenarios suitable for CKA/CKS exam preparation.
+        scenarios, generate a Kubernetes practice scenario suitable for CKA/CKS exam preparation.
         Focus on addressing perceived weaknesses and providing learning opportunities.
         """
-        try:
-            completion = client.beta.chat.completions.parse(
-                model="gpt-4o-mini-2024-07-18",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Notes: {notes}\nPrevious scenarios: {previous_scenarios}\nGenerate scenarios based on: {prompt}"}
-                ],
-                response_format=ScenarioResponse
-            )
-            response = completion.choices[0].message.parsed
-            logger.info("Scenarios generated successfully")
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "Notes:\n" + "\n".join(f"- {n}" for n in notes)
+                + "\nPrevious scenarios:\n" + "\n".join(previous_scenarios)
+                + f"\nGenerate a scenario based on: {prompt}"}
+        ]
 
-            # Store the generated scenarios in the database
-            for scenario in response.scenarios:
-                db.store_scenario(scenario.model_dump())
-                logger.info(f"Scenario stored: {scenario.title}")
+    def generate_scenarios(self, prompt: str, count: int = 1) -> 'schemas.ScenarioResponse':
+        from app.services import schemas
+        logger.info("Generating %s scenarios", count)
+        scenarios, error = [], None
+        for result in self.iter_scenarios(prompt, count):
+            if isinstance(result, Exception):
+                error = result
+            else:
+                scenarios.append(result)
+        if not scenarios:
+            logger.error("Error generating scenarios: %s", error)
+            raise error
+        logger.info("%s of %s scenarios generated successfully", len(scenarios), count)
+        return schemas.ScenarioResponse(scenarios=scenarios)
+
+    # Sends one request per scenario, at most GENERATION_CONCURRENCY at a
+    # time, and yields each KubernetesScenario as soon as it is ready (or the
+    # exception for a scenario that failed every attempt). A batch of ten
+    # takes about as long as its slowest single scenario. If the batch stops
+    # early or stalls, the scenarios still missing are yielded as errors;
+    # closing the generator early cancels the rest of the batch.
+    def iter_scenarios(self, prompt: str, count: int = 1):
+        messages = self._scenario_messages(prompt)
+        results = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._fan_out(messages, count, results.put), _event_loop())
+        stopped = None
+        try:
+            for _ in range(count):
+                if stopped is None:
+                    try:
+                        result = results.get(timeout=RESULT_WAIT)
+                    except queue.Empty:
+                        result = stopped = TimeoutError(f"No scenario generated within {RESULT_WAIT:.0f}s")
+                    if result is _BATCH_DONE:
+                        result = stopped = RuntimeError("Scenario generation stopped before finishing the batch")
+                yield stopped or result
+        finally:
+            future.cancel()
+
+    async def _fan_out(self, messages: List[dict], count: int, emit) -> None:
+        semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+
+        async def run(index):
+            async with semaphore:
+                try:
+                    emit(await self._generate_scenario(messages, index, count))
+                except Exception as e:
+                    emit(e)
 
+        try:
+            await asyncio.gather(*(run(i) for i in range(count)))
+        finally:
+            emit(_BATCH_DONE)
+
+    async def _generate_scenario(self, messages: List[dict], index: int, count: int) -> 'schemas.KubernetesScenario':
+        from openai import LengthFinishReasonError
+        from pydantic import ValidationError
+        from app.services.schemas import KubernetesScenario
+        if count > 1:
+            messages = messages + [{"role": "user", "content":
+                                    f"This is scenario {index + 1} of {count}; make it different from the others."}]
+        for attempt in range(1, GENERATION_ATTEMPTS + 1):
+            try:
+                completion = await gateway.acall(
+                    get_async_client().beta.chat.completions.parse,
+                    operation='generate_scenario',
+                    model=MODEL,
+                    messages=messages,
+                    response_format=KubernetesScenario,
+                    timeout=GENERATION_TIMEOUT
+                )
+                message = completion.choices[0].message
+                if message.parsed is None:
+                    raise ValueError(message.refusal or "No scenario in response")
+                return KubernetesScenario.model_validate(message.parsed.model_dump())
+            except (LengthFinishReasonError, ValidationError, ValueError) as e:
+                if attempt == GENERATION_ATTEMPTS:
+                    raise
+                logger.warning("Scenario %s/%s attempt %s failed, retrying: %s", index + 1, count, attempt, e)
+
+    def _chat_messages(self, message: str, scenario_id: Optional[int]) -> List[dict]:
+        system_prompt = "You are a Kubernetes expert helping a user work through a practice scenario."
+        history = []
+        if scenario_id is not None:
+            scenario = db.get_scenario(scenario_id)
+            if scenario:
+                system_prompt += f"""
+
+                Scenario: {scenario['title']}
+                Description: {scenario['description']}
+                Tasks: {scenario['tasks']}
+                Hints: {scenario['hints']}
+
+                Guide the user towards the solution rather than giving it away.
+                """
+            summary, history = self.context.chat_context(scenario_id)
+            if summary:
+                system_prompt += f"\n\nEarlier in this conversation: {summary}"
+        return [{"role": "system", "content": system_prompt}, *history,
+                {"role": "user", "content": message}]
+
+    # Folds a batch of older chat messages into the running summary.
+    def _summarize(self, summary: str, messages: List[dict]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        completion = gateway.call(
+            get_client().chat.completions.create,
+            operation='summarize',
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": "Summarize this Kubernetes practice conversation in a short "
+                 "paragraph. Keep what the user has tried, what worked and what they still struggle with."},
+                {"role": "user", "content": f"Summary so far: {summary or 'none'}\n\nNew messages:\n{transcript}"}
+            ]
+        )
+        return completion.choices[0].message.content
+
+    def _store_exchange(self, scenario_id: Optional[int], message: str, response: str) -> None:
+        db.store_chat_messages([
+            {'scenario_id': scenario_id, 'role': 'user', 'content': message},
+            {'scenario_id': scenario_id, 'role': 'assistant', 'content': response}
+        ])
+
+    def generate_response(self, message: str, scenario_id: Optional[int]) -> str:
+        logger.info("Generating chat response for scenario_id: %s", scenario_id)
+        try:
+            completion = gateway.call(
+                get_client().chat.completions.create,
+                operation='chat',
+                model=MODEL,
+                messages=self._chat_messages(message, scenario_id)
+            )
+            response = completion.choices[0].message.content
+            self._store_exchange(scenario_id, message, response)
             return response
         except Exception as e:
-            logger.error(f"Error generating scenarios: {e}")
+            logger.error("Error generating chat response for scenario_id %s: %s", scenario_id, e)
             raise
 
-    def evaluate_progress(self, scenario_id: int, user_commands: List[str]) -> dict:
-        logger.info(f"Evaluating progress for scenario_id: {scenario_id}")
+    # Yields the answer token by token as the model produces it. When
+    # should_stop() turns true the upstream request is closed and nothing is
+    # stored; otherwise the whole exchange is stored once it completes.
+    def stream_response(self, message: str, scenario_id: Optional[int], should_stop=None):
+        logger.info("Streaming chat response for scenario_id: %s", scenario_id)
+        stream = gateway.call(
+            get_client().chat.completions.create,
+            operation='chat_stream',
+            model=MODEL,
+            messages=self._chat_messages(message, scenario_id),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        parts = []
+        try:
+            for chunk in stream:
+                if should_stop is not None and should_stop():
+                    logger.info("Chat stream cancelled for scenario_id: %s", scenario_id)
+                    return
+                if not chunk.choices:
+                    # With include_usage the last chunk carries only usage.
+                    record_usage(chunk, 'chat_stream')
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            stream.close()
+        self._store_exchange(scenario_id, message, ''.join(parts))
+        logger.info("Chat stream completed for scenario_id: %s", scenario_id)
+
+    # `namespace` is the caller's scenario environment; the prompt only
+    # describes the cluster state there.
+    def evaluate_progress(self, scenario_id: int, user_commands: List[str],
+                          namespace: Optional[str] = None) -> dict:
+        logger.info("Evaluating progress for scenario_id: %s", scenario_id)
         try:
             scenario = db.get_scenario(scenario_id)
-            chat_history = db.get_chat_history(scenario_id)
+            summary, turns = self.context.chat_context(scenario_id)
+            chat_history = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+            if summary:
+                chat_history = f"(Earlier: {summary})\n{chat_history}"
+            cluster_state = (self.cluster_cache.summary(namespaces=[namespace])
+                             if self.cluster_cache and namespace else [])
 
             prompt = f"""
             Evaluate the progress on the following Kubernetes scenario:
@@ -95,11 +586,15 @@ class ChatHandler:
 
             User commands: {user_commands}
 
+            Cluster state: {cluster_state}
+
             Provide feedback and the next hint if needed.
             """
 
-            completion = client.beta.chat.completions.parse(
-                model="gpt-4o-mini-2024-07-18",
+            completion = gateway.call(
+                get_client().beta.chat.completions.parse,
+                operation='evaluate',
+                model=MODEL,
                 messages=[
                     {"role": "system", "content": "You are a Kubernetes expert evaluating progress on a mock scenario."},
                     {"role": "user", "content": prompt}
@@ -117,11 +612,11 @@ class ChatHandler:
             )
 
             evaluation = json.loads(completion.choices[0].message.content)
-            logger.info(f"Evaluation completed for scenario_id: {scenario_id}")
+            logger.info("Evaluation completed for scenario_id: %s", scenario_id)
 
             # Store the evaluation as a chat message
             db.store_chat_message(scenario_id, "assistant", json.dumps(evaluation))
-            logger.info(f"Evaluation stored in chat history for scenario_id: {scenario_id}")
+            logger.info("Evaluation stored in chat history for scenario_id: %s", scenario_id)
 
             # Update scenario progress
             current_progress = db.get_scenario_progress(scenario_id)
@@ -133,20 +628,25 @@ class ChatHandler:
                 completed_tasks = [scenario['tasks'][0]] if evaluation['progress'] > 0 else []
 
             db.update_scenario_progress(scenario_id, "in_progress", completed_tasks)
-            logger.info(f"Scenario progress updated for scenario_id: {scenario_id}")
+            logger.info("Scenario progress updated for scenario_id: %s", scenario_id)
 
             return evaluation
         except Exception as e:
-            logger.error(f"Error evaluating progress for scenario_id {scenario_id}: {e}")
+            logger.error("Error evaluating progress for scenario_id %s: %s", scenario_id, e)
             raise
 
     def explain_concept(self, concept: str) -> dict:
-        logger.info(f"Explaining concept: {concept}")
+        logger.info("Explaining concept: %s", concept)
+        cached = self.explanations.get(concept)
+        if cached is not None:
+            return cached
         prompt = f"Explain the Kubernetes concept '{concept}'."
 
         try:
-            completion = client.beta.chat.completions.parse(
-                model="gpt-4o-mini-2024-07-18",
+            completion = gateway.call(
+                get_client().beta.chat.completions.parse,
+                operation='explain',
+                model=MODEL,
                 messages=[
                     {"role": "system", "content": "You are a Kubernetes expert explaining concepts."},
                     {"role": "user", "content": prompt}
@@ -164,14 +664,19 @@ class ChatHandler:
             )
 
             explanation = json.loads(completion.choices[0].message.content)
-            logger.info(f"Concept explained: {concept}")
+            logger.info("Concept explained: %s", concept)
+            self.explanations.set(concept, explanation)
             return explanation
         except Exception as e:
-            logger.error(f"Error explaining concept {concept}: {e}")
+            logger.error("Error explaining concept %s: %s", concept, e)
             raise
 
     def troubleshoot_issue(self, problem_description: str, user_commands: List[str], system_output: str) -> dict:
-        logger.info(f"Troubleshooting issue: {problem_description}")
+        logger.info("Troubleshooting issue: %s", problem_description)
+        question = "\n".join([problem_description, *user_commands, system_output])
+        cached = self.troubleshooting.get(question)
+        if cached is not None:
+            return cached
         prompt = f"""
         Troubleshoot the following Kubernetes issue:
 
@@ -183,8 +688,10 @@ class ChatHandler:
         """
 
         try:
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini-2024-07-18",
+            completion = gateway.call(
+                get_client().chat.completions.create,
+                operation='troubleshoot',
+                model=MODEL,
                 messages=[
                     {"role": "system", "content": "You are a Kubernetes expert troubleshooting issues."},
                     {"role": "user", "content": prompt}
@@ -202,8 +709,9 @@ class ChatHandler:
             )
 
             troubleshooting = json.loads(completion.choices[0].message.content)
-            logger.info(f"Issue troubleshooted: {problem_description}")
+            logger.info("Issue troubleshooted: %s", problem_description)
+            self.troubleshooting.set(question, troubleshooting)
             return troubleshooting
         except Exception as e:
-            logger.error(f"Error troubleshooting issue {problem_description}: {e}")
+            logger.error("Error troubleshooting issue %s: %s", problem_description, e)
             raise
\ No newline at end of file
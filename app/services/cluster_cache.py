@@ -0,0 +1,318 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import os
+import threading
+import time
+from app.services.kubectl import API_METHODS, RESOURCES
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+WATCH_CACHE_ENABLED = os.environ.get('KPA_WATCH_CACHE', '1') != '0'
+MAX_OBJECTS = int(os.environ.get('KPA_WATCH_CACHE_MAX_OBJECTS', '5000'))
+WATCH_TIMEOUT = 300
+RETRY_DELAY = 5
+SYNC_TIMEOUT = float(os.environ.get('KPA_WATCH_CACHE_SYNC_TIMEOUT', '30'))
+
+LAST_APPLIED = 'kubectl.kubernetes.io/last-applied-configuration'
+
+
+class UnsupportedSelector(Exception):
+    pass
+
+
+def parse_selector(selector):
+    requirements = []
+    for term in (selector or '').split(','):
+        term = term.strip()
+        if not term:
+            continue
+        if ' in ' in term or ' notin ' in term or '(' in term:
+            raise UnsupportedSelector(selector)
+        if '!=' in term:
+            key, value = term.split('!=', 1)
+            requirements.append((key.strip(), '!=', value.strip()))
+        elif '==' in term or '=' in term:
+            key, value = term.replace('==', '=').split('=', 1)
+            requirements.append((key.strip(), '=', value.strip()))
+        elif term.startswith('!'):
+            requirements.append((term[1:].strip(), '!', None))
+        else:
+            requirements.append((term, 'exists', None))
+    return requirements
+
+
+def matches_selector(labels, requirements):
+    labels = labels or {}
+    for key, op, value in requirements:
+        if op == '=' and labels.get(key) != value:
+            return False
+        if op == '!=' and labels.get(key) == value:
+            return False
+        if op == 'exists' and key not in labels:
+            return False
+        if op == '!' and key in labels:
+            return False
+    return True
+
+
+def _trim(obj):
+    # managedFields and the last-applied annotation are usually most of an
+    # object's size and nothing here reads them.
+    metadata = obj.get('metadata', {})
+    metadata.pop('managedFields', None)
+    annotations = metadata.get('annotations')
+    if annotations:
+        annotations.pop(LAST_APPLIED, None)
+    return obj
+
+
+class ResourceStore:
+    def __init__(self, resource, max_objects):
+        self.resource = resource
+        self.max_objects = max_objects
+        self.objects = {}
+        self.by_namespace = {}
+        self.resource_version = None
+        self.synced = False
+        self.overflow = False
+
+    def replace(self, items, resource_version):
+        self.objects = {}
+        self.by_namespace = {}
+        self.overflow = False
+        for obj in items:
+            self.put(obj)
+        self.resource_version = resource_version
+        self.synced = True
+
+    def put(self, obj):
+        metadata = obj.get('metadata', {})
+        key = (metadata.get('namespace'), metadata.get('name'))
+        if key not in self.objects and len(self.objects) >= self.max_objects:
+            # Serving a partial view would give wrong answers, so stop
+            # serving this resource from memory until the next relist.
+            self.overflow = True
+            return
+        self.objects[key] = _trim(obj)
+        self.by_namespace.setdefault(key[0], set()).add(key[1])
+
+    def delete(self, obj):
+        metadata = obj.get('metadata', {})
+        key = (metadata.get('namespace'), metadata.get('name'))
+        if self.objects.pop(key, None) is not None:
+            names = self.by_namespace.get(key[0])
+            if names is not None:
+                names.discard(key[1])
+                if not names:
+                    del self.by_namespace[key[0]]
+
+    @property
+    def ready(self):
+        return self.synced and not self.overflow
+
+
+class ClusterCache:
+    def __init__(self, kube_client, resources=None, max_objects=MAX_OBJECTS):
+        self.kube_client = kube_client
+        self.resources = list(resources or RESOURCES)
+        self.stores = {r: ResourceStore(r, max_objects) for r in self.resources}
+        self.generation = 0
+        self.namespace_generations = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads or self.kube_client is None or not WATCH_CACHE_ENABLED:
+            return
+        for resource in self.resources:
+            thread = threading.Thread(
+                target=self._watch_loop, args=(resource,),
+                name=f"watch-{resource}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    # Waits until every watched resource has been listed, or its watch has
+    # given up. Returns False if that takes longer than `timeout`.
+    def wait_synced(self, timeout=SYNC_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for resource, thread in zip(self.resources, self._threads):
+            while not self.synced(resource) and thread.is_alive():
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(0.1)
+        return True
+
+    def synced(self, resource):
+        with self._lock:
+            store = self.stores.get(resource)
+            return store is not None and store.ready
+
+    def get(self, resource, name, namespace=None):
+        _, _, _, _, namespaced = RESOURCES[resource]
+        with self._lock:
+            obj = self.stores[resource].objects.get(
+                (namespace if namespaced else None, name))
+            return json.loads(json.dumps(obj)) if obj is not None else None
+
+    def list(self, resource, namespace=None, selector=None):
+        requirements = parse_selector(selector)
+        _, _, _, _, namespaced = RESOURCES[resource]
+        with self._lock:
+            store = self.stores[resource]
+            if namespaced and namespace is not None:
+                keys = [(namespace, name) for name in sorted(store.by_namespace.get(namespace, ()))]
+            else:
+                keys = sorted(store.objects, key=lambda k: (k[0] or '', k[1]))
+            items = [store.objects[key] for key in keys
+                     if matches_selector(store.objects[key]['metadata'].get('labels'), requirements)]
+            return json.loads(json.dumps(items))
+
+    def namespace_generation(self, namespace):
+        with self._lock:
+            return self.namespace_generations.get(namespace, 0)
+
+    # A short, prompt-sized description of what is running in the given
+    # namespaces, built from memory.
+    def summary(self, namespaces=None, limit=50):
+        lines = []
+        with self._lock:
+            for resource in self.resources:
+                store = self.stores[resource]
+                if not store.ready:
+                    continue
+                for (namespace, name), obj in sorted(store.objects.items(), key=lambda i: (i[0][0] or '', i[0][1])):
+                    if namespaces is not None and namespace is not None and namespace not in namespaces:
+                        continue
+                    if resource == 'namespaces' and namespaces is not None and name not in namespaces:
+                        continue
+                    lines.append(self._describe(resource, namespace, name, obj))
+                    if len(lines) >= limit:
+                        lines.append('...')
+                        return lines
+        return lines
+
+    def _describe(self, resource, namespace, name, obj):
+        prefix = f"{RESOURCES[resource][3]}/{name}"
+        if namespace:
+            prefix = f"{namespace}/{prefix}"
+        status = obj.get('status') or {}
+        spec = obj.get('spec') or {}
+        if resource == 'pods':
+            return f"{prefix} phase={status.get('phase')}"
+        if resource == 'deployments':
+            return f"{prefix} ready={status.get('readyReplicas', 0)}/{spec.get('replicas', 0)}"
+        if resource == 'services':
+            return f"{prefix} type={spec.get('type')}"
+        if resource == 'namespaces':
+            return f"{prefix} phase={status.get('phase')}"
+        return prefix
+
+    def _bump(self, namespace):
+        self.generation += 1
+        if namespace is not None:
+            self.namespace_generations[namespace] = self.namespace_generations.get(namespace, 0) + 1
+
+    def _list(self, resource):
+        api_name, kind, api_version, _, _ = RESOURCES[resource]
+        api = self.kube_client.apis[api_name]
+        response = getattr(api, API_METHODS[resource][0])(_preload_content=False)
+        data = json.loads(response.data)
+        items = [{'apiVersion': api_version, 'kind': kind, **item} for item in data.get('items', [])]
+        return items, data.get('metadata', {}).get('resourceVersion')
+
+    def _relist(self, resource):
+        items, resource_version = self._list(resource)
+        with self._lock:
+            store = self.stores[resource]
+            # Anything may have changed while the watch was down, including
+            # namespaces that have no objects left after the relist.
+            namespaces = self._store_namespaces(resource)
+            store.replace(items, resource_version)
+            for namespace in namespaces | self._store_namespaces(resource):
+                self._bump(namespace)
+            self._bump(None)
+        logger.info("Watch cache listed %s %s at resourceVersion %s", len(items), resource, resource_version)
+
+    def _store_namespaces(self, resource):
+        store = self.stores[resource]
+        if resource == 'namespaces':
+            return {name for _, name in store.objects}
+        return set(store.by_namespace) - {None}
+
+    def _watch_loop(self, resource):
+        if not self.kube_client.load():
+            logger.warning("Watch cache disabled for %s: no cluster configuration", resource)
+            return
+        from kubernetes import watch
+        from kubernetes.client.exceptions import ApiException
+        api = self.kube_client.apis[RESOURCES[resource][0]]
+        list_method = getattr(api, API_METHODS[resource][0])
+
+        while not self._stop.is_set():
+            try:
+                if self.stores[resource].resource_version is None or self.stores[resource].overflow:
+                    self._relist(resource)
+                stream = watch.Watch().stream(
+                    list_method,
+                    resource_version=self.stores[resource].resource_version,
+                    allow_watch_bookmarks=True,
+                    timeout_seconds=WATCH_TIMEOUT,
+                    _request_timeout=WATCH_TIMEOUT + 30)
+                for event in stream:
+                    self._apply(resource, event['type'], event['raw_object'])
+                    if self._stop.is_set():
+                        break
+            except ApiException as e:
+                if e.status == 410:
+                    # Our resourceVersion is too old; start again from a list.
+                    logger.info("Watch for %s expired, relisting", resource)
+                    with self._lock:
+                        self.stores[resource].resource_version = None
+                    continue
+                self._mark_stale(resource)
+                if e.status in (401, 403):
+                    # Retrying will not help; the resource is left to the
+                    # API client and kubectl.
+                    logger.warning("Watch cache disabled for %s: %s %s", resource, e.status, e.reason)
+                    return
+                logger.warning("Watch for %s failed: %s", resource, e.reason)
+                time.sleep(RETRY_DELAY)
+            except Exception as e:
+                logger.warning("Watch for %s failed: %s", resource, e)
+                self._mark_stale(resource)
+                time.sleep(RETRY_DELAY)
+
+    def _mark_stale(self, resource):
+        with self._lock:
+            store = self.stores[resource]
+            store.synced = False
+            store.resource_version = None
+
+    def _apply(self, resource, event_type, obj):
+        _, kind, api_version, _, _ = RESOURCES[resource]
+        metadata = obj.get('metadata', {})
+        with self._lock:
+            store = self.stores[resource]
+            if metadata.get('resourceVersion'):
+                store.resource_version = metadata['resourceVersion']
+            if event_type == 'BOOKMARK':
+                return
+            obj.setdefault('apiVersion', api_version)
+            obj.setdefault('kind', kind)
+            if event_type == 'DELETED':
+                store.delete(obj)
+            else:
+                store.put(obj)
+            if resource == 'namespaces':
+                self._bump(metadata.get('name'))
+            else:
+                self._bump(metadata.get('namespace'))
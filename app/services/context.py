@@ -0,0 +1,136 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import functools
+import os
+import re
+from app.services import db
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+TOKEN_BUDGET = int(os.environ.get('KPA_CONTEXT_TOKEN_BUDGET', '3000'))
+RECENT_TURNS = 40
+SUMMARY_BATCH = 50
+NOTES_SCAN = 200
+PREVIOUS_SCENARIOS = 5
+CHARS_PER_TOKEN = 4
+
+WORD_RE = re.compile(r'[a-z0-9][a-z0-9\-]+')
+
+
+# Loading the tiktoken encoding takes a while, so it is done on first use
+# (or by the startup warm-up). Without tiktoken, counts fall back to an
+# estimate of four characters per token.
+@functools.lru_cache(maxsize=None)
+def encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if encoding() is not None:
+        return len(encoding().encode(text))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate(text, budget):
+    if count_tokens(text) <= budget:
+        return text
+    if encoding() is not None:
+        return encoding().decode(encoding().encode(text)[:max(budget - 1, 0)]) + '…'
+    return text[:max(budget - 1, 0) * CHARS_PER_TOKEN] + '…'
+
+
+def keywords(text):
+    return set(WORD_RE.findall((text or '').lower()))
+
+
+# Assembles prompt context that fits a token budget however much history
+# has built up. Recent chat turns are kept verbatim, older ones are folded
+# into a rolling summary stored in the database, and notes are picked by
+# how well they match the request rather than sent wholesale.
+class ContextBuilder:
+    def __init__(self, summarize=None, budget=TOKEN_BUDGET):
+        self.summarize = summarize
+        self.budget = budget
+
+    # Returns (summary, turns): the newest turns that fit in the budget, in
+    # order, plus a summary of what came before them.
+    def chat_context(self, scenario_id, budget=None):
+        budget = self.budget if budget is None else budget
+        if scenario_id is None:
+            return '', []
+        recent = db.get_recent_chat_history(scenario_id, RECENT_TURNS)
+        turn_budget = budget * 3 // 4
+        turns, used = [], 0
+        for message in reversed(recent):
+            cost = count_tokens(message['content']) + 4
+            if used + cost > turn_budget:
+                break
+            turns.append(message)
+            used += cost
+        turns.reverse()
+
+        older = len(turns) < len(recent) or len(recent) == RECENT_TURNS
+        summary = ''
+        if older:
+            cutoff = turns[0]['id'] if turns else recent[-1]['id'] + 1
+            summary = self._summary(scenario_id, cutoff)
+        summary = truncate(summary, budget - used)
+        return summary, [{'role': m['role'], 'content': m['content']} for m in turns]
+
+    # Brings the stored summary forward by at most one batch of messages, so
+    # the cost of a request stays bounded while a long history catches up.
+    def _summary(self, scenario_id, cutoff):
+        stored = db.get_chat_summary(scenario_id)
+        content = stored['content'] if stored else ''
+        upto = stored['upto_message_id'] if stored else 0
+        if self.summarize is None or upto >= cutoff - 1:
+            return content
+        batch = db.get_chat_history_range(scenario_id, upto, cutoff, SUMMARY_BATCH)
+        if not batch:
+            return content
+        try:
+            content = self.summarize(content, batch)
+        except Exception as e:
+            logger.warning("Could not summarize chat history for scenario_id %s: %s", scenario_id, e)
+            return content
+        db.store_chat_summary(scenario_id, batch[-1]['id'], content)
+        return content
+
+    # The notes sharing the most words with the query, newest first among
+    # equals, until the budget is spent.
+    def relevant_notes(self, query, budget=None):
+        budget = self.budget if budget is None else budget
+        wanted = keywords(query)
+        notes = db.get_notes(limit=NOTES_SCAN)
+        ranked = sorted(enumerate(notes),
+                        key=lambda item: (-len(wanted & keywords(item[1]['content'])), item[0]))
+        selected, used = [], 0
+        for _, note in ranked:
+            cost = count_tokens(note['content']) + 2
+            if used + cost > budget:
+                continue
+            selected.append(note['content'])
+            used += cost
+        return selected
+
+    def previous_scenarios(self, budget=None, limit=PREVIOUS_SCENARIOS):
+        budget = self.budget if budget is None else budget
+        lines, used = [], 0
+        for scenario in db.list_scenarios(limit, fields=['title', 'tasks']):
+            line = f"- {scenario['title']}: " + '; '.join(scenario['tasks'])
+            cost = count_tokens(line)
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+        return lines
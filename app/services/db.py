@@ -3,187 +3,880 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import copy
+import os
+import queue
 import sqlite3
 import json
+import threading
 from contextlib import contextmanager
 from typing import List, Dict, Any
 from datetime import datetime
-from app.utils.logger import logger
+from app.utils.cache import LRUCache
+from app.utils.logger import get_logger
+from app.utils.metrics import gauge, histogram, timed
+
+logger = get_logger(__name__)
 
 DATABASE = None
+# A file path (or sqlite:///path) for a local SQLite database, or a
+# postgresql:// URL for a database shared by several replicas.
+DATABASE_URL = os.environ.get('KPA_DATABASE_URL', 'kpa.db')
+POOL_SIZE = int(os.environ.get('KPA_DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = float(os.environ.get('KPA_DB_POOL_TIMEOUT', '10'))
+STATEMENT_CACHE_SIZE = 256
+SCENARIO_CACHE_SIZE = int(os.environ.get('KPA_SCENARIO_CACHE_SIZE', '512'))
+# Other replicas sharing the database cannot invalidate this process's
+# cache, so with a shared backend cached scenarios expire after this long.
+SCENARIO_CACHE_TTL = float(os.environ.get('KPA_SCENARIO_CACHE_TTL', '30'))
+
+# Applied to every pooled connection. journal_mode=WAL is persistent and is
+# set once in init_db; with WAL, synchronous=NORMAL only fsyncs at
+# checkpoints and readers never block the writer.
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+_backend = None
+_init_lock = threading.RLock()
+
+DB_QUERY_SECONDS = histogram(
+    'kpa_db_query_seconds', 'Time spent in each database function, including waiting for a connection',
+    ['function'])
+
+# Scenarios never change after they are stored, so decoded copies can be
+# kept until the scenario is deleted, or until SCENARIO_CACHE_TTL when the
+# delete may happen on another replica.
+scenario_cache = LRUCache(SCENARIO_CACHE_SIZE)
+gauge('kpa_scenario_cache', 'Decoded scenario cache size and hit/miss/eviction counts', ['stat'],
+      callback=lambda: {(k,): v for k, v in scenario_cache.stats().items()})
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self.connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError("Timed out waiting for a database connection")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 @contextmanager
 def get_db():
-    global DATABASE
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
+    backend = _backend or ensure_db()
+    conn = backend.pool.acquire()
     try:
-        yield db
+        yield conn
     finally:
-        db.close()
-
-
-def init_db(db_path):
-    global DATABASE
-    DATABASE = db_path
-    logger.info(f"Initializing database at {db_path}")
-    with get_db() as db:
-        db.executescript('''
-            CREATE TABLE IF NOT EXISTS scenarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT NOT NULL,
-                setup_commands TEXT NOT NULL,
-                tasks TEXT NOT NULL,
-                hints TEXT NOT NULL,
-                solution TEXT NOT NULL,
-                verification_commands TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                scenario_id INTEGER,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (scenario_id) REFERENCES scenarios(id)
-            );
-
-            CREATE TABLE IF NOT EXISTS scenario_progress (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                scenario_id INTEGER NOT NULL,
-                status TEXT NOT NULL,
-                completed_tasks TEXT NOT NULL,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (scenario_id) REFERENCES scenarios(id)
-            );
-        ''')
-        db.commit()
-    logger.info("Database initialized successfully")
+        backend.pool.release(conn)
 
 
-def store_scenario(scenario: Dict[str, Any]) -> int:
-    logger.info(f"Storing scenario: {scenario['title']}")
+# Each entry upgrades the schema by one version; the backend records how
+# many have been applied (PRAGMA user_version for SQLite). Append new
+# migrations, never edit old ones.
+MIGRATIONS = [
+    # 1: initial schema
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS scenarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            setup_commands TEXT NOT NULL,
+            tasks TEXT NOT NULL,
+            hints TEXT NOT NULL,
+            solution TEXT NOT NULL,
+            verification_commands TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (scenario_id) REFERENCES scenarios(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scenario_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            completed_tasks TEXT NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (scenario_id) REFERENCES scenarios(id)
+        )
+        ''',
+    ),
+    # 2: lookup indexes and a single progress row per scenario
+    (
+        '''
+        DELETE FROM scenario_progress WHERE id NOT IN (
+            SELECT MAX(id) FROM scenario_progress GROUP BY scenario_id
+        )
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_scenario_progress_scenario
+            ON scenario_progress (scenario_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_scenario_timestamp
+            ON chat_history (scenario_id, timestamp, id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_created_at
+            ON scenarios (created_at, id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_notes_created_at
+            ON notes (created_at)
+        ''',
+    ),
+    # 3: change counters so readers can tell when a table was modified
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        "INSERT OR IGNORE INTO table_versions (name, version) VALUES ('scenarios', 0)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS scenarios_version_insert AFTER INSERT ON scenarios
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'scenarios';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS scenarios_version_update AFTER UPDATE ON scenarios
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'scenarios';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS scenarios_version_delete AFTER DELETE ON scenarios
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'scenarios';
+        END
+        ''',
+    ),
+    # 4: rolling summaries of older chat history
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            scenario_id INTEGER PRIMARY KEY,
+            upto_message_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 5: cached AI responses
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS ai_responses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            model TEXT NOT NULL,
+            version TEXT NOT NULL,
+            query TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (kind, key)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_ai_responses_last_used_at
+            ON ai_responses (last_used_at)
+        ''',
+    ),
+    # 6: pre-generated scenarios waiting in the pool are kept out of listings
+    (
+        "ALTER TABLE scenarios ADD COLUMN pooled INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE scenarios ADD COLUMN pool_topic TEXT",
+        "ALTER TABLE scenarios ADD COLUMN pool_difficulty TEXT",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_pool
+            ON scenarios (pool_topic, pool_difficulty, id) WHERE pooled = 1
+        ''',
+    ),
+]
+
+# The same schema versions for PostgreSQL. Keep in step with MIGRATIONS.
+POSTGRES_MIGRATIONS = [
+    # 1: initial schema
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS scenarios (
+            id BIGSERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            setup_commands TEXT NOT NULL,
+            tasks TEXT NOT NULL,
+            hints TEXT NOT NULL,
+            solution TEXT NOT NULL,
+            verification_commands TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notes (
+            id BIGSERIAL PRIMARY KEY,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id BIGSERIAL PRIMARY KEY,
+            scenario_id BIGINT,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scenario_progress (
+            id BIGSERIAL PRIMARY KEY,
+            scenario_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            completed_tasks TEXT NOT NULL,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 2: lookup indexes and a single progress row per scenario
+    (
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_scenario_progress_scenario
+            ON scenario_progress (scenario_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_scenario_timestamp
+            ON chat_history (scenario_id, timestamp, id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_created_at
+            ON scenarios (created_at, id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_notes_created_at
+            ON notes (created_at)
+        ''',
+    ),
+    # 3: change counters so readers can tell when a table was modified
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        "INSERT INTO table_versions (name, version) VALUES ('scenarios', 0) ON CONFLICT DO NOTHING",
+        '''
+        CREATE OR REPLACE FUNCTION bump_scenarios_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'scenarios';
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER scenarios_version AFTER INSERT OR UPDATE OR DELETE ON scenarios
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_scenarios_version()
+        ''',
+    ),
+    # 4: rolling summaries of older chat history
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            scenario_id BIGINT PRIMARY KEY,
+            upto_message_id BIGINT NOT NULL,
+            content TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 5: cached AI responses
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS ai_responses (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            model TEXT NOT NULL,
+            version TEXT NOT NULL,
+            query TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at DOUBLE PRECISION NOT NULL,
+            last_used_at DOUBLE PRECISION NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (kind, key)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_ai_responses_last_used_at
+            ON ai_responses (last_used_at)
+        ''',
+    ),
+    # 6: pre-generated scenarios waiting in the pool are kept out of listings
+    (
+        "ALTER TABLE scenarios ADD COLUMN IF NOT EXISTS pooled INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE scenarios ADD COLUMN IF NOT EXISTS pool_topic TEXT",
+        "ALTER TABLE scenarios ADD COLUMN IF NOT EXISTS pool_difficulty TEXT",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_scenarios_pool
+            ON scenarios (pool_topic, pool_difficulty, id) WHERE pooled = 1
+        ''',
+    ),
+]
+
+SCENARIO_JSON_FIELDS = ['setup_commands', 'tasks', 'hints', 'solution', 'verification_commands']
+SCENARIO_FIELDS = ['id', 'title', 'description', 'setup_commands', 'tasks', 'hints',
+                   'solution', 'verification_commands', 'created_at']
+
+
+# Storage backends. Everything above the backend speaks SQLite's dialect
+# with '?' placeholders; a backend supplies connections, the schema
+# migrations, transactions and how to get the ids of inserted rows.
+#
+# SQLiteBackend is the default: a file next to the app, or ':memory:' as a
+# throwaway stand-in. It is per-process, so every replica needs its own.
+class SQLiteBackend:
+    name = 'sqlite'
+    migrations = MIGRATIONS
+    # SQLite serializes writers, so a claimed row cannot be raced.
+    lock_rows = ''
+    shared = False
+
+    def __init__(self, path):
+        self.path = path
+        # Every connection to ':memory:' is a separate database.
+        self.pool = ConnectionPool(self._connect, 1 if path == ':memory:' else POOL_SIZE)
+
+    def _connect(self):
+        # Long-lived connections keep their prepared statements cached, so
+        # repeated queries skip parsing and planning.
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def setup(self, db):
+        mode = db.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        logger.info("Database journal mode: %s", mode)
+
+    # BEGIN IMMEDIATE takes the write lock up front, so a batch commits as
+    # one unit with one sync and its AUTOINCREMENT ids are consecutive.
+    def begin(self, db):
+        db.execute('BEGIN IMMEDIATE')
+
+    def schema_version(self, db):
+        return db.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, db, version):
+        db.execute(f'PRAGMA user_version = {int(version)}')
+
+    def insert(self, db, sql, rows):
+        db.executemany(sql, rows)
+        last_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def close(self):
+        self.pool.close()
+
+
+# Rows from PostgreSQL behave like sqlite3.Row: indexable by position or
+# column name, and convertible with dict().
+class PostgresRow(tuple):
+    def __new__(cls, names, values):
+        row = super().__new__(cls, values)
+        row.names = names
+        return row
+
+    def keys(self):
+        return self.names
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.names.index(key)
+        return tuple.__getitem__(self, key)
+
+
+def _postgres_row_factory(cursor):
+    names = [column.name for column in cursor.description or ()]
+    return lambda values: PostgresRow(names, values)
+
+
+def _postgres_sql(sql, params):
+    # psycopg only parses placeholders when parameters are passed.
+    if params is None:
+        return sql
+    return sql.replace('%', '%%').replace('?', '%s')
+
+
+class PostgresCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        self.cursor.execute(_postgres_sql(sql, params), params)
+        return self
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(_postgres_sql(sql, ()), rows)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+# Gives a psycopg connection the sqlite3 methods the queries use. It runs
+# in autocommit mode; transaction() opens explicit transactions.
+class PostgresConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self.conn.cursor())
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.cursor().executemany(sql, rows)
+
+    def commit(self):
+        if self.in_transaction:
+            self.conn.execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.conn.execute('ROLLBACK')
+
+    @property
+    def in_transaction(self):
+        from psycopg.pq import TransactionStatus
+        return self.conn.info.transaction_status != TransactionStatus.IDLE
+
+    def close(self):
+        self.conn.close()
+
+
+# Shared by every replica, so scenarios, chat, progress and cached AI
+# responses are the same whichever pod serves a request. Needs psycopg.
+class PostgresBackend:
+    name = 'postgres'
+    migrations = POSTGRES_MIGRATIONS
+    # Two replicas claiming from the pool at once take different rows.
+    lock_rows = ' FOR UPDATE SKIP LOCKED'
+    shared = True
+    # Serializes migrations across replicas starting together.
+    MIGRATION_LOCK = 7331
+
+    def __init__(self, url):
+        try:
+            import psycopg
+        except ImportError:
+            raise RuntimeError("KPA_DATABASE_URL points at PostgreSQL but psycopg is not installed")
+        self.psycopg = psycopg
+        self.url = url
+        self.pool = ConnectionPool(self._connect, POOL_SIZE)
+
+    def _connect(self):
+        conn = self.psycopg.connect(self.url, autocommit=True, row_factory=_postgres_row_factory)
+        return PostgresConnection(conn)
+
+    def setup(self, db):
+        db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+
+    def begin(self, db):
+        db.execute('BEGIN')
+
+    def schema_version(self, db):
+        db.execute('SELECT pg_advisory_xact_lock(?)', (self.MIGRATION_LOCK,))
+        return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+    def set_schema_version(self, db, version):
+        db.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+
+    def insert(self, db, sql, rows):
+        return [db.execute(f"{sql} RETURNING id", row).fetchone()[0] for row in rows]
+
+    def close(self):
+        self.pool.close()
+
+
+def create_backend(url):
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(url)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteBackend(url)
+
+
+def migrate(db, backend):
+    for version, statements in enumerate(backend.migrations, start=1):
+        backend.begin(db)
+        try:
+            # Checked under the write lock so concurrent workers starting up
+            # together apply each migration once.
+            current = backend.schema_version(db)
+            if current >= version:
+                db.rollback()
+                continue
+            logger.info("Applying database migration %s", version)
+            for statement in statements:
+                db.execute(statement)
+            backend.set_schema_version(db, version)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return len(backend.migrations)
+
+
+# The new backend is only swapped in once its schema is up to date, so
+# queries never see a half-migrated database.
+def init_db(db_url=DATABASE_URL):
+    global DATABASE, _backend
+    logger.info("Initializing database at %s", db_url.split('@')[-1])
+    backend = create_backend(db_url)
+    db = backend.pool.acquire()
+    try:
+        backend.setup(db)
+        version = migrate(db, backend)
+    finally:
+        backend.pool.release(db)
+    with _init_lock:
+        previous, DATABASE, _backend = _backend, db_url, backend
+    if previous is not None:
+        previous.close()
+    scenario_cache.clear()
+    scenario_cache.ttl = SCENARIO_CACHE_TTL if backend.shared else None
+    logger.info("Database initialized successfully at schema version %s (%s)", version, backend.name)
+
+
+# Opens the configured database on first use when nothing has yet.
+def ensure_db():
+    with _init_lock:
+        if _backend is None:
+            init_db(DATABASE_URL)
+    return _backend
+
+
+@contextmanager
+def transaction():
     with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute('''
-            INSERT INTO scenarios 
-            (title, description, setup_commands, tasks, hints, solution, verification_commands)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            scenario['title'],
-            scenario['description'],
-            json.dumps(scenario['setup_commands']),
-            json.dumps(scenario['tasks']),
-            json.dumps(scenario['hints']),
-            json.dumps(scenario['solution']),
-            json.dumps(scenario['verification_commands'])
-        ))
-        db.commit()
-        scenario_id = cursor.lastrowid
-    logger.info(f"Scenario stored with id: {scenario_id}")
-    return scenario_id
+        _backend.begin(db)
+        try:
+            yield db
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+
+# Inserts the rows with one statement each and returns their ids in order.
+def _insert(db, sql: str, rows: List[tuple]) -> List[int]:
+    return _backend.insert(db, sql, rows)
+
+
+def store_scenario(scenario: Dict[str, Any]) -> int:
+    return store_scenarios([scenario])[0]
+
+
+# With a topic and difficulty the scenarios go into the pre-generated pool
+# instead of the user's list; see claim_pooled_scenario.
+@timed(DB_QUERY_SECONDS)
+def store_scenarios(scenarios: List[Dict[str, Any]], topic: str = None,
+                    difficulty: str = None) -> List[int]:
+    if not scenarios:
+        return []
+    pooled = topic is not None
+    if pooled:
+        logger.info("Storing %s scenarios in pool %s/%s", len(scenarios), topic, difficulty)
+    else:
+        logger.info("Storing %s scenarios", len(scenarios))
+    rows = [(
+        scenario['title'],
+        scenario['description'],
+        json.dumps(scenario['setup_commands']),
+        json.dumps(scenario['tasks']),
+        json.dumps(scenario['hints']),
+        json.dumps(scenario['solution']),
+        json.dumps(scenario['verification_commands']),
+        int(pooled),
+        topic,
+        difficulty
+    ) for scenario in scenarios]
+    with transaction() as db:
+        scenario_ids = _insert(db, '''
+            INSERT INTO scenarios
+            (title, description, setup_commands, tasks, hints, solution, verification_commands,
+             pooled, pool_topic, pool_difficulty)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    for scenario_id in scenario_ids:
+        scenario_cache.delete(scenario_id)
+    logger.info("Scenarios stored with ids: %s", scenario_ids)
+    return scenario_ids
 
 
+@timed(DB_QUERY_SECONDS)
 def delete_scenario(scenario_id: int) -> bool:
-    logger.info(f"Deleting scenario with id: {scenario_id}")
+    logger.info("Deleting scenario with id: %s", scenario_id)
     with get_db() as db:
         cursor = db.cursor()
         cursor.execute("DELETE FROM scenarios WHERE id = ?", (scenario_id,))
         db.commit()
         rows_affected = cursor.rowcount
-    logger.info(f"Deleted scenario with id {
-                scenario_id}. Rows affected: {rows_affected}")
+    scenario_cache.delete(int(scenario_id))
+    logger.info(
+        "Deleted scenario with id %s. Rows affected: %s", scenario_id, rows_affected)
     return rows_affected > 0
 
 
+@timed(DB_QUERY_SECONDS)
 def get_scenario(scenario_id: int) -> Dict[str, Any]:
-    logger.info(f"Fetching scenario with id: {scenario_id}")
+    logger.info("Fetching scenario with id: %s", scenario_id)
+    scenario_id = int(scenario_id)
+    scenario = scenario_cache.get(scenario_id)
+    if scenario is not None:
+        # Callers get their own copy so the cached one stays pristine.
+        return copy.deepcopy(scenario)
+
     with get_db() as db:
         cursor = db.cursor()
-        cursor.execute("SELECT * FROM scenarios WHERE id = ?", (scenario_id,))
+        cursor.execute(f"SELECT {', '.join(SCENARIO_FIELDS)} FROM scenarios WHERE id = ?",
+                       (scenario_id,))
         row = cursor.fetchone()
         if row:
             scenario = dict(row)
-            for field in ['setup_commands', 'tasks', 'hints', 'solution', 'verification_commands']:
+            for field in SCENARIO_JSON_FIELDS:
                 if field in scenario and scenario[field]:
                     scenario[field] = json.loads(scenario[field])
                 else:
                     scenario[field] = []
-            logger.info(f"Scenario fetched: {scenario}")
-            return scenario
-    logger.warning(f"Scenario with id {scenario_id} not found")
+            scenario_cache.set(scenario_id, scenario)
+            logger.debug("Scenario fetched: %s", scenario)
+            return copy.deepcopy(scenario)
+    logger.warning("Scenario with id %s not found", scenario_id)
     return None
 
 
+@timed(DB_QUERY_SECONDS)
+def count_pooled_scenarios() -> Dict[tuple, int]:
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT pool_topic, pool_difficulty, COUNT(*) FROM scenarios "
+            "WHERE pooled = 1 GROUP BY pool_topic, pool_difficulty"
+        ).fetchall()
+    return {(row[0], row[1]): row[2] for row in rows}
+
+
+# Takes the oldest pooled scenario for the topic and difficulty and hands it
+# to the user. It is re-inserted under a fresh id so it sorts as the newest
+# scenario in the keyset-paged listing. Returns the new id, or None when the
+# pool is empty.
+@timed(DB_QUERY_SECONDS)
+def claim_pooled_scenario(topic: str, difficulty: str) -> int:
+    with transaction() as db:
+        row = db.execute(
+            "SELECT id FROM scenarios WHERE pooled = 1 AND pool_topic = ? AND pool_difficulty = ? "
+            "ORDER BY id LIMIT 1" + _backend.lock_rows,
+            (topic, difficulty)
+        ).fetchone()
+        if row is None:
+            return None
+        scenario_id = _insert(db, '''
+            INSERT INTO scenarios
+            (title, description, setup_commands, tasks, hints, solution, verification_commands)
+            SELECT title, description, setup_commands, tasks, hints, solution, verification_commands
+            FROM scenarios WHERE id = ?
+        ''', [(row[0],)])[0]
+        db.execute("DELETE FROM scenarios WHERE id = ?", (row[0],))
+    scenario_cache.delete(row[0])
+    logger.info("Claimed pooled scenario %s as %s from pool %s/%s", row[0], scenario_id, topic, difficulty)
+    return scenario_id
+
+
+def scenario_cache_stats() -> Dict[str, int]:
+    return scenario_cache.stats()
+
+
+@timed(DB_QUERY_SECONDS)
 def store_note(content: str) -> int:
     logger.info("Storing note")
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "INSERT INTO notes (content) VALUES (?)",
-            (content,)
-        )
-        db.commit()
-        note_id = cursor.lastrowid
-    logger.info(f"Note stored with id: {note_id}")
+    with transaction() as db:
+        note_id = _insert(db, "INSERT INTO notes (content) VALUES (?)", [(content,)])[0]
+    logger.info("Note stored with id: %s", note_id)
     return note_id
 
 
-def get_notes() -> List[Dict[str, Any]]:
+@timed(DB_QUERY_SECONDS)
+def get_notes(limit: int = None) -> List[Dict[str, Any]]:
     logger.info("Fetching all notes")
     with get_db() as db:
         cursor = db.cursor()
-        cursor.execute("SELECT * FROM notes ORDER BY created_at DESC")
+        if limit is None:
+            cursor.execute("SELECT * FROM notes ORDER BY created_at DESC")
+        else:
+            cursor.execute("SELECT * FROM notes ORDER BY created_at DESC LIMIT ?", (limit,))
         notes = [dict(row) for row in cursor.fetchall()]
-    logger.info(f"Fetched {len(notes)} notes")
+    logger.info("Fetched %s notes", len(notes))
     return notes
 
 
 def store_chat_message(scenario_id: int, role: str, content: str) -> int:
-    logger.info(f"Storing chat message for scenario_id: {
-                scenario_id}, role: {role}")
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "INSERT INTO chat_history (scenario_id, role, content) VALUES (?, ?, ?)",
-            (scenario_id, role, content)
-        )
-        db.commit()
-        message_id = cursor.lastrowid
-    logger.info(f"Chat message stored with id: {message_id}")
-    return message_id
+    return store_chat_messages([{'scenario_id': scenario_id, 'role': role, 'content': content}])[0]
+
+
+@timed(DB_QUERY_SECONDS)
+def store_chat_messages(messages: List[Dict[str, Any]]) -> List[int]:
+    if not messages:
+        return []
+    logger.info("Storing %s chat messages", len(messages))
+    rows = [(m['scenario_id'], m['role'], m['content']) for m in messages]
+    with transaction() as db:
+        message_ids = _insert(
+            db, "INSERT INTO chat_history (scenario_id, role, content) VALUES (?, ?, ?)", rows)
+    logger.info("Chat messages stored with ids: %s", message_ids)
+    return message_ids
 
 
+@timed(DB_QUERY_SECONDS)
 def get_chat_history(scenario_id: int) -> List[Dict[str, Any]]:
-    logger.info(f"Fetching chat history for scenario_id: {scenario_id}")
+    logger.info("Fetching chat history for scenario_id: %s", scenario_id)
     with get_db() as db:
         cursor = db.cursor()
         cursor.execute(
-            "SELECT * FROM chat_history WHERE scenario_id = ? ORDER BY timestamp",
+            "SELECT * FROM chat_history WHERE scenario_id = ? ORDER BY timestamp, id",
             (scenario_id,)
         )
         chat_history = [dict(row) for row in cursor.fetchall()]
-    logger.info(f"Fetched {len(chat_history)} chat messages")
+    logger.info("Fetched %s chat messages", len(chat_history))
     return chat_history
 
 
+@timed(DB_QUERY_SECONDS)
+def get_recent_chat_history(scenario_id: int, limit: int) -> List[Dict[str, Any]]:
+    logger.info("Fetching %s recent chat messages for scenario_id: %s", limit, scenario_id)
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT * FROM chat_history WHERE scenario_id = ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (scenario_id, limit)
+        ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+
+@timed(DB_QUERY_SECONDS)
+def get_chat_history_range(scenario_id: int, after_id: int, before_id: int,
+                           limit: int) -> List[Dict[str, Any]]:
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT * FROM chat_history WHERE scenario_id = ? AND id > ? AND id < ? "
+            "ORDER BY id LIMIT ?",
+            (scenario_id, after_id, before_id, limit)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@timed(DB_QUERY_SECONDS)
+def get_chat_summary(scenario_id: int) -> Dict[str, Any]:
+    with get_db() as db:
+        row = db.execute(
+            "SELECT * FROM chat_summaries WHERE scenario_id = ?", (scenario_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+@timed(DB_QUERY_SECONDS)
+def store_chat_summary(scenario_id: int, upto_message_id: int, content: str) -> None:
+    logger.info("Storing chat summary for scenario_id: %s up to message %s", scenario_id, upto_message_id)
+    with get_db() as db:
+        db.execute('''
+            INSERT INTO chat_summaries (scenario_id, upto_message_id, content, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (scenario_id) DO UPDATE SET
+                upto_message_id = excluded.upto_message_id,
+                content = excluded.content,
+                updated_at = excluded.updated_at
+        ''', (scenario_id, upto_message_id, content, datetime.now().isoformat()))
+        db.commit()
+
+
+@timed(DB_QUERY_SECONDS)
 def update_scenario_progress(scenario_id: int, status: str, completed_tasks: List[str]) -> None:
-    logger.info(f"Updating scenario progress for scenario_id: {scenario_id}")
+    logger.info("Updating scenario progress for scenario_id: %s", scenario_id)
     with get_db() as db:
         cursor = db.cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO scenario_progress 
+            INSERT INTO scenario_progress
             (scenario_id, status, completed_tasks, last_updated)
             VALUES (?, ?, ?, ?)
+            ON CONFLICT (scenario_id) DO UPDATE SET
+                status = excluded.status,
+                completed_tasks = excluded.completed_tasks,
+                last_updated = excluded.last_updated
         ''', (
             scenario_id,
             status,
@@ -191,11 +884,12 @@ def update_scenario_progress(scenario_id: int, status: str, completed_tasks: Lis
             datetime.now().isoformat()
         ))
         db.commit()
-    logger.info(f"Scenario progress updated for scenario_id: {scenario_id}")
+    logger.info("Scenario progress updated for scenario_id: %s", scenario_id)
 
 
+@timed(DB_QUERY_SECONDS)
 def get_scenario_progress(scenario_id: int) -> Dict[str, Any]:
-    logger.info(f"Fetching scenario progress for scenario_id: {scenario_id}")
+    logger.info("Fetching scenario progress for scenario_id: %s", scenario_id)
     with get_db() as db:
         cursor = db.cursor()
         cursor.execute(
@@ -207,34 +901,159 @@ def get_scenario_progress(scenario_id: int) -> Dict[str, Any]:
             progress = dict(row)
             progress['completed_tasks'] = json.loads(
                 progress['completed_tasks'])
-            logger.info(f"Scenario progress fetched: {progress}")
+            logger.debug("Scenario progress fetched: %s", progress)
             return progress
-    logger.warning(f"Scenario progress for scenario_id {
-                   scenario_id} not found")
+    logger.warning(
+        "Scenario progress for scenario_id %s not found", scenario_id)
     return None
 
 
+@timed(DB_QUERY_SECONDS)
 def get_all_scenarios() -> List[Dict[str, Any]]:
     logger.info("Fetching all scenarios")
     with get_db() as db:
         cursor = db.cursor()
         cursor.execute(
-            "SELECT id, title, description, tasks FROM scenarios ORDER BY created_at DESC")
+            "SELECT id, title, description, tasks FROM scenarios WHERE pooled = 0 "
+            "ORDER BY created_at DESC, id DESC")
         scenarios = []
         for row in cursor.fetchall():
             scenario = dict(row)
             scenario['tasks'] = json.loads(scenario['tasks'])
             scenarios.append(scenario)
-    logger.info(f"Fetched {len(scenarios)} scenarios")
+    logger.info("Fetched %s scenarios", len(scenarios))
+    return scenarios
+
+
+@timed(DB_QUERY_SECONDS)
+def list_scenarios(limit: int, before_id: int = None, fields: List[str] = None) -> List[Dict[str, Any]]:
+    fields = [f for f in SCENARIO_FIELDS if f in (fields or SCENARIO_FIELDS)]
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    logger.info("Listing %s scenarios before id %s", limit, before_id)
+    # Keyset pagination on the primary key: each page is an index range
+    # scan, however deep the client has paged.
+    query = f"SELECT {', '.join(fields)} FROM scenarios WHERE pooled = 0"
+    params = []
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with get_db() as db:
+        rows = db.execute(query, params).fetchall()
+    scenarios = []
+    for row in rows:
+        scenario = dict(row)
+        for field in SCENARIO_JSON_FIELDS:
+            if field in scenario:
+                scenario[field] = json.loads(scenario[field]) if scenario[field] else []
+        scenarios.append(scenario)
     return scenarios
 
 
+@timed(DB_QUERY_SECONDS)
+def get_scenarios_stamp() -> tuple:
+    with get_db() as db:
+        row = db.execute(
+            "SELECT (SELECT MAX(id) FROM scenarios WHERE pooled = 0), "
+            "(SELECT version FROM table_versions WHERE name = 'scenarios')"
+        ).fetchone()
+    return row[0] or 0, row[1] or 0
+
+
+@timed(DB_QUERY_SECONDS)
 def get_last_scenario_id() -> int:
     logger.info("Fetching last scenario id")
     with get_db() as db:
         cursor = db.cursor()
-        cursor.execute("SELECT MAX(id) FROM scenarios")
+        cursor.execute("SELECT MAX(id) FROM scenarios WHERE pooled = 0")
         result = cursor.fetchone()
         last_id = result[0] if result[0] is not None else 0
-    logger.info(f"Last scenario id: {last_id}")
+    logger.info("Last scenario id: %s", last_id)
     return last_id
+
+
+@timed(DB_QUERY_SECONDS)
+def get_cached_response(kind: str, key: str, model: str, version: str,
+                        created_after: float) -> Dict[str, Any]:
+    with get_db() as db:
+        row = db.execute(
+            "SELECT id, response FROM ai_responses WHERE kind = ? AND key = ? "
+            "AND model = ? AND version = ? AND created_at > ?",
+            (kind, key, model, version, created_after)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+@timed(DB_QUERY_SECONDS)
+def get_cached_response_by_id(response_id: int, created_after: float) -> Dict[str, Any]:
+    with get_db() as db:
+        row = db.execute(
+            "SELECT id, response FROM ai_responses WHERE id = ? AND created_at > ?",
+            (response_id, created_after)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+@timed(DB_QUERY_SECONDS)
+def list_cached_responses(kind: str, model: str, version: str,
+                          created_after: float) -> List[Dict[str, Any]]:
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT id, query FROM ai_responses WHERE kind = ? AND model = ? "
+            "AND version = ? AND created_at > ?",
+            (kind, model, version, created_after)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@timed(DB_QUERY_SECONDS)
+def store_cached_response(kind: str, key: str, model: str, version: str,
+                          query: str, response: str, now: float) -> int:
+    with get_db() as db:
+        db.execute('''
+            INSERT INTO ai_responses (kind, key, model, version, query, response, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                model = excluded.model,
+                version = excluded.version,
+                query = excluded.query,
+                response = excluded.response,
+                created_at = excluded.created_at,
+                last_used_at = excluded.last_used_at,
+                hits = 0
+        ''', (kind, key, model, version, query, response, now, now))
+        response_id = db.execute(
+            "SELECT id FROM ai_responses WHERE kind = ? AND key = ?", (kind, key)
+        ).fetchone()[0]
+        db.commit()
+    return response_id
+
+
+@timed(DB_QUERY_SECONDS)
+def touch_cached_response(response_id: int, now: float) -> None:
+    with get_db() as db:
+        db.execute(
+            "UPDATE ai_responses SET hits = hits + 1, last_used_at = ? WHERE id = ?",
+            (now, response_id)
+        )
+        db.commit()
+
+
+# Drops expired entries and then the least recently used ones beyond
+# max_entries; returns the ids removed.
+@timed(DB_QUERY_SECONDS)
+def prune_cached_responses(max_entries: int, created_after: float) -> List[int]:
+    with transaction() as db:
+        rows = db.execute(
+            "SELECT id FROM ai_responses WHERE created_at <= ? "
+            "UNION SELECT id FROM ai_responses WHERE id NOT IN "
+            "(SELECT id FROM ai_responses ORDER BY last_used_at DESC LIMIT ?)",
+            (created_after, max_entries)
+        ).fetchall()
+        removed = [row[0] for row in rows]
+        db.executemany("DELETE FROM ai_responses WHERE id = ?", [(i,) for i in removed])
+    if removed:
+        logger.info("Pruned %s cached AI responses", len(removed))
+    return removed
@@ -0,0 +1,359 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import re
+import secrets
+import shlex
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from app.services import db
+from app.utils.logger import get_logger
+from app.utils.metrics import gauge, histogram
+
+logger = get_logger(__name__)
+
+ENVIRONMENTS_ENABLED = os.environ.get('KPA_ENVIRONMENTS', '1') != '0'
+POOL_SIZE = int(os.environ.get('KPA_ENVIRONMENT_POOL_SIZE', '1'))
+MAX_ENVIRONMENTS = int(os.environ.get('KPA_MAX_ENVIRONMENTS', '20'))
+PROVISION_WORKERS = int(os.environ.get('KPA_ENVIRONMENT_WORKERS', '2'))
+SETUP_TIMEOUT = float(os.environ.get('KPA_ENVIRONMENT_SETUP_TIMEOUT', '60'))
+# Unclaimed environments for a scenario nobody has opened for this long are
+# collected; so are released ones after RELEASE_GRACE.
+IDLE_TTL = float(os.environ.get('KPA_ENVIRONMENT_IDLE_TTL', '1800'))
+RELEASE_GRACE = float(os.environ.get('KPA_ENVIRONMENT_RELEASE_GRACE', '60'))
+# In-cluster the app's service account only has a narrow cluster-wide role.
+# Each environment namespace gets a RoleBinding to KPA_ENVIRONMENT_ROLE, a
+# ClusterRole allowing what setup commands and users do inside it, for the
+# service account KPA_SERVICE_ACCOUNT ("namespace:name").
+ENVIRONMENT_ROLE = os.environ.get('KPA_ENVIRONMENT_ROLE', '')
+SERVICE_ACCOUNT = os.environ.get('KPA_SERVICE_ACCOUNT', '')
+GC_INTERVAL = 60
+GC_BATCH = 20
+
+ENVIRONMENT_LABEL = 'kpa.dev/environment'
+SCENARIO_LABEL = 'kpa.dev/scenario'
+INSTANCE_LABEL = 'kpa.dev/instance'
+# Replicas only collect leftover namespaces they created themselves.
+INSTANCE = re.sub(r'[^A-Za-z0-9_.-]', '-', os.environ.get('KPA_INSTANCE') or socket.gethostname())[:63].strip('-_.')
+NAMESPACE_FLAGS = ('-n', '--namespace', '-A', '--all-namespaces')
+SHELL_SYNTAX_RE = re.compile(r'[|&;<>`$]')
+
+# Setup commands are grouped into stages by what they create; commands in a
+# stage run in parallel and each stage waits for the one before it.
+# Namespaced plumbing comes before workloads, and commands that act on
+# existing objects come last.
+STAGES = (
+    {'namespace', 'namespaces', 'ns', 'customresourcedefinition', 'crd', 'storageclass', 'pv',
+     'persistentvolume', 'clusterrole', 'priorityclass'},
+    {'configmap', 'cm', 'secret', 'serviceaccount', 'sa', 'role', 'rolebinding', 'clusterrolebinding',
+     'pvc', 'persistentvolumeclaim', 'networkpolicy', 'netpol', 'quota', 'resourcequota', 'limitrange'},
+    {'deployment', 'deploy', 'statefulset', 'sts', 'daemonset', 'ds', 'pod', 'po', 'job', 'cronjob',
+     'cj', 'replicaset', 'rs'},
+)
+LATE_VERBS = {'expose', 'scale', 'set', 'label', 'annotate', 'patch', 'rollout', 'autoscale', 'taint',
+              'cordon', 'uncordon', 'drain', 'exec', 'cp', 'wait'}
+WORKLOAD_VERBS = {'run', 'apply'}
+
+SETUP_SECONDS = histogram(
+    'kpa_environment_setup_seconds', 'Time taken to provision a scenario environment', ['outcome'],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+
+
+def command_stage(command):
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return len(STAGES)
+    words = [a for a in args[1:] if not a.startswith('-')]
+    verb = words[0] if words else ''
+    if verb in LATE_VERBS:
+        return len(STAGES) + 1
+    if verb in WORKLOAD_VERBS:
+        return len(STAGES) - 1
+    if verb == 'create' and len(words) > 1:
+        kind = words[1].split('/')[0].lower()
+        for stage, kinds in enumerate(STAGES):
+            if kind in kinds:
+                return stage
+    return len(STAGES)
+
+
+def plan_stages(commands):
+    stages = {}
+    for command in commands:
+        stages.setdefault(command_stage(command), []).append(command)
+    return [stages[stage] for stage in sorted(stages)]
+
+
+# Where a namespace flag can go: before the first standalone '--' (whose
+# arguments belong to the container or remote command) or shell operator,
+# so pipes, redirections and heredoc bodies are left as they are.
+def flag_position(command):
+    quote = None
+    i = 0
+    while i < len(command):
+        c = command[i]
+        if quote:
+            if c == quote:
+                quote = None
+            elif c == '\\' and quote == '"':
+                i += 1
+        elif c in '\'"':
+            quote = c
+        elif c == '\\':
+            i += 1
+        elif c in '|;&<>\n':
+            return i
+        elif (command.startswith('--', i) and (i == 0 or command[i - 1].isspace()) and
+              (i + 2 == len(command) or command[i + 2].isspace())):
+            return i
+        i += 1
+    return len(command)
+
+
+def scope_command(command, namespace):
+    # Commands that already choose a namespace, or that create one, run as
+    # written; everything else is pointed at the environment's namespace.
+    position = flag_position(command)
+    head, tail = command[:position].rstrip(), command[position:]
+    try:
+        args = shlex.split(head)
+    except ValueError:
+        return command
+    if any(a in NAMESPACE_FLAGS or a.startswith('--namespace=') or
+           (a.startswith('-n') and len(a) > 2) for a in args):
+        return command
+    words = [a for a in args[1:] if not a.startswith('-')]
+    if words[:2] in (['create', 'namespace'], ['create', 'ns']):
+        return command
+    scoped = f"{head} -n {shlex.quote(namespace)}"
+    return f"{scoped} {tail}" if tail else scoped
+
+
+class Environment:
+    def __init__(self, scenario_id, namespace):
+        self.scenario_id = scenario_id
+        self.namespace = namespace
+        self.state = 'provisioning'
+        self.owner = None
+        self.error = None
+        self.created = time.monotonic()
+        self.released = None
+        self.finished = threading.Event()
+
+
+# Keeps ready-made namespaces for scenarios, each with the scenario's setup
+# commands already run in it, so a user opening a scenario gets a working
+# environment at once. Environments are never reused: one that has been
+# handed out is deleted after its user leaves.
+class EnvironmentProvisioner:
+    def __init__(self, kubectl_executor, size=POOL_SIZE, max_environments=MAX_ENVIRONMENTS):
+        self.kubectl_executor = kubectl_executor
+        self.size = size
+        self.max_environments = max_environments
+        self.environments = {}
+        self.last_requested = {}
+        self.pool = ThreadPoolExecutor(max_workers=PROVISION_WORKERS, thread_name_prefix='environment')
+        self._lock = threading.Lock()
+        self._gc_thread = None
+        gauge('kpa_environments', 'Scenario environments by state', ['state'], callback=self.counts)
+
+    @property
+    def enabled(self):
+        return ENVIRONMENTS_ENABLED and self.kubectl_executor is not None
+
+    def start(self):
+        if not self.enabled or self._gc_thread is not None:
+            return
+        self._gc_thread = threading.Thread(target=self._gc_loop, name='environment-gc', daemon=True)
+        self._gc_thread.start()
+
+    # Tops up the ready stock for a scenario in the background.
+    def prepare(self, scenario_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.last_requested[scenario_id] = time.monotonic()
+            stocked = sum(1 for env in self.environments.values()
+                          if env.scenario_id == scenario_id and env.owner is None and
+                          env.state in ('provisioning', 'ready'))
+            wanted = max(0, min(self.size - stocked, self._room()))
+            created = [self._new_environment(scenario_id) for _ in range(wanted)]
+        for env in created:
+            self.pool.submit(self._provision, env)
+
+    # Hands an environment for the scenario to `owner`: a ready one if there
+    # is one, else one still being set up (usually the one the page load
+    # started), else a new one provisioned on the spot. Returns None when
+    # environments are disabled, setup failed or max_environments is reached.
+    def claim(self, scenario_id, owner):
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.last_requested[scenario_id] = time.monotonic()
+            unowned = [e for e in self.environments.values()
+                       if e.scenario_id == scenario_id and e.owner is None]
+            env = (next((e for e in unowned if e.state == 'ready'), None) or
+                   next((e for e in unowned if e.state == 'provisioning'), None))
+            created = env is None
+            if created:
+                if self._room() <= 0:
+                    logger.warning("Environment limit of %s reached; scenario %s gets none",
+                                   self.max_environments, scenario_id)
+                    return None
+                env = self._new_environment(scenario_id)
+            env.owner = owner
+            if env.state == 'ready':
+                env.state = 'claimed'
+        if created:
+            self._provision(env)
+        elif not env.finished.is_set():
+            # Setup may still be queued behind other environments.
+            env.finished.wait(SETUP_TIMEOUT * 2)
+        self.prepare(scenario_id)
+        if env.state != 'claimed':
+            return None
+        logger.info("Environment %s claimed for scenario %s", env.namespace, scenario_id)
+        return env
+
+    def release(self, owner):
+        with self._lock:
+            for env in self.environments.values():
+                if env.owner == owner and env.state == 'claimed':
+                    env.state = 'released'
+                    env.released = time.monotonic()
+                elif env.owner == owner and env.state == 'provisioning':
+                    # Still being set up, so it goes back into the stock.
+                    env.owner = None
+
+    def environment_for(self, owner):
+        with self._lock:
+            return next((e for e in self.environments.values()
+                         if e.owner == owner and e.state == 'claimed'), None)
+
+    def lookup(self, namespace):
+        with self._lock:
+            return self.environments.get(namespace)
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for env in self.environments.values():
+                counts[(env.state,)] = counts.get((env.state,), 0) + 1
+            return counts
+
+    # How many more environments fit under max_environments; called with
+    # the lock held.
+    def _room(self):
+        return self.max_environments - sum(
+            1 for env in self.environments.values() if env.state != 'deleting')
+
+    def _new_environment(self, scenario_id):
+        namespace = f"kpa-s{scenario_id}-{secrets.token_hex(3)}"
+        env = Environment(scenario_id, namespace)
+        self.environments[namespace] = env
+        return env
+
+    def _provision(self, env):
+        started = time.monotonic()
+        try:
+            scenario = db.get_scenario(env.scenario_id)
+            if scenario is None:
+                raise ValueError(f"Scenario {env.scenario_id} not found")
+            self.kubectl_executor.execute(f"kubectl create namespace {env.namespace}")
+            self.kubectl_executor.execute(
+                f"kubectl label namespace {env.namespace} {ENVIRONMENT_LABEL}=true "
+                f"{SCENARIO_LABEL}={env.scenario_id} {INSTANCE_LABEL}={INSTANCE}")
+            if ENVIRONMENT_ROLE and SERVICE_ACCOUNT:
+                self.kubectl_executor.execute(
+                    f"kubectl create rolebinding kpa-environment -n {env.namespace} "
+                    f"--clusterrole={ENVIRONMENT_ROLE} --serviceaccount={SERVICE_ACCOUNT}")
+            for stage in plan_stages(scenario.get('setup_commands') or []):
+                self._run_stage(env, stage, started)
+        except Exception as e:
+            logger.error("Provisioning environment %s failed: %s", env.namespace, e)
+            SETUP_SECONDS.observe(time.monotonic() - started, outcome='failed')
+            with self._lock:
+                env.state = 'failed'
+                env.error = str(e)
+            env.finished.set()
+            return
+        SETUP_SECONDS.observe(time.monotonic() - started, outcome='ready')
+        logger.info("Environment %s ready in %.2fs", env.namespace, time.monotonic() - started)
+        with self._lock:
+            env.state = 'ready' if env.owner is None else 'claimed'
+        env.finished.set()
+
+    def _run_stage(self, env, commands, started):
+        futures = {}
+        for command in commands:
+            scoped = scope_command(command, env.namespace)
+            futures[self.kubectl_executor.submit(
+                scoped, shell=bool(SHELL_SYNTAX_RE.search(scoped)))] = command
+        done, pending = wait(futures, timeout=max(0, SETUP_TIMEOUT - (time.monotonic() - started)))
+        for future in pending:
+            self.kubectl_executor.cancel(future)
+        if pending:
+            raise TimeoutError(f"Setup did not finish within {SETUP_TIMEOUT}s")
+        for future in done:
+            try:
+                future.result()
+            except Exception as e:
+                # Shared objects such as an explicitly named namespace are
+                # only created by the first environment.
+                if 'AlreadyExists' not in str(e) and 'already exists' not in str(e):
+                    raise
+
+    def _gc_loop(self):
+        self._collect_orphans()
+        while True:
+            time.sleep(GC_INTERVAL)
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error("Environment garbage collection failed: %s", e)
+
+    # Deletes released, failed and long-unwanted environments, batching the
+    # namespaces into as few kubectl calls as possible.
+    def collect(self):
+        now = time.monotonic()
+        with self._lock:
+            doomed = [env for env in self.environments.values() if
+                      env.state == 'failed' or
+                      (env.state == 'released' and now - env.released > RELEASE_GRACE) or
+                      (env.state == 'ready' and now - self.last_requested.get(env.scenario_id, 0) > IDLE_TTL)]
+            for env in doomed:
+                env.state = 'deleting'
+        self._delete([env.namespace for env in doomed])
+        with self._lock:
+            for env in doomed:
+                self.environments.pop(env.namespace, None)
+        return len(doomed)
+
+    # Namespaces left behind by an earlier run of this instance.
+    def _collect_orphans(self):
+        try:
+            output = self.kubectl_executor.execute(
+                f"kubectl get namespaces -l {ENVIRONMENT_LABEL}=true,{INSTANCE_LABEL}={INSTANCE} -o name")
+        except Exception as e:
+            logger.warning("Could not list leftover environments: %s", e)
+            return
+        with self._lock:
+            known = set(self.environments)
+        orphans = [name.split('/', 1)[-1] for name in output.split() if name.split('/', 1)[-1] not in known]
+        self._delete(orphans)
+
+    def _delete(self, namespaces):
+        for i in range(0, len(namespaces), GC_BATCH):
+            batch = namespaces[i:i + GC_BATCH]
+            try:
+                self.kubectl_executor.execute(
+                    f"kubectl delete namespace {' '.join(batch)} --wait=false --ignore-not-found")
+                logger.info("Deleted %s scenario environments", len(batch))
+            except Exception as e:
+                logger.error("Deleting environments %s failed: %s", batch, e)
@@ -3,23 +3,461 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import json
+import os
+import re
+import shlex
+import signal
 import subprocess
-from app.utils.logger import logger
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.utils.logger import get_logger
+from app.utils.metrics import histogram
+
+logger = get_logger(__name__)
+
+MAX_WORKERS = int(os.environ.get('KPA_EXECUTOR_WORKERS', '16'))
+COMMAND_TIMEOUT = float(os.environ.get('KPA_COMMAND_TIMEOUT', '30'))
+FAST_PATH_ENABLED = os.environ.get('KPA_KUBE_FAST_PATH', '1') != '0'
+
+QUEUE_SECONDS = histogram(
+    'kpa_kubectl_queue_seconds', 'Time kubectl commands wait for an executor worker')
+SPAWN_SECONDS = histogram(
+    'kpa_kubectl_spawn_seconds', 'Time taken to start a kubectl subprocess')
+EXEC_SECONDS = histogram(
+    'kpa_kubectl_exec_seconds', 'Time taken to run a kubectl command, by how it was served and its outcome',
+    ['path', 'outcome'])
+
+SERVICE_ACCOUNT_NAMESPACE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+
+# (api, kind, apiVersion, name used by -o name, namespaced)
+RESOURCES = {
+    'pods': ('core', 'Pod', 'v1', 'pod', True),
+    'deployments': ('apps', 'Deployment', 'apps/v1', 'deployment.apps', True),
+    'services': ('core', 'Service', 'v1', 'service', True),
+    'nodes': ('core', 'Node', 'v1', 'node', False),
+    'namespaces': ('core', 'Namespace', 'v1', 'namespace', False),
+}
+
+RESOURCE_ALIASES = {
+    'po': 'pods', 'pod': 'pods', 'pods': 'pods',
+    'deploy': 'deployments', 'deployment': 'deployments', 'deployments': 'deployments',
+    'deployment.apps': 'deployments', 'deployments.apps': 'deployments',
+    'svc': 'services', 'service': 'services', 'services': 'services',
+    'no': 'nodes', 'node': 'nodes', 'nodes': 'nodes',
+    'ns': 'namespaces', 'namespace': 'namespaces', 'namespaces': 'namespaces',
+}
+
+# Python client method names per resource: (list all namespaces, list in
+# namespace, read one). Cluster-scoped resources only have list and read.
+API_METHODS = {
+    'pods': ('list_pod_for_all_namespaces', 'list_namespaced_pod', 'read_namespaced_pod'),
+    'deployments': ('list_deployment_for_all_namespaces', 'list_namespaced_deployment',
+                    'read_namespaced_deployment'),
+    'services': ('list_service_for_all_namespaces', 'list_namespaced_service',
+                 'read_namespaced_service'),
+    'nodes': ('list_node', None, 'read_node'),
+    'namespaces': ('list_namespace', None, 'read_namespace'),
+}
+
+JSONPATH_FIELD_RE = re.compile(r'\.((?:\\\.|[^.\[\\])+)|\[(\*|-?\d+)\]')
+
+
+class Unsupported(Exception):
+    pass
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandCancelled(Exception):
+    pass
+
+
+class Command:
+    def __init__(self, command, args, timeout, shell=False):
+        self.command = command
+        self.args = args
+        self.timeout = timeout
+        self.shell = shell
+        self.process = None
+        self.cancelled = False
+        self.path = 'binary'
+        self.submitted = time.perf_counter()
+
+
+def parse_get(args):
+    if len(args) < 3 or args[1] != 'get':
+        raise Unsupported()
+    request = {'namespace': None, 'all_namespaces': False,
+               'selector': None, 'output': None, 'targets': []}
+    options = {'-n': 'namespace', '--namespace': 'namespace',
+               '-l': 'selector', '--selector': 'selector',
+               '-o': 'output', '--output': 'output'}
+    rest = iter(args[2:])
+    for arg in rest:
+        if arg in ('-A', '--all-namespaces'):
+            request['all_namespaces'] = True
+        elif arg in options:
+            value = next(rest, None)
+            if value is None:
+                raise Unsupported()
+            request[options[arg]] = value
+        elif arg.startswith('--') and '=' in arg and arg.split('=', 1)[0] in options:
+            flag, value = arg.split('=', 1)
+            request[options[flag]] = value
+        elif arg[:2] in ('-n', '-l', '-o') and len(arg) > 2:
+            request[options[arg[:2]]] = arg[2:].lstrip('=')
+        elif arg.startswith('-'):
+            raise Unsupported()
+        else:
+            request['targets'].append(arg)
+
+    targets = request['targets']
+    if len(targets) == 1 and '/' in targets[0]:
+        targets = targets[0].split('/', 1)
+    if not targets or len(targets) > 2 or ',' in targets[0]:
+        raise Unsupported()
+    resource = RESOURCE_ALIASES.get(targets[0].lower())
+    if resource is None:
+        raise Unsupported()
+    request['resource'] = resource
+    request['name'] = targets[1] if len(targets) == 2 else None
+    return request
+
+
+def render_jsonpath(template, data):
+    output = []
+    position = 0
+    for match in re.finditer(r'\{([^{}]*)\}', template):
+        output.append(template[position:match.start()])
+        position = match.end()
+        expression = match.group(1).strip()
+        if len(expression) >= 2 and expression[0] == expression[-1] == '"':
+            output.append(json.loads(expression))
+            continue
+        values = resolve_jsonpath(expression, data)
+        output.append(' '.join(format_jsonpath_value(v) for v in values))
+    output.append(template[position:])
+    return ''.join(output)
+
+
+# Supports the plain field, index and [*] forms that verification commands
+# use. Filters, slices, recursion and range blocks go to the real kubectl.
+def resolve_jsonpath(expression, data):
+    if expression.startswith('$'):
+        expression = expression[1:]
+    if not expression:
+        return [data]
+    if not expression.startswith(('.', '[')) or '..' in expression:
+        raise Unsupported()
+    values = [data]
+    position = 0
+    while position < len(expression):
+        match = JSONPATH_FIELD_RE.match(expression, position)
+        if match is None:
+            raise Unsupported()
+        position = match.end()
+        field, index = match.groups()
+        resolved = []
+        for value in values:
+            if field is not None:
+                field = field.replace('\\.', '.')
+                if isinstance(value, dict) and field in value:
+                    resolved.append(value[field])
+            elif index == '*':
+                if isinstance(value, list):
+                    resolved.extend(value)
+                elif isinstance(value, dict):
+                    resolved.extend(value.values())
+            elif isinstance(value, list):
+                i = int(index)
+                if -len(value) <= i < len(value):
+                    resolved.append(value[i])
+        values = resolved
+    return values
+
+
+def format_jsonpath_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return str(value)
+
+
+class KubernetesClient:
+    def __init__(self, pool_size=MAX_WORKERS):
+        self.pool_size = pool_size
+        self.api_client = None
+        self.apis = {}
+        self.default_namespace = 'default'
+        self.cache = None
+        self._available = None
+        self._lock = threading.Lock()
+
+    # Loads the configuration once and keeps one ApiClient, so every read
+    # reuses the same pooled HTTPS connections instead of a new kubectl.
+    def load(self):
+        if self._available is not None:
+            return self._available
+        with self._lock:
+            if self._available is not None:
+                return self._available
+            try:
+                from kubernetes import client, config
+                configuration = client.Configuration()
+                try:
+                    config.load_incluster_config(client_configuration=configuration)
+                    if os.path.exists(SERVICE_ACCOUNT_NAMESPACE):
+                        with open(SERVICE_ACCOUNT_NAMESPACE) as f:
+                            self.default_namespace = f.read().strip() or 'default'
+                except config.ConfigException:
+                    config.load_kube_config(client_configuration=configuration)
+                    _, context = config.list_kube_config_contexts()
+                    self.default_namespace = context.get(
+                        'context', {}).get('namespace') or 'default'
+                configuration.connection_pool_maxsize = self.pool_size
+                self.api_client = client.ApiClient(configuration)
+                self.apis = {'core': client.CoreV1Api(self.api_client),
+                             'apps': client.AppsV1Api(self.api_client)}
+                self._available = True
+                logger.info("Kubernetes API client initialized")
+            except Exception as e:
+                logger.warning("Kubernetes API client unavailable, using kubectl: %s", e)
+                self._available = False
+        return self._available
+
+    # With cached=False the watch cache is skipped; its objects lack
+    # managedFields and the last-applied annotation.
+    def get(self, resource, name=None, namespace=None, all_namespaces=False,
+            selector=None, timeout=None, cached=True):
+        api_name, kind, api_version, _, namespaced = RESOURCES[resource]
+        namespace = namespace or self.default_namespace
+
+        if cached and self.cache is not None and self.cache.synced(resource):
+            cached = self._get_cached(resource, name, namespace if namespaced else None,
+                                      all_namespaces, selector)
+            if cached is not None:
+                return cached
+
+        api = self.apis[api_name]
+        list_all, list_namespaced, read = API_METHODS[resource]
+        kwargs = {'_request_timeout': timeout} if timeout else {}
+
+        if name is not None:
+            args = (name, namespace) if namespaced else (name,)
+            return self._serialize(getattr(api, read)(*args, **kwargs), kind, api_version)
+
+        if selector:
+            kwargs['label_selector'] = selector
+        if not namespaced or all_namespaces:
+            result = getattr(api, list_all)(**kwargs)
+        else:
+            result = getattr(api, list_namespaced)(namespace, **kwargs)
+        items = [self._serialize(item, kind, api_version) for item in result.items]
+        return {'apiVersion': 'v1', 'items': items, 'kind': 'List',
+                'metadata': {'resourceVersion': ''}}
+
+    def _get_cached(self, resource, name, namespace, all_namespaces, selector):
+        from app.services.cluster_cache import UnsupportedSelector
+        if name is not None:
+            obj = self.cache.get(resource, name, namespace)
+            if obj is None:
+                from kubernetes.client.exceptions import ApiException
+                raise ApiException(status=404, reason='Not Found')
+            return obj
+        try:
+            items = self.cache.list(resource, None if all_namespaces else namespace, selector)
+        except UnsupportedSelector:
+            return None
+        return {'apiVersion': 'v1', 'items': items, 'kind': 'List',
+                'metadata': {'resourceVersion': ''}}
+
+    def _serialize(self, obj, kind, api_version):
+        data = self.api_client.sanitize_for_serialization(obj)
+        return {'apiVersion': api_version, 'kind': kind, **data}
+
+    # Returns kubectl-compatible stdout for supported reads, or None when the
+    # command has to go to the kubectl binary. Only `get` with -o json, yaml,
+    # name or a simple jsonpath is served here. `describe`, table output and
+    # everything else stay with the binary, because matching kubectl's
+    # human-readable printers exactly is not worth re-implementing.
+    def execute(self, args, timeout=None):
+        try:
+            request = parse_get(args)
+        except Unsupported:
+            return None
+        output = request['output']
+        if output not in ('json', 'yaml', 'name') and not (
+                output and output.startswith('jsonpath=')):
+            return None
+        if not self.load():
+            return None
+
+        from kubernetes.client.exceptions import ApiException
+        resource = request['resource']
+        # Whole objects, and jsonpaths that may reach the fields the watch
+        # cache trims, are read from the API so they match real kubectl.
+        cached = output == 'name' or (output.startswith('jsonpath=') and not any(
+            field in output for field in ('managedFields', 'annotations', 'last-applied')))
+        try:
+            data = self.get(resource, request['name'], request['namespace'],
+                            request['all_namespaces'], request['selector'], timeout, cached)
+        except ApiException as e:
+            if e.status == 404 and request['name']:
+                raise Exception(
+                    f"Command failed: {' '.join(args)}\nStderr: Error from server (NotFound): "
+                    f"{resource} \"{request['name']}\" not found")
+            logger.warning("Kubernetes API read failed, using kubectl: %s", e.reason)
+            return None
+
+        try:
+            if output == 'json':
+                return json.dumps(data, indent=4) + '\n'
+            if output == 'yaml':
+                import yaml
+                return yaml.safe_dump(data, default_flow_style=False)
+            if output == 'name':
+                prefix = RESOURCES[resource][3]
+                items = data['items'] if request['name'] is None else [data]
+                return ''.join(f"{prefix}/{item['metadata']['name']}\n" for item in items)
+            template = output[len('jsonpath='):]
+            return render_jsonpath(template, data)
+        except Unsupported:
+            return None
 
 
 class Executor:
-    def execute(self, command):
-        logger.info(f"Executing command: {command}")
-        args = command.split()
+    def __init__(self, max_workers=MAX_WORKERS, timeout=COMMAND_TIMEOUT):
+        self.timeout = timeout
+        self.kube_client = KubernetesClient(max_workers) if FAST_PATH_ENABLED else None
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='kubectl')
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def parse(self, command):
+        args = shlex.split(command)
         if not args or args[0] != "kubectl":
-            logger.error(f"Invalid kubectl command: {command}")
+            logger.error("Invalid kubectl command: %s", command)
             raise ValueError(f"Invalid kubectl command: {command}")
+        return args
+
+    # Runs the command on the shared worker pool and returns a Future, so
+    # callers can wait on several commands at once instead of one by one.
+    # shell=True allows pipelines such as 'kubectl get pods | grep Running',
+    # which still have to start with kubectl.
+    def submit(self, command, timeout=None, shell=False):
+        args = self.parse(command)
+        if shell:
+            args = ['/bin/sh', '-c', command]
+        job = Command(command, args,
+                      self.timeout if timeout is None else timeout, shell)
+        future = self.pool.submit(self._run, job)
+        future.job = job
+        return future
+
+    def execute(self, command, timeout=None, shell=False):
+        return self.submit(command, timeout, shell).result()
+
+    def cancel(self, future):
+        if future.cancel():
+            return True
+        job = future.job
+        with self._lock:
+            job.cancelled = True
+            process = job.process
+        if process is not None:
+            self._kill(process)
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._running)
+            for job in jobs:
+                job.cancelled = True
+        for job in jobs:
+            if job.process is not None:
+                self._kill(job.process)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def use_cache(self, cache):
+        if self.kube_client is not None:
+            self.kube_client.cache = cache
+
+    def _run(self, job):
+        QUEUE_SECONDS.observe(time.perf_counter() - job.submitted)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            output = self._execute(job)
+            outcome = 'ok'
+            return output
+        except CommandTimeout:
+            outcome = 'timeout'
+            raise
+        except CommandCancelled:
+            outcome = 'cancelled'
+            raise
+        finally:
+            EXEC_SECONDS.observe(time.perf_counter() - started, path=job.path, outcome=outcome)
+
+    def _execute(self, job):
+        if self.kube_client is not None and not job.shell:
+            output = self.kube_client.execute(job.args, job.timeout)
+            if output is not None:
+                job.path = 'api'
+                logger.info("Command served by API client: %s", job.command)
+                return output
+
+        logger.info("Executing command: %s", job.command)
+        if job.cancelled:
+            raise CommandCancelled(f"Command cancelled: {job.command}")
+        with SPAWN_SECONDS.time():
+            process = subprocess.Popen(
+                job.args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                start_new_session=True
+            )
+        # The lock only publishes the process for cancel(); a cancel that
+        # arrived while it was starting is applied here.
+        with self._lock:
+            job.process = process
+            self._running.add(job)
+            cancelled = job.cancelled
+        if cancelled:
+            self._kill(process)
+        try:
+            stdout, stderr = process.communicate(timeout=job.timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(process)
+            process.communicate()
+            logger.error("Command timed out after %ss: %s", job.timeout, job.command)
+            raise CommandTimeout(
+                f"Command timed out after {job.timeout}s: {job.command}")
+        finally:
+            with self._lock:
+                self._running.discard(job)
+
+        if job.cancelled:
+            logger.warning("Command cancelled: %s", job.command)
+            raise CommandCancelled(f"Command cancelled: {job.command}")
+        if process.returncode != 0:
+            logger.error("Command failed: %s\nStderr: %s", job.command, stderr)
+            raise Exception(
+                f"Command failed: {job.command} exited with status {process.returncode}\nStderr: {stderr}")
+        logger.debug("Command executed successfully: %s", job.command)
+        return stdout
 
+    def _kill(self, process):
         try:
-            result = subprocess.run(
-                args, capture_output=True, text=True, check=True)
-            logger.info(f"Command executed successfully: {command}")
-            return result.stdout
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Command failed: {command}\nStderr: {e.stderr}")
-            raise Exception(f"Command failed: {e}\nStderr: {e.stderr}")
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
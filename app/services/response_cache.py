@@ -0,0 +1,187 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from app.services import db
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+CACHE_ENABLED = os.environ.get('KPA_AI_CACHE', '1') != '0'
+CACHE_TTL = float(os.environ.get('KPA_AI_CACHE_TTL', str(7 * 24 * 3600)))
+CACHE_SIZE = int(os.environ.get('KPA_AI_CACHE_SIZE', '5000'))
+SIMILARITY_THRESHOLD = float(os.environ.get('KPA_AI_CACHE_SIMILARITY', '0.9'))
+PRUNE_INTERVAL = 100
+
+CAMEL_RE = re.compile(r'([a-z0-9])([A-Z])')
+WORD_RE = re.compile(r'[a-z0-9]+')
+STOP_WORDS = {'a', 'an', 'and', 'are', 'can', 'do', 'does', 'explain', 'how', 'i', 'in',
+              'is', 'it', 'me', 'my', 'of', 'please', 'the', 'to', 'what', 'whats', 'why'}
+
+
+def normalize(text):
+    # "PersistentVolumeClaim", "persistent volume claim" and
+    # "Persistent-Volume claim?" all normalize to the same string.
+    text = CAMEL_RE.sub(r'\1 \2', text or '')
+    return ' '.join(WORD_RE.findall(text.lower()))
+
+
+def _stem(word):
+    # Enough to match "claims" with "claim" and "policies" with "policy".
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def vectorize(text):
+    return Counter(_stem(word) for word in normalize(text).split() if word not in STOP_WORDS)
+
+
+def cosine(a, b):
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b[word] for word, count in a.items() if word in b)
+    return dot / (math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values())))
+
+
+# A persistent cache of AI answers for one kind of question. Lookups try
+# the normalized text first and then, when `similar` is set, the closest
+# previously answered question, so rephrasings of a common question cost
+# nothing. Entries are tagged with the model and prompt version that
+# produced them and stop matching when either changes.
+class ResponseCache:
+    def __init__(self, kind, model, version, ttl=CACHE_TTL, max_entries=CACHE_SIZE,
+                 threshold=SIMILARITY_THRESHOLD, similar=True):
+        self.kind = kind
+        self.model = model
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.similar = similar
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        # response id -> question vector, oldest first, plus an inverted
+        # index from word to the ids using it, so a lookup only scores
+        # questions sharing a word with it.
+        self._index = None
+        self._postings = {}
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    def key(self, text):
+        return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+    def get(self, text):
+        if not CACHE_ENABLED:
+            return None
+        now = time.time()
+        cutoff = now - self.ttl
+        row = db.get_cached_response(self.kind, self.key(text), self.model, self.version, cutoff)
+        similar = False
+        if row is None and self.similar:
+            response_id = self._nearest(text)
+            if response_id is not None:
+                row = db.get_cached_response_by_id(response_id, cutoff)
+                similar = row is not None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        db.touch_cached_response(row['id'], now)
+        with self._lock:
+            self.hits += 1
+            self.similar_hits += similar
+        logger.info("AI %s response served from cache%s", self.kind, ' (similar question)' if similar else '')
+        return json.loads(row['response'])
+
+    def set(self, text, response):
+        if not CACHE_ENABLED:
+            return
+        now = time.time()
+        response_id = db.store_cached_response(
+            self.kind, self.key(text), self.model, self.version, text, json.dumps(response), now)
+        if self.similar:
+            self._load_index()
+            with self._lock:
+                self._add(response_id, vectorize(text))
+        with self._lock:
+            self._stores += 1
+            prune = self._stores % PRUNE_INTERVAL == 1
+        if prune:
+            removed = db.prune_cached_responses(self.max_entries, now - self.ttl)
+            with self._lock:
+                for response_id in removed:
+                    self._remove(response_id)
+
+    def _load_index(self):
+        with self._lock:
+            if self._index is not None:
+                return
+        rows = db.list_cached_responses(self.kind, self.model, self.version, time.time() - self.ttl)
+        vectors = [(row['id'], vectorize(row['query'])) for row in rows]
+        with self._lock:
+            if self._index is None:
+                self._index = {}
+                for response_id, vector in sorted(vectors)[-self.max_entries:]:
+                    self._add(response_id, vector)
+
+    def _add(self, response_id, vector):
+        if self._index is None or not vector:
+            return
+        self._remove(response_id)
+        self._index[response_id] = vector
+        for word in vector:
+            self._postings.setdefault(word, set()).add(response_id)
+        while len(self._index) > self.max_entries:
+            self._remove(next(iter(self._index)))
+
+    def _remove(self, response_id):
+        if self._index is None:
+            return
+        vector = self._index.pop(response_id, None)
+        for word in vector or ():
+            ids = self._postings.get(word)
+            if ids is not None:
+                ids.discard(response_id)
+                if not ids:
+                    del self._postings[word]
+
+    def _nearest(self, text):
+        vector = vectorize(text)
+        if not vector:
+            return None
+        self._load_index()
+        with self._lock:
+            candidates = set()
+            for word in vector:
+                candidates.update(self._postings.get(word, ()))
+            entries = [(response_id, self._index[response_id]) for response_id in candidates]
+        best_id, best = None, self.threshold
+        for response_id, candidate in entries:
+            score = cosine(vector, candidate)
+            if score >= best:
+                best_id, best = response_id, score
+        return best_id
+
+    def stats(self):
+        with self._lock:
+            return {
+                'kind': self.kind,
+                'indexed': len(self._index or ()),
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses
+            }
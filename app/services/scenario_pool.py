@@ -0,0 +1,137 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import queue
+import threading
+import time
+from app.services import db
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+POOL_ENABLED = os.environ.get('KPA_SCENARIO_POOL', '1') != '0'
+# Every process keeping a stock spends model calls filling topics x
+# difficulties x size scenarios, so the pool is off until a size is set.
+POOL_SIZE = int(os.environ.get('KPA_SCENARIO_POOL_SIZE', '0'))
+POOL_WORKERS = int(os.environ.get('KPA_SCENARIO_POOL_WORKERS', '2'))
+TOPICS = [t.strip() for t in os.environ.get('KPA_SCENARIO_POOL_TOPICS', 'general').split(',') if t.strip()]
+DIFFICULTIES = [d.strip() for d in os.environ.get(
+    'KPA_SCENARIO_POOL_DIFFICULTIES', 'medium').split(',') if d.strip()]
+DEFAULT_TOPIC = TOPICS[0] if TOPICS else 'general'
+DEFAULT_DIFFICULTY = DIFFICULTIES[0] if DIFFICULTIES else 'medium'
+RETRY_DELAY = 30
+
+
+class UnusableScenario(Exception):
+    pass
+
+
+# Keeps a stock of generated scenarios that passed lint() for every
+# configured topic and difficulty, so a user asking for a scenario gets one from the
+# database straight away while the model call happens in the background.
+class ScenarioPool:
+    def __init__(self, ai_chat, kubectl_executor, size=POOL_SIZE, workers=POOL_WORKERS,
+                 topics=TOPICS, difficulties=DIFFICULTIES):
+        self.ai_chat = ai_chat
+        self.kubectl_executor = kubectl_executor
+        self.size = size
+        self.workers = workers
+        self.buckets = [(t, d) for t in topics for d in difficulties]
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.served = 0
+        self.empty = 0
+
+    def start(self):
+        if self._threads or not POOL_ENABLED or self.size <= 0:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"scenario-pool-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        for bucket in self.buckets:
+            self.refill(*bucket)
+
+    def serves(self, topic, difficulty):
+        return bool(self._threads) and (topic, difficulty) in self.buckets
+
+    # Hands out a pooled scenario and queues a replacement. Returns the
+    # scenario id, or None when the pool is empty.
+    def take(self, topic=DEFAULT_TOPIC, difficulty=DEFAULT_DIFFICULTY):
+        scenario_id = db.claim_pooled_scenario(topic, difficulty)
+        with self._lock:
+            if scenario_id is None:
+                self.empty += 1
+            else:
+                self.served += 1
+        self.refill(topic, difficulty)
+        return scenario_id
+
+    def refill(self, topic, difficulty):
+        with self._lock:
+            if (topic, difficulty) in self._queued:
+                return
+            self._queued.add((topic, difficulty))
+        self._queue.put((topic, difficulty))
+
+    def _work(self):
+        while True:
+            bucket = self._queue.get()
+            try:
+                while db.count_pooled_scenarios().get(bucket, 0) < self.size:
+                    self._generate(*bucket)
+            except Exception as e:
+                logger.error("Error refilling scenario pool %s/%s: %s", bucket[0], bucket[1], e)
+                time.sleep(RETRY_DELAY)
+                with self._lock:
+                    self._queued.discard(bucket)
+                self.refill(*bucket)
+                continue
+            with self._lock:
+                self._queued.discard(bucket)
+
+    def _generate(self, topic, difficulty):
+        logger.info("Generating pooled scenario for %s/%s", topic, difficulty)
+        prompt = f"a {difficulty} difficulty scenario" + (f" about {topic}" if topic != 'general' else '')
+        scenarios = []
+        for scenario in self.ai_chat.generate_scenarios(prompt).scenarios:
+            scenario = scenario.model_dump()
+            try:
+                self.lint(scenario)
+            except UnusableScenario as e:
+                logger.warning("Discarding generated scenario '%s': %s", scenario['title'], e)
+                continue
+            scenarios.append(scenario)
+        if not scenarios:
+            raise UnusableScenario("no usable scenario was generated")
+        db.store_scenarios(scenarios, topic=topic, difficulty=difficulty)
+
+    # A static check only: a scenario needs tasks and verification commands,
+    # and every command must parse as kubectl. Nothing is run against the
+    # cluster, so a command the API server would reject still gets through
+    # and only fails when an environment is set up or the scenario checked.
+    def lint(self, scenario):
+        if not scenario['tasks']:
+            raise UnusableScenario("no tasks")
+        if not scenario['verification_commands']:
+            raise UnusableScenario("no verification commands")
+        for command in scenario['setup_commands'] + scenario['verification_commands']:
+            try:
+                self.kubectl_executor.parse(command)
+            except ValueError as e:
+                raise UnusableScenario(str(e))
+
+    def stats(self):
+        stock = db.count_pooled_scenarios()
+        with self._lock:
+            return {
+                'stock': {f"{t}/{d}": stock.get((t, d), 0) for t, d in self.buckets},
+                'target': self.size,
+                'served': self.served,
+                'empty': self.empty
+            }
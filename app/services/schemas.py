@@ -0,0 +1,35 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# Structured output models for the OpenAI calls. Kept apart from ai.py so
+# pydantic is only imported when a scenario is first generated.
+
+from pydantic import BaseModel
+from typing import List
+
+
+# A dictionary containing 'commands' (list of strings) and 'explanation' (string)"
+class KubernetesScenarioSolution(BaseModel):
+    explanation: str
+    commands: List[str]
+
+
+class KubernetesScenario(BaseModel):
+    title: str
+    description: str
+    setup_commands: List[str]
+    tasks: List[str]
+    hints: List[str]
+    solution: KubernetesScenarioSolution
+    verification_commands: List[str]
+
+
+class ScenarioReflection(BaseModel):
+    perceived_weaknesses: List[str]
+    learning_opportunities: List[str]
+
+
+class ScenarioResponse(BaseModel):
+    scenarios: List[KubernetesScenario]
@@ -0,0 +1,523 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import codecs
+import collections
+import fcntl
+import os
+import re
+import select
+import shutil
+import signal
+import struct
+import subprocess
+import tempfile
+import termios
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Written by the shell as its prompt so the reader can tell where a command's
+# output ends. It is an OSC sequence, so xterm would ignore it if it leaked.
+PROMPT_MARKER = '\x1b]7331;kpa-prompt\x07'
+
+DEFAULT_SHELL = os.environ.get('KPA_SHELL', '/bin/bash')
+SESSION_ROOT = os.environ.get('KPA_SESSION_ROOT', tempfile.gettempdir())
+MAX_SESSIONS = int(os.environ.get('KPA_MAX_SESSIONS', '50'))
+WARM_SESSIONS = int(os.environ.get('KPA_WARM_SESSIONS', '2'))
+SESSION_IDLE_TIMEOUT = float(os.environ.get('KPA_SESSION_IDLE_TIMEOUT', '900'))
+READ_SIZE = 4096
+# Output is sent in frames of at most OUTPUT_CHUNK_SIZE characters. Once
+# OUTPUT_WINDOW characters are unacknowledged by the browser the PTY is not
+# read, so the shell blocks on write. A client that stays behind for
+# OUTPUT_PAUSE_LIMIT seconds gets the PTY drained into a buffer of
+# OUTPUT_BUFFER_SIZE characters that keeps only the newest output.
+OUTPUT_CHUNK_SIZE = int(os.environ.get('KPA_TERMINAL_CHUNK_SIZE', '16384'))
+OUTPUT_WINDOW = int(os.environ.get('KPA_TERMINAL_WINDOW', '262144'))
+OUTPUT_BUFFER_SIZE = int(os.environ.get('KPA_TERMINAL_BUFFER_SIZE', '1048576'))
+OUTPUT_PAUSE_LIMIT = float(os.environ.get('KPA_TERMINAL_PAUSE_LIMIT', '5'))
+# Frames at least this large are deflated when compression is enabled.
+OUTPUT_COMPRESS = os.environ.get('KPA_TERMINAL_COMPRESS', '0') != '0'
+OUTPUT_COMPRESS_MIN = int(os.environ.get('KPA_TERMINAL_COMPRESS_MIN', '4096'))
+TRUNCATED_MARKER = '\r\n\x1b[2m[... {} characters of output truncated ...]\x1b[0m\r\n'
+
+CURRENT_CONTEXT_RE = re.compile(r'^current-context:\s*"?([^"\s]*)"?\s*$', re.MULTILINE)
+# In-cluster there is no kubeconfig file, so sessions get one built from the
+# pod's service account; the token is referenced by path so rotation works.
+SERVICE_ACCOUNT_DIR = os.environ.get('KPA_SERVICE_ACCOUNT_DIR', '/var/run/secrets/kubernetes.io/serviceaccount')
+IN_CLUSTER_KUBECONFIG = """apiVersion: v1
+kind: Config
+clusters:
+- name: in-cluster
+  cluster:
+    server: https://{host}:{port}
+    certificate-authority: {ca}
+users:
+- name: service-account
+  user:
+    tokenFile: {token}
+contexts:
+- name: in-cluster
+  context:
+    cluster: in-cluster
+    user: service-account
+    namespace: {namespace}
+current-context: in-cluster
+"""
+
+
+def _default_kubeconfig():
+    paths = os.environ.get('KUBECONFIG', '').split(os.pathsep)
+    for path in paths + [os.path.expanduser('~/.kube/config')]:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def _in_cluster_kubeconfig():
+    host = os.environ.get('KUBERNETES_SERVICE_HOST')
+    token = os.path.join(SERVICE_ACCOUNT_DIR, 'token')
+    if not host or not os.path.isfile(token):
+        return None
+    try:
+        with open(os.path.join(SERVICE_ACCOUNT_DIR, 'namespace')) as f:
+            namespace = f.read().strip() or 'default'
+    except OSError:
+        namespace = 'default'
+    return IN_CLUSTER_KUBECONFIG.format(
+        host=f"[{host}]" if ':' in host else host, port=os.environ.get('KUBERNETES_SERVICE_PORT', '443'),
+        ca=os.path.join(SERVICE_ACCOUNT_DIR, 'ca.crt'), token=token, namespace=namespace)
+
+
+def _set_controlling_tty():
+    # Runs in the child after setsid() so that ^C on the pty reaches the
+    # foreground job instead of being ignored.
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+class TerminalSession:
+    def __init__(self, shell=DEFAULT_SHELL, env=None, kubeconfig=None):
+        self.shell = shell
+        self.env = env or {}
+        self.kubeconfig = kubeconfig or _default_kubeconfig()
+        self.home = None
+        self.process = None
+        self.fd = None
+        self.last_active = time.monotonic()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+        self._context_cache = (None, None)
+        self.namespace = None
+        self.output = OutputBuffer()
+        # The PTY fd is only closed once nothing is using it, so a reader
+        # blocked in select() never ends up reading a reused fd number.
+        self._fd_users = 0
+        self._closing = False
+        self._fd_lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def cwd(self):
+        if not self.alive:
+            return self.home
+        try:
+            return os.readlink(f"/proc/{self.process.pid}/cwd")
+        except OSError:
+            return self.home
+
+    @property
+    def kube_context(self):
+        path = os.path.join(self.home, '.kube', 'config') if self.home else None
+        try:
+            mtime = os.stat(path).st_mtime
+        except (OSError, TypeError):
+            return None
+        if self._context_cache[0] != mtime:
+            with open(path) as f:
+                match = CURRENT_CONTEXT_RE.search(f.read())
+            self._context_cache = (mtime, match.group(1) if match else None)
+        return self._context_cache[1]
+
+    def state(self):
+        cwd = self.cwd
+        if cwd and self.home and (cwd == self.home or cwd.startswith(self.home + os.sep)):
+            cwd = '~' + cwd[len(self.home):]
+        return {'cwd': cwd, 'context': self.kube_context, 'namespace': self.namespace}
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    # Makes `namespace` the default for kubectl in this session only, by
+    # editing the session's private kubeconfig. Returns False when the
+    # session has no kubeconfig or kubectl refused the change.
+    def set_namespace(self, namespace):
+        config = os.path.join(self.home, '.kube', 'config') if self.home else None
+        if config is None or not os.path.isfile(config):
+            return False
+        result = subprocess.run(
+            ['kubectl', 'config', 'set-context', '--current', f'--namespace={namespace}'],
+            env=dict(os.environ, KUBECONFIG=config), capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error("Could not switch session to namespace %s: %s", namespace, result.stderr)
+            return False
+        self.namespace = namespace
+        return True
+
+    # Each session gets a private HOME holding its own copy of the kubeconfig,
+    # so cd, exported variables and 'kubectl config use-context' only affect
+    # the client that ran them.
+    def _prepare_home(self):
+        self.home = tempfile.mkdtemp(prefix='kpa-session-', dir=SESSION_ROOT)
+        kube_dir = os.path.join(self.home, '.kube')
+        os.makedirs(kube_dir)
+        config = os.path.join(kube_dir, 'config')
+        if self.kubeconfig:
+            shutil.copyfile(self.kubeconfig, config)
+        else:
+            in_cluster = _in_cluster_kubeconfig()
+            if in_cluster is None:
+                return
+            with open(config, 'w') as f:
+                f.write(in_cluster)
+        os.chmod(config, 0o600)
+
+    def start(self, cols=80, rows=24):
+        self._prepare_home()
+        master, slave = os.openpty()
+
+        # The browser terminal does its own line editing and echo.
+        attrs = termios.tcgetattr(slave)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+
+        env = dict(os.environ)
+        env.update(self.env)
+        env.update({
+            'HOME': self.home,
+            'KUBECONFIG': os.path.join(self.home, '.kube', 'config'),
+            'PS1': PROMPT_MARKER,
+            'PS2': '',
+            'TERM': 'xterm-256color'
+        })
+
+        self.process = subprocess.Popen(
+            [self.shell, '--noprofile', '--norc', '--noediting', '-i'],
+            stdin=slave,
+            stdout=slave,
+            stderr=slave,
+            cwd=self.home,
+            env=env,
+            start_new_session=True,
+            preexec_fn=_set_controlling_tty,
+            close_fds=True
+        )
+        os.close(slave)
+        self.fd = master
+        self.resize(cols, rows)
+        logger.info("Terminal session started with pid %s", self.process.pid)
+
+    @contextmanager
+    def _borrow_fd(self):
+        with self._fd_lock:
+            fd = None if self._closing else self.fd
+            if fd is not None:
+                self._fd_users += 1
+        try:
+            yield fd
+        finally:
+            if fd is not None:
+                with self._fd_lock:
+                    self._fd_users -= 1
+                    if self._closing and not self._fd_users:
+                        self._close_fd()
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def write(self, data):
+        with self._borrow_fd() as fd:
+            if fd is None or not self.alive:
+                raise RuntimeError("Terminal session is not running")
+            os.write(fd, data.encode())
+
+    def send_line(self, line):
+        self.write(line + '\n')
+
+    def interrupt(self):
+        with self._borrow_fd() as fd:
+            if fd is not None and self.alive:
+                os.write(fd, b'\x03')
+
+    def resize(self, cols, rows):
+        winsize = struct.pack('HHHH', int(rows), int(cols), 0, 0)
+        with self._borrow_fd() as fd:
+            if fd is not None:
+                fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
+
+    # Returns a list of (kind, text) events where kind is 'text' or 'prompt',
+    # or None once the shell has exited and its output is drained. Waits up
+    # to `timeout` for output, then takes whatever else is already waiting,
+    # up to about max_bytes, so bursts are read as one batch. Output counts
+    # as activity, so a long-running watch is not evicted as idle.
+    def read(self, timeout=0.1, max_bytes=OUTPUT_CHUNK_SIZE):
+        data = b''
+        with self._borrow_fd() as fd:
+            if fd is None:
+                return None
+            try:
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if not ready:
+                    return [] if self.alive else None
+                while True:
+                    chunk = os.read(fd, READ_SIZE)
+                    data += chunk
+                    if not chunk or len(data) >= max_bytes or not select.select([fd], [], [], 0)[0]:
+                        break
+            except OSError:
+                # EIO once the shell has exited and the PTY is drained.
+                pass
+        if not data:
+            return None
+        self.touch()
+        return self._split(self._decoder.decode(data))
+
+    def _split(self, text):
+        events = []
+        text = self._pending + text
+        self._pending = ''
+        while True:
+            index = text.find(PROMPT_MARKER)
+            if index < 0:
+                break
+            if index:
+                events.append(('text', text[:index]))
+            events.append(('prompt', ''))
+            text = text[index + len(PROMPT_MARKER):]
+
+        # Hold back a possible partial marker until the next read.
+        keep = 0
+        for size in range(min(len(text), len(PROMPT_MARKER) - 1), 0, -1):
+            if PROMPT_MARKER.startswith(text[-size:]):
+                keep = size
+                break
+        if keep:
+            self._pending = text[-keep:]
+            text = text[:-keep]
+        if text:
+            events.append(('text', text))
+        return events
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGHUP)
+                self.process.wait(timeout=1)
+            except (ProcessLookupError, subprocess.TimeoutExpired):
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.process.wait()
+        with self._fd_lock:
+            self._closing = True
+            if not self._fd_users:
+                self._close_fd()
+        if self.home:
+            shutil.rmtree(self.home, ignore_errors=True)
+        logger.info("Terminal session closed")
+
+
+# The terminal output waiting to be sent to one browser, and how much of
+# what was sent it has not acknowledged yet. Waiting output is capped at
+# `capacity` characters by discarding the oldest text, which is reported
+# with a marker in its place.
+class OutputBuffer:
+    def __init__(self, window=OUTPUT_WINDOW, capacity=OUTPUT_BUFFER_SIZE, chunk_size=OUTPUT_CHUNK_SIZE):
+        self.window = window
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.events = collections.deque()
+        self.size = 0
+        self.unacked = 0
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    @property
+    def blocked(self):
+        return self.unacked >= self.window
+
+    def add(self, events):
+        with self._lock:
+            for kind, text in events:
+                if kind == 'text' and self.events and self.events[-1][0] == 'text':
+                    self.events[-1] = ('text', self.events[-1][1] + text)
+                else:
+                    self.events.append((kind, text))
+                self.size += len(text)
+            self._trim()
+
+    def _trim(self):
+        while self.size > self.capacity:
+            index = next(i for i, (kind, _) in enumerate(self.events) if kind == 'text')
+            text = self.events[index][1]
+            excess = min(len(text), self.size - self.capacity)
+            if excess == len(text):
+                del self.events[index]
+            else:
+                self.events[index] = ('text', text[excess:])
+            self.size -= excess
+            self.truncated += excess
+
+    def ack(self, size):
+        with self._lock:
+            self.unacked = max(0, self.unacked - size)
+
+    # Takes the frames that fit in the client's window, each a (kind, text)
+    # pair with text of at most chunk_size characters.
+    def frames(self):
+        frames = []
+        with self._lock:
+            if self.truncated:
+                marker = TRUNCATED_MARKER.format(self.truncated)
+                frames.append(('text', marker))
+                self.unacked += len(marker)
+                self.truncated = 0
+            while self.events and self.unacked < self.window:
+                kind, text = self.events.popleft()
+                if len(text) > self.chunk_size:
+                    self.events.appendleft((kind, text[self.chunk_size:]))
+                    text = text[:self.chunk_size]
+                self.size -= len(text)
+                self.unacked += len(text)
+                frames.append((kind, text))
+        return frames
+
+
+# Builds the socket.io payload for a text frame. `size` is echoed back by the
+# browser in its ack once the text has been written to the terminal.
+def text_frame(text):
+    if OUTPUT_COMPRESS and len(text) >= OUTPUT_COMPRESS_MIN:
+        return {'type': 'text', 'encoding': 'deflate', 'data': zlib.compress(text.encode()), 'size': len(text)}
+    return {'type': 'text', 'content': text, 'size': len(text)}
+
+
+class SessionManager:
+    def __init__(self, max_sessions=MAX_SESSIONS, warm_sessions=WARM_SESSIONS,
+                 idle_timeout=SESSION_IDLE_TIMEOUT, session_factory=TerminalSession):
+        self.max_sessions = max_sessions
+        self.warm_sessions = warm_sessions
+        self.idle_timeout = idle_timeout
+        self.session_factory = session_factory
+        self.sessions = {}
+        self.pool = []
+        self._warming = 0
+        self._lock = threading.Lock()
+        self._reserved = threading.Condition(self._lock)
+
+    def get(self, sid):
+        with self._lock:
+            return self.sessions.get(sid)
+
+    def acquire(self, sid):
+        with self._lock:
+            # Another call for this client is starting its shell.
+            while sid in self.sessions and self.sessions[sid] is None:
+                self._reserved.wait()
+            session = self.sessions.get(sid)
+            if session is not None and session.alive:
+                return session, False
+            if session is not None:
+                del self.sessions[sid]
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError(
+                    "Too many active terminal sessions, please try again later")
+            session = None
+            while self.pool and session is None:
+                candidate = self.pool.pop()
+                if candidate.alive:
+                    session = candidate
+                else:
+                    candidate.close()
+            # Reserve the slot before releasing the lock to start a shell.
+            self.sessions[sid] = session
+        if session is None:
+            try:
+                session = self._spawn()
+            except Exception:
+                with self._lock:
+                    self.sessions.pop(sid, None)
+                    self._reserved.notify_all()
+                raise
+            with self._lock:
+                released = sid not in self.sessions
+                if not released:
+                    self.sessions[sid] = session
+                self._reserved.notify_all()
+            if released:
+                # The client disconnected while its shell was starting.
+                session.close()
+                raise RuntimeError("Terminal session was closed while starting")
+        session.touch()
+        return session, True
+
+    def release(self, sid):
+        with self._lock:
+            session = self.sessions.pop(sid, None)
+            self._reserved.notify_all()
+        if session is not None:
+            session.close()
+
+    def fill_pool(self):
+        while True:
+            with self._lock:
+                warm = len(self.pool) + self._warming
+                if warm >= self.warm_sessions or len(self.sessions) + warm >= self.max_sessions:
+                    return
+                self._warming += 1
+            try:
+                session = self._spawn()
+            finally:
+                with self._lock:
+                    self._warming -= 1
+            with self._lock:
+                self.pool.append(session)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [sid for sid, session in self.sessions.items()
+                    if session is not None and session.last_active < deadline]
+            evicted = [(sid, self.sessions.pop(sid)) for sid in idle]
+        for sid, session in evicted:
+            logger.info("Evicting idle terminal session for client %s", sid)
+            session.close()
+        return [sid for sid, _ in evicted]
+
+    def close_all(self):
+        with self._lock:
+            sessions = [s for s in self.sessions.values() if s is not None] + self.pool
+            self.sessions = {}
+            self.pool = []
+            self._reserved.notify_all()
+        for session in sessions:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {'active': len(self.sessions), 'warm': len(self.pool)}
+
+    def _spawn(self):
+        session = self.session_factory()
+        session.start()
+        return session
@@ -0,0 +1,198 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import copy
+import os
+import re
+import shlex
+import time
+from concurrent.futures import FIRST_EXCEPTION, ALL_COMPLETED, wait
+from app.services.environments import scope_command
+from app.services.kubectl import CommandCancelled, CommandTimeout, RESOURCES, RESOURCE_ALIASES
+from app.utils.cache import LRUCache
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+COMMAND_TIMEOUT = float(os.environ.get('KPA_VALIDATION_COMMAND_TIMEOUT', '15'))
+VALIDATION_DEADLINE = float(os.environ.get('KPA_VALIDATION_DEADLINE', '45'))
+RESULT_CACHE_SIZE = int(os.environ.get('KPA_VALIDATION_CACHE_SIZE', '256'))
+RESULT_CACHE_TTL = float(os.environ.get('KPA_VALIDATION_CACHE_TTL', '300'))
+MAX_OUTPUT = 2000
+
+SHELL_SYNTAX_RE = re.compile(r'[|&;<>`$]')
+UNCACHEABLE_SHELL_RE = re.compile(r'[;&`<>]|\$\(')
+VALUE_FLAGS = {'-n', '--namespace', '-l', '--selector', '-o', '--output',
+               '--field-selector', '--sort-by', '-L', '--label-columns'}
+
+
+class Validator:
+    def __init__(self, kubectl_executor, cluster_cache=None, command_timeout=COMMAND_TIMEOUT,
+                 deadline=VALIDATION_DEADLINE):
+        self.kubectl_executor = kubectl_executor
+        self.cluster_cache = cluster_cache
+        self.command_timeout = command_timeout
+        self.deadline = deadline
+        self.results = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+    # With a namespace, checks that do not name one of their own run against
+    # that scenario environment rather than the default namespace.
+    def validate(self, scenario, fail_fast=False, namespace=None):
+        if namespace:
+            scenario = dict(scenario, verification_commands=[
+                scope_command(c, namespace) for c in scenario.get('verification_commands') or []])
+        key = self._cache_key(scenario, fail_fast)
+        if key is not None:
+            cached = self.results.get(key)
+            if cached is not None:
+                logger.info("Validation result served from cache for scenario %s", scenario.get('id'))
+                return dict(copy.deepcopy(cached), cached=True)
+
+        summary = self._validate(scenario, fail_fast)
+        if key is not None and not any(r['status'] in ('timeout', 'error') for r in summary['results']):
+            self.results.set(key, copy.deepcopy(summary))
+        return summary
+
+    # A verification result can only be reused while nothing it looked at has
+    # changed. That is known when every check is a plain 'kubectl get' of a
+    # resource the watch cache is keeping in sync, so the key is built from
+    # the generations of the namespaces those checks read. Anything else is
+    # not cached.
+    def _cache_key(self, scenario, fail_fast):
+        commands = scenario.get('verification_commands') or []
+        if self.cluster_cache is None or scenario.get('id') is None or not commands:
+            return None
+        scopes = set()
+        for command in commands:
+            scope = self._watch_scope(command)
+            if scope is None:
+                return None
+            scopes.add(scope)
+        return (scenario['id'], fail_fast, tuple(sorted(scopes)))
+
+    def _watch_scope(self, command):
+        if UNCACHEABLE_SHELL_RE.search(command):
+            return None
+        stages = command.split('|')
+        if any(stage.strip().startswith('kubectl') for stage in stages[1:]):
+            return None
+        try:
+            args = shlex.split(stages[0])
+        except ValueError:
+            return None
+        if len(args) < 3 or args[0] != 'kubectl' or args[1] != 'get':
+            return None
+
+        namespace, all_namespaces, targets = None, False, []
+        rest = iter(args[2:])
+        for arg in rest:
+            if arg in ('-A', '--all-namespaces'):
+                all_namespaces = True
+            elif arg in ('-n', '--namespace'):
+                namespace = next(rest, None)
+            elif arg.startswith('--namespace='):
+                namespace = arg.split('=', 1)[1]
+            elif arg in VALUE_FLAGS:
+                next(rest, None)
+            elif not arg.startswith('-'):
+                targets.append(arg)
+        if not targets or ',' in targets[0]:
+            return None
+        resource = RESOURCE_ALIASES.get(targets[0].split('/')[0].lower())
+        if resource is None or not self.cluster_cache.synced(resource):
+            return None
+
+        if all_namespaces or not RESOURCES[resource][4]:
+            return ('*', self.cluster_cache.generation)
+        kube_client = self.kubectl_executor.kube_client
+        namespace = namespace or (kube_client.default_namespace if kube_client else 'default')
+        return (namespace, self.cluster_cache.namespace_generation(namespace))
+
+    # Runs every verification command concurrently and reports each one.
+    # With fail_fast the remaining commands are cancelled on the first
+    # failure; commands still running at the deadline are cancelled too.
+    def _validate(self, scenario, fail_fast):
+        commands = scenario.get('verification_commands') or []
+        tasks = scenario.get('tasks') or []
+        started = time.monotonic()
+        # Checks only map onto tasks when the scenario has one per task.
+        if len(tasks) != len(commands):
+            tasks = [None] * len(commands)
+        results = [self._result(command, task) for command, task in zip(commands, tasks)]
+
+        futures = {}
+        for i, command in enumerate(commands):
+            try:
+                future = self.kubectl_executor.submit(
+                    command, self.command_timeout,
+                    shell=bool(SHELL_SYNTAX_RE.search(command)))
+            except ValueError as e:
+                results[i].update(status='error', error=str(e))
+                if fail_fast:
+                    break
+                continue
+            future.started = time.monotonic()
+            futures[future] = i
+
+        pending = set(futures)
+        failed = any(r['status'] == 'error' for r in results) and fail_fast
+        while pending and not failed:
+            remaining = self.deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining,
+                                 return_when=FIRST_EXCEPTION if fail_fast else ALL_COMPLETED)
+            for future in done:
+                result = results[futures[future]]
+                self._record(result, future)
+                if result['status'] != 'passed':
+                    failed = fail_fast
+            if not done:
+                break
+
+        for future in pending:
+            self.kubectl_executor.cancel(future)
+            result = results[futures[future]]
+            result['status'] = 'skipped' if failed else 'timeout'
+            result['error'] = ('Skipped after an earlier check failed' if failed
+                               else f"Validation deadline of {self.deadline}s exceeded")
+        for result in results:
+            if result['status'] == 'pending':
+                result.update(status='skipped', error='Skipped after an earlier check failed')
+
+        passed = sum(1 for r in results if r['status'] == 'passed')
+        summary = {
+            'passed': bool(results) and passed == len(results),
+            'passed_count': passed,
+            'total': len(results),
+            'duration': round(time.monotonic() - started, 3),
+            'results': results,
+            'message': (f"{passed}/{len(results)} checks passed" if results
+                        else "This scenario has no verification commands")
+        }
+        logger.info("Validation finished: %s in %ss", summary['message'], summary['duration'])
+        return summary
+
+    def _result(self, command, task):
+        return {
+            'command': command,
+            'task': task,
+            'status': 'pending',
+            'output': '',
+            'error': None,
+            'duration': None
+        }
+
+    def _record(self, result, future):
+        result['duration'] = round(time.monotonic() - future.started, 3)
+        try:
+            result['output'] = future.result()[:MAX_OUTPUT]
+            result['status'] = 'passed'
+        except CommandTimeout as e:
+            result.update(status='timeout', error=str(e))
+        except CommandCancelled as e:
+            result.update(status='skipped', error=str(e))
+        except Exception as e:
+            result.update(status='failed', error=str(e)[:MAX_OUTPUT])
@@ -3,26 +3,111 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import atexit
+import copy
 import logging
+import os
+import queue
 import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from app.utils.metrics import counter
 
+LOG_LEVEL = os.environ.get('KPA_LOG_LEVEL', 'INFO').upper()
+# Per-module overrides, e.g. KPA_LOG_LEVELS="kubectl=DEBUG,db=WARNING".
+MODULE_LEVELS = dict(
+    (name.strip(), level.strip().upper()) for name, _, level in
+    (item.partition('=') for item in os.environ.get('KPA_LOG_LEVELS', '').split(',')) if level.strip())
+LOG_FILE = os.environ.get('KPA_LOG_FILE', 'kpa.log')
+LOG_MAX_BYTES = int(os.environ.get('KPA_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get('KPA_LOG_BACKUPS', '5'))
+# INFO lines allowed per second from any one logging call; the rest are
+# dropped and counted. 0 disables sampling.
+INFO_RATE = float(os.environ.get('KPA_LOG_INFO_RATE', '20'))
 
+SUPPRESSED = counter('kpa_log_lines_suppressed_total', 'INFO log lines dropped by rate limiting', ['logger'])
+
+
+# Rate-limits INFO records per call site with a token bucket, so lines
+# logged on every request or command cannot flood the log under load.
+# Warnings and errors always pass.
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=INFO_RATE, burst=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._buckets = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.INFO or self.rate <= 0:
+            return True
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                SUPPRESSED.inc(logger=record.name)
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar lines suppressed)"
+            record.args = ()
+        return True
+
+
+# QueueHandler formats each record before queueing it; this one only merges
+# the args into the message (they may be mutable objects) and leaves the
+# formatting, tracebacks included, to the listener thread.
+class RawQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# Records are queued on the calling thread and formatted and written by a
+# listener thread, so request handlers never wait on stdout or the disk.
 def setup_logger():
     logger = logging.getLogger('KPA')
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
 
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
-    file_handler = logging.FileHandler('kpa.log')
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = RawQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for name, level in MODULE_LEVELS.items():
+        logging.getLogger(f'KPA.{name}').setLevel(level)
 
     return logger
 
 
+# Module loggers are children of KPA named after the module, so
+# get_logger('app.services.db') is 'KPA.db' and follows KPA_LOG_LEVELS['db'].
+def get_logger(name):
+    return logger.getChild(name.rsplit('.', 1)[-1])
+
+
 logger = setup_logger()
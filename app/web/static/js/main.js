@@ -14,8 +14,12 @@ document.addEventListener("DOMContentLoaded", async () => {
   const sendButton = document.getElementById("send-button");
 
   let currentScenarioId = null;
+  let currentNamespace = null;
   let term = null;
   let socket = null;
+  let promptState = { cwd: "~", context: null };
+  let chatRequestId = 0;
+  const pendingChats = {};
 
   function initializeTerminal() {
     const terminalElement = document.getElementById("terminal");
@@ -56,36 +60,60 @@ document.addEventListener("DOMContentLoaded", async () => {
       const rows = Math.floor(terminalElement.clientHeight / CHAR_HEIGHT);
 
       term.resize(cols, rows);
+      sendResize();
     }
 
-    fitTerminal();
-    window.addEventListener("resize", fitTerminal);
+    function sendResize() {
+      if (socket && socket.connected) {
+        socket.emit("resize", { cols: term.cols, rows: term.rows });
+      }
+    }
 
     socket = io();
 
+    fitTerminal();
+    window.addEventListener("resize", fitTerminal);
+
     socket.on("connect", () => {
       term.write(
         "\r\n\x1b[1;32m➜ \x1b[1;36mKubernetes Practice Assistant\x1b[0m\r\n"
       );
-      writePrompt();
+      sendResize();
+      requestEnvironment();
     });
 
-    socket.on("output", (data) => {
-      // Improve output formatting
-      const formattedOutput = formatOutput(data);
-      term.write(formattedOutput);
-      writePrompt();
+    socket.on("environment", (data) => {
+      if (data.error) {
+        term.write(`\r\n\x1b[1;31m${data.error}\x1b[0m\r\n`);
+        return;
+      }
+      currentNamespace = data.namespace;
+      if (currentNamespace) {
+        term.write(
+          `\r\n\x1b[1;33mScenario environment ready in namespace ${currentNamespace}\x1b[0m\r\n`
+        );
+      }
     });
 
-    // Update the socket.on('output') handler
+    // Frames are written in order, and text frames are acknowledged once
+    // xterm has rendered them so the server can send more.
+    let outputQueue = Promise.resolve();
     socket.on("output", (data) => {
-      const formattedOutput = formatOutput(data);
-      term.write(formattedOutput);
-      writePrompt();
+      outputQueue = outputQueue
+        .then(() => decodeOutput(data))
+        .then((frame) => {
+          const formattedOutput = formatOutput(frame);
+          if (formattedOutput === null) {
+            writePrompt();
+          } else if (frame.size) {
+            term.write(formattedOutput, () => socket.emit("ack", { size: frame.size }));
+          } else {
+            term.write(formattedOutput);
+          }
+        })
+        .catch((error) => console.error("Error writing output:", error));
     });
 
-
-
     let currentLine = "";
     let commandHistory = [];
     let historyIndex = -1;
@@ -93,12 +121,18 @@ document.addEventListener("DOMContentLoaded", async () => {
     term.onKey(({ key, domEvent }) => {
       const printable = !domEvent.altKey && !domEvent.ctrlKey && !domEvent.metaKey;
 
-      if (domEvent.keyCode === 13) { // Enter key
+      if (domEvent.ctrlKey && domEvent.keyCode === 67) { // Ctrl+C
+        term.write("^C\r\n");
+        currentLine = "";
+        socket.emit("interrupt");
+      } else if (domEvent.keyCode === 13) { // Enter key
         term.write("\r\n");
         if (currentLine.trim()) {
           processCommand(currentLine);
           commandHistory.push(currentLine);
           historyIndex = commandHistory.length;
+        } else {
+          writePrompt();
         }
         currentLine = "";
       } else if (domEvent.keyCode === 8) { // Backspace
@@ -131,6 +165,7 @@ document.addEventListener("DOMContentLoaded", async () => {
     function processCommand(command) {
       if (command.trim() === 'clear') {
         term.clear();
+        writePrompt();
       } else if (command.startsWith('k ') || command.startsWith('kubectl ')) {
         // Handle kubectl commands
         const kubectlCommand = command.replace(/^k /, 'kubectl ');
@@ -140,21 +175,16 @@ document.addEventListener("DOMContentLoaded", async () => {
       }
     }
 
-    socket.on("output", (data) => {
-      const formattedOutput = formatOutput(data);
-      term.writeln(formattedOutput);
-      writePrompt();
-    });
-
     function writePrompt() {
       term.write(getPrompt());
     }
 
     function getPrompt() {
-      return "\r\n\x1B[1;32m➜\x1B[0m \x1B[1;34m~/kubernetes\x1B[0m \x1B[1;36m(main)\x1B[0m $ ";
+      const context = promptState.context
+        ? ` \x1B[1;36m(${promptState.context})\x1B[0m`
+        : "";
+      return `\x1B[1;32m➜\x1B[0m \x1B[1;34m${promptState.cwd}\x1B[0m${context} $ `;
     }
-
-    writePrompt();
   }
 
   // function writePrompt() {
@@ -167,6 +197,13 @@ document.addEventListener("DOMContentLoaded", async () => {
   //   );
   // }
   //
+  // Asks the server for a namespace with this scenario already set up in it.
+  function requestEnvironment() {
+    if (socket && socket.connected && currentScenarioId !== null) {
+      socket.emit("scenario", { id: currentScenarioId });
+    }
+  }
+
   function loadScenario() {
     const urlParams = new URLSearchParams(window.location.search);
     const scenarioId = urlParams.get("id");
@@ -182,6 +219,7 @@ document.addEventListener("DOMContentLoaded", async () => {
         .then((scenario) => {
           console.log("Scenario loaded:", scenario);
           currentScenarioId = scenario.id;
+          requestEnvironment();
           scenarioTitle.textContent = scenario.title;
           scenarioDescription.textContent = scenario.description;
           taskList.innerHTML = scenario.tasks
@@ -205,9 +243,21 @@ document.addEventListener("DOMContentLoaded", async () => {
   }
 
 
+  // Large frames may arrive deflated; inflate them into ordinary text frames.
+  async function decodeOutput(frame) {
+    if (frame && frame.encoding === "deflate") {
+      const stream = new Blob([frame.data])
+        .stream()
+        .pipeThrough(new DecompressionStream("deflate"));
+      const content = await new Response(stream).text();
+      return { type: frame.type, content, size: frame.size };
+    }
+    return frame;
+  }
+
   function formatOutput(outputData) {
     try {
-      const data = JSON.parse(outputData);
+      const data = typeof outputData === "string" ? JSON.parse(outputData) : outputData;
       switch (data.type) {
         case "ls":
           return formatLsOutput(data.content);
@@ -215,8 +265,14 @@ document.addEventListener("DOMContentLoaded", async () => {
           return `\x1B[1;31m${data.content}\x1B[0m`;
         case "text":
           return data.content;
+        case "prompt":
+          promptState = {
+            cwd: data.cwd || promptState.cwd,
+            context: data.context || null,
+          };
+          return null;
         default:
-          return outputData;
+          return typeof outputData === "string" ? outputData : "";
       }
     } catch (e) {
       console.error("Error parsing output:", e);
@@ -250,11 +306,42 @@ document.addEventListener("DOMContentLoaded", async () => {
     messageElement.textContent = content;
     chatMessages.appendChild(messageElement);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return messageElement;
+  }
+
+  function initializeChatStream() {
+    socket.on("chat_token", ({ id, delta }) => {
+      const element = pendingChats[id];
+      if (element) {
+        element.textContent += delta;
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+      }
+    });
+
+    socket.on("chat_done", ({ id }) => {
+      delete pendingChats[id];
+    });
+
+    socket.on("chat_error", ({ id }) => {
+      const element = pendingChats[id];
+      if (element) {
+        element.textContent =
+          "Sorry, there was an error processing your message. Please try again.";
+        delete pendingChats[id];
+      }
+    });
   }
 
   function sendMessage() {
     const message = userInput.value.trim();
-    if (message) {
+    if (message && socket && socket.connected) {
+      addMessage("user", message);
+      userInput.value = "";
+
+      const id = ++chatRequestId;
+      pendingChats[id] = addMessage("ai", "");
+      socket.emit("chat", { id, message, scenarioId: currentScenarioId });
+    } else if (message) {
       addMessage("user", message);
       userInput.value = "";
 
@@ -285,7 +372,11 @@ document.addEventListener("DOMContentLoaded", async () => {
   }
 
   checkButton.addEventListener("click", () => {
-    fetch(`/api/scenarios/${currentScenarioId}/validate`, { method: "POST" })
+    fetch(`/api/scenarios/${currentScenarioId}/validate`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ namespace: currentNamespace }),
+    })
       .then((response) => {
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
@@ -293,7 +384,13 @@ document.addEventListener("DOMContentLoaded", async () => {
         return response.json();
       })
       .then((data) => {
-        checkOutput.textContent = data.message;
+        const lines = (data.results || []).map((result) => {
+          const mark = result.status === "passed" ? "\u2714" : "\u2718";
+          const label = result.task || result.command;
+          const detail = result.status === "passed" ? "" : ` (${result.status})`;
+          return `${mark} ${label}${detail}`;
+        });
+        checkOutput.textContent = [data.message, ...lines].join("\n");
       })
       .catch((error) => {
         console.error("Error validating scenario:", error);
@@ -313,6 +410,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 
   loadScenario();
   initializeTerminal();
+  initializeChatStream();
 });
 
 console.log("main.js loaded");
@@ -8,8 +8,13 @@ document.addEventListener("DOMContentLoaded", () => {
   const generateButton = document.getElementById("generate-scenarios");
   const feelingLuckyButton = document.getElementById("feeling-lucky");
   const scenarioList = document.getElementById("scenario-list");
+  const scenarioCount = document.getElementById("scenario-count");
+  const PAGE_SIZE = 20;
 
-  function displayScenarios(scenarios) {
+  let loadedScenarios = [];
+  let nextCursor = null;
+
+  function displayScenarios(scenarios, hasMore = false) {
     scenarioList.innerHTML = scenarios
       .map(
         (scenario, index) => `
@@ -40,7 +45,16 @@ document.addEventListener("DOMContentLoaded", () => {
         </div>
       `
       )
-      .join("");
+      .join("") +
+      (hasMore ? `<button id="load-more-scenarios">Load More</button>` : "");
+
+    const loadMoreButton = document.getElementById("load-more-scenarios");
+    if (loadMoreButton) {
+      loadMoreButton.addEventListener("click", () => {
+        loadMoreButton.disabled = true;
+        fetchExistingScenarios(nextCursor);
+      });
+    }
 
     // Add event listeners for expand buttons
     document.querySelectorAll(".expand-btn").forEach((btn) => {
@@ -88,16 +102,23 @@ document.addEventListener("DOMContentLoaded", () => {
     });
   }
 
-  function fetchExistingScenarios() {
-    fetch("/api/scenarios")
+  function fetchExistingScenarios(cursor = null) {
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (cursor !== null) {
+      params.set("cursor", cursor);
+    }
+    fetch(`/api/scenarios?${params}`)
       .then((response) => {
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
         return response.json();
       })
-      .then((scenarios) => {
-        displayScenarios(scenarios);
+      .then((page) => {
+        loadedScenarios =
+          cursor === null ? page.scenarios : loadedScenarios.concat(page.scenarios);
+        nextCursor = page.next_cursor;
+        displayScenarios(loadedScenarios, nextCursor !== null);
       })
       .catch((error) => {
         console.error("Error fetching existing scenarios:", error);
@@ -106,22 +127,48 @@ document.addEventListener("DOMContentLoaded", () => {
       });
   }
 
+  // Generated scenarios arrive as NDJSON, one line per scenario, and are
+  // shown as each one finishes.
   function generateScenarios(prompt = "") {
+    const count = parseInt(scenarioCount.value, 10) || 1;
+    const generated = [];
+    scenarioList.innerHTML = "<p>Generating scenarios...</p>";
     fetch("/api/generate-scenarios", {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
+        Accept: "application/x-ndjson",
       },
-      body: JSON.stringify({ prompt }),
+      body: JSON.stringify({ prompt, count }),
     })
-      .then((response) => {
+      .then(async (response) => {
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
-        return response.json();
-      })
-      .then((scenarios) => {
-        displayScenarios(scenarios);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+          const { done, value } = await reader.read();
+          buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+          const lines = buffer.split("\n");
+          buffer = lines.pop();
+          for (const line of lines.filter((l) => l.trim())) {
+            const item = JSON.parse(line);
+            if (item.error) {
+              console.error("Error generating scenario:", item.error);
+              continue;
+            }
+            generated.push(item);
+            displayScenarios(generated);
+          }
+          if (done) {
+            break;
+          }
+        }
+        if (!generated.length) {
+          throw new Error("No scenarios were generated");
+        }
       })
       .catch((error) => {
         console.error("Error generating scenarios:", error);
@@ -3,90 +3,243 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-import subprocess
-import json
 import os
+import threading
+import time
+from flask import request
 from flask_socketio import SocketIO, emit
-from app.utils.logger import logger
+from app.services.ai import AIUnavailable
+from app.services.terminal import OUTPUT_PAUSE_LIMIT, SessionManager, text_frame
+from app.utils.logger import get_logger
+from app.utils.metrics import gauge
+
+logger = get_logger(__name__)
 
 socketio = SocketIO()
 
+session_manager = SessionManager()
+
+chat_handler = None
+environments = None
+chat_streams = {}
+chat_streams_lock = threading.Lock()
+
+EVICTION_INTERVAL = 60
+# With several server processes or replicas, emits from one reach clients
+# connected to another through this queue, e.g. redis://redis:6379/0.
+MESSAGE_QUEUE = os.environ.get('KPA_SOCKETIO_MESSAGE_QUEUE') or None
+
+gauge('kpa_terminal_sessions', 'Terminal sessions attached to clients and waiting in the warm pool', ['state'],
+      callback=lambda: {(k,): v for k, v in session_manager.stats().items()})
+gauge('kpa_chat_streams', 'Chat replies currently streaming over socket.io',
+      callback=lambda: sum(len(streams) for streams in chat_streams.values()))
+
 
 @socketio.on('connect')
 def handle_connect():
     logger.info('Client connected')
+    try:
+        start_session(request.sid)
+    except Exception as e:
+        logger.error("Error starting terminal session: %s", e)
+        emit('output', {'type': 'error', 'content': f"Error: {str(e)}\r\n"})
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     logger.info('Client disconnected')
+    cancel_chat_streams(request.sid)
+    session_manager.release(request.sid)
+    if environments is not None:
+        environments.release(request.sid)
+    socketio.start_background_task(session_manager.fill_pool)
 
 
 @socketio.on('input')
 def handle_input(data):
-    logger.info(f'Received input: {data}')
+    logger.debug("Received input: %r", data)
     try:
         if data.strip().lower() == 'exit':
-            emit('output', json.dumps(
-                {'type': 'text', 'content': 'Goodbye!\r\n'}))
+            emit('output', {'type': 'text', 'content': 'Goodbye!\r\n'})
+            emit('output', {'type': 'prompt'})
             return
 
-        command = data.split()[0]
-        if command == 'ls':
-            output = handle_ls_command(data)
-        elif command == 'cd':
-            output = handle_cd_command(data)
-        elif command == 'pwd':
-            output = handle_pwd_command()
-        else:
-            output = run_command(data)
-
-        emit('output', json.dumps(output))
+        session = start_session(request.sid)
+        session.touch()
+        session.send_line(data)
     except Exception as e:
-        logger.error(f"Error executing command: {e}")
-        emit('output', json.dumps(
-            {'type': 'error', 'content': f"Error: {str(e)}\r\n"}))
-
-
-def run_command(command):
-    process = subprocess.Popen(
-        command,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
-    stdout, stderr = process.communicate()
-
-    if stderr:
-        return {'type': 'error', 'content': stderr}
-    return {'type': 'text', 'content': stdout}
-
-
-def handle_ls_command(command):
+        logger.error("Error executing command: %s", e)
+        emit('output', {'type': 'error', 'content': f"Error: {str(e)}\r\n"})
+        emit('output', {'type': 'prompt'})
+
+
+@socketio.on('ack')
+def handle_ack(data):
+    session = session_manager.get(request.sid)
+    if session:
+        try:
+            session.output.ack(int(data['size']))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("Invalid output ack: %s", e)
+
+
+@socketio.on('interrupt')
+def handle_interrupt():
+    session = session_manager.get(request.sid)
+    if session:
+        session.touch()
+        session.interrupt()
+
+
+@socketio.on('resize')
+def handle_resize(data):
+    session = session_manager.get(request.sid)
+    if session:
+        try:
+            session.resize(data['cols'], data['rows'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("Invalid resize request: %s", e)
+
+
+# Sent by the scenario page once connected; gives the client's terminal its
+# own namespace with the scenario already set up in it.
+@socketio.on('scenario')
+def handle_scenario(data):
     try:
-        output = subprocess.check_output(command, shell=True, text=True)
-        files = output.strip().split('\n')
-        return {'type': 'ls', 'content': files}
-    except subprocess.CalledProcessError as e:
-        return {'type': 'error', 'content': str(e)}
-
-
-def handle_cd_command(command):
+        scenario_id = int(data.get('id'))
+    except (AttributeError, TypeError, ValueError):
+        emit('environment', {'error': 'Invalid scenario id'})
+        return
+    if environments is None or not environments.enabled:
+        emit('environment', {'namespace': None})
+        return
+    socketio.start_background_task(attach_environment, request.sid, scenario_id)
+
+
+def attach_environment(sid, scenario_id):
+    environments.release(sid)
+    env = environments.claim(scenario_id, sid)
+    if env is None:
+        socketio.emit('environment', {'error': 'Could not prepare a scenario environment'}, to=sid)
+        return
+    session = session_manager.get(sid)
+    if session is None or not session.set_namespace(env.namespace):
+        # Without the switch terminal kubectl would act outside the
+        # namespace that validation checks.
+        logger.error("Could not point the terminal of %s at environment %s", sid, env.namespace)
+        environments.release(sid)
+        socketio.emit('environment', {'error': 'Could not switch the terminal to the scenario environment'},
+                      to=sid)
+        return
+    socketio.emit('environment', {'namespace': env.namespace}, to=sid)
+
+
+@socketio.on('chat')
+def handle_chat(data):
+    if not isinstance(data, dict):
+        emit('chat_error', {'id': None, 'error': 'Invalid chat request'})
+        return
+    request_id = data.get('id')
+    message = data.get('message')
+    if not message:
+        emit('chat_error', {'id': request_id, 'error': 'Message is required'})
+        return
+    if chat_handler is None:
+        emit('chat_error', {'id': request_id, 'error': 'Chat is not available'})
+        return
+    cancelled = threading.Event()
+    with chat_streams_lock:
+        chat_streams.setdefault(request.sid, {})[request_id] = cancelled
+    socketio.start_background_task(
+        stream_chat, request.sid, request_id, message, data.get('scenarioId'), cancelled)
+
+
+@socketio.on('chat_cancel')
+def handle_chat_cancel(data):
+    if not isinstance(data, dict):
+        return
+    with chat_streams_lock:
+        cancelled = chat_streams.get(request.sid, {}).get(data.get('id'))
+    if cancelled:
+        cancelled.set()
+
+
+def stream_chat(sid, request_id, message, scenario_id, cancelled):
     try:
-        path = command.split(maxsplit=1)[1] if len(
-            command.split()) > 1 else '~'
-        os.chdir(os.path.expanduser(path))
-        return {'type': 'text', 'content': ''}
-    except FileNotFoundError:
-        return {'type': 'error', 'content': f"cd: no such file or directory: {path}\n"}
+        for delta in chat_handler.stream_response(message, scenario_id, cancelled.is_set):
+            socketio.emit('chat_token', {'id': request_id, 'delta': delta}, to=sid)
+        if not cancelled.is_set():
+            socketio.emit('chat_done', {'id': request_id}, to=sid)
+    except AIUnavailable as e:
+        logger.warning("AI unavailable for chat stream: %s", e)
+        socketio.emit('chat_error', {'id': request_id,
+                      'error': 'The AI service is busy, please try again shortly'}, to=sid)
     except Exception as e:
-        return {'type': 'error', 'content': str(e)}
-
-
-def handle_pwd_command():
-    return {'type': 'text', 'content': f"{os.getcwd()}\n"}
-
-
-def init_socketio(app):
-    socketio.init_app(app)
+        logger.error("Error streaming chat response: %s", e)
+        socketio.emit('chat_error', {'id': request_id,
+                      'error': 'Failed to handle AI chat request'}, to=sid)
+    finally:
+        with chat_streams_lock:
+            streams = chat_streams.get(sid, {})
+            streams.pop(request_id, None)
+            if not streams:
+                chat_streams.pop(sid, None)
+
+
+def cancel_chat_streams(sid):
+    with chat_streams_lock:
+        streams = chat_streams.pop(sid, {})
+    for cancelled in streams.values():
+        cancelled.set()
+
+
+def start_session(sid):
+    session, created = session_manager.acquire(sid)
+    if created:
+        socketio.start_background_task(stream_output, sid, session)
+        socketio.start_background_task(session_manager.fill_pool)
+    return session
+
+
+# Sends the session's output in bounded frames. While the browser is more
+# than a window behind, the PTY is left unread so the shell blocks; after
+# OUTPUT_PAUSE_LIMIT the PTY is drained into the capped buffer instead.
+def stream_output(sid, session):
+    output = session.output
+    paused_since = None
+    while True:
+        if output.blocked:
+            paused_since = paused_since or time.monotonic()
+            if time.monotonic() - paused_since < OUTPUT_PAUSE_LIMIT:
+                socketio.sleep(0.01)
+                continue
+        else:
+            paused_since = None
+        events = session.read()
+        if events is None:
+            break
+        output.add(events)
+        for kind, text in output.frames():
+            if kind == 'prompt':
+                socketio.emit('output', {'type': 'prompt', **session.state()}, to=sid)
+            else:
+                socketio.emit('output', text_frame(text), to=sid)
+        socketio.sleep(0)
+    logger.info("Terminal output stream ended for client %s", sid)
+
+
+def evict_idle_sessions():
+    while True:
+        socketio.sleep(EVICTION_INTERVAL)
+        for sid in session_manager.evict_idle():
+            socketio.emit('output', {'type': 'error', 'content': 'Session closed after inactivity\r\n'}, to=sid)
+            socketio.emit('output', {'type': 'prompt'}, to=sid)
+
+
+def init_socketio(app, ai_chat=None, environment_provisioner=None):
+    global chat_handler, environments
+    chat_handler = ai_chat
+    environments = environment_provisioner
+    socketio.init_app(app, message_queue=MESSAGE_QUEUE)
+    socketio.start_background_task(session_manager.fill_pool)
+    socketio.start_background_task(evict_idle_sessions)
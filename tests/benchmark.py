@@ -0,0 +1,207 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# Drives the Flask routes and socket.io events with many concurrent
+# simulated users against the fake OpenAI server and fake kubectl, and
+# reports latency percentiles and throughput per workload.
+#
+#   python -m tests.benchmark --users 20 --requests 10 --latency 0.3
+#   python -m tests.benchmark --workloads terminal,validate --json results.json
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.fake_openai import FakeOpenAIServer
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_KUBECTL_DIR = os.path.join(TESTS_DIR, 'bin')
+SOCKET_TIMEOUT = 30
+SCENARIO = {
+    'title': 'Benchmark scenario',
+    'description': 'Scale the web deployment and check that its pods are running.',
+    'setup_commands': ['kubectl create deployment web --image=nginx'],
+    'tasks': ['Scale web to three replicas', 'Check the pods are running'],
+    'hints': ['kubectl scale'],
+    'solution': {'explanation': 'Scale the deployment.', 'commands': ['kubectl scale deployment web --replicas=3']},
+    'verification_commands': ['kubectl get deployment web', 'kubectl get pods -l app=web']
+}
+
+
+# Points the app at the fakes. Must run before anything under app/ is
+# imported, since the services read their settings at import time.
+def configure_environment(openai_url, kubectl_latency=0.0):
+    os.environ.update({
+        'OPENAI_BASE_URL': openai_url,
+        'OPENAI_API_KEY': 'fake',
+        'KPA_KUBE_FAST_PATH': '0',
+        'KPA_WATCH_CACHE': '0',
+        'KPA_SCENARIO_POOL': '0',
+        'KPA_AI_CACHE': '0',
+        'KPA_AI_RATE_LIMIT': '10000',
+        'KPA_AI_RATE_BURST': '10000',
+        'KPA_FAKE_KUBECTL_LATENCY': str(kubectl_latency),
+    })
+    if FAKE_KUBECTL_DIR not in os.environ.get('PATH', '').split(os.pathsep):
+        os.environ['PATH'] = FAKE_KUBECTL_DIR + os.pathsep + os.environ.get('PATH', '')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    # Nearest-rank: the smallest value with at least pct% of values at or below it.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(name, latencies, errors, elapsed):
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        'workload': name,
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'p50_ms': percentile(ms, 50),
+        'p95_ms': percentile(ms, 95),
+        'p99_ms': percentile(ms, 99),
+        'mean_ms': sum(ms) / len(ms) if ms else None,
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else None
+    }
+
+
+class Benchmark:
+    def __init__(self, app, socketio, users=10, requests=10):
+        self.app = app
+        self.socketio = socketio
+        self.users = users
+        self.requests = requests
+        from app.services import db
+        self.scenario_id = db.store_scenario(SCENARIO)
+        self.workloads = {
+            'list_scenarios': lambda: self.http('GET', '/api/scenarios?limit=20'),
+            'get_scenario': lambda: self.http('GET', f'/api/scenarios/{self.scenario_id}'),
+            'generate_scenarios': lambda: self.http('POST', '/api/generate-scenarios', {'prompt': 'pods'}),
+            'ai_chat': lambda: self.http('POST', '/api/ai-chat',
+                                         {'message': 'How do I scale?', 'scenarioId': self.scenario_id}),
+            'validate': lambda: self.http('POST', f'/api/scenarios/{self.scenario_id}/validate'),
+            'terminal': lambda: self.socket('input', 'kubectl get pods', self._prompt),
+            'chat_stream': lambda: self.socket(
+                'chat', {'id': 1, 'message': 'How do I scale?', 'scenarioId': self.scenario_id}, self._chat_done),
+        }
+
+    # Each simulated user gets its own client and makes `requests` calls one
+    # after another; all users run at once.
+    def run(self, names=None):
+        return [self.run_workload(name) for name in (names or self.workloads)]
+
+    def run_workload(self, name):
+        make_user = self.workloads[name]
+
+        def user():
+            call = make_user()
+            latencies, errors = [], 0
+            try:
+                for _ in range(self.requests):
+                    started = time.perf_counter()
+                    if call():
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        errors += 1
+            finally:
+                getattr(call, 'close', lambda: None)()
+            return latencies, errors
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.users) as pool:
+            results = list(pool.map(lambda _: user(), range(self.users)))
+        elapsed = time.perf_counter() - started
+        latencies = [latency for user_latencies, _ in results for latency in user_latencies]
+        return summarize(name, latencies, sum(e for _, e in results), elapsed)
+
+    def http(self, method, path, body=None):
+        client = self.app.test_client()
+
+        def call():
+            response = client.open(path, method=method, json=body)
+            return response.status_code < 400
+        return call
+
+    def socket(self, event, payload, done):
+        client = self.socketio.test_client(self.app)
+        self._wait(client, self._prompt)
+
+        def call():
+            client.emit(event, payload)
+            return self._wait(client, done)
+        call.close = client.disconnect
+        return call
+
+    def _wait(self, client, done):
+        deadline = time.monotonic() + SOCKET_TIMEOUT
+        while time.monotonic() < deadline:
+            for message in client.get_received():
+                if done(message):
+                    return True
+            time.sleep(0.002)
+        return False
+
+    def _prompt(self, message):
+        return message['name'] == 'output' and message['args'][0].get('type') == 'prompt'
+
+    def _chat_done(self, message):
+        return message['name'] in ('chat_done', 'chat_error')
+
+
+def format_results(results):
+    def ms(value):
+        return f"{value:9.1f}" if value is not None else "        -"
+    lines = [f"{'workload':<20}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}"]
+    for r in results:
+        lines.append(f"{r['workload']:<20}{r['requests']:>9}{r['errors']:>8} {ms(r['p50_ms'])} "
+                     f"{ms(r['p95_ms'])} {ms(r['p99_ms'])}{r['throughput'] or 0:>9}")
+    return '\n'.join(lines)
+
+
+def create_benchmark(users, requests):
+    from app.main import create_app
+    from app.websocket import socketio
+    return Benchmark(create_app(), socketio, users, requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test kpa against local fakes")
+    parser.add_argument('--users', type=int, default=10, help="concurrent simulated users")
+    parser.add_argument('--requests', type=int, default=10, help="requests per user per workload")
+    parser.add_argument('--workloads', help="comma separated subset of workloads to run")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake OpenAI response latency in seconds")
+    parser.add_argument('--kubectl-latency', type=float, default=0.02, help="fake kubectl latency in seconds")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.json) if args.json else None
+
+    server = FakeOpenAIServer(latency=args.latency, jitter=args.latency / 4).start()
+    configure_environment(server.url, args.kubectl_latency)
+    # kpa.db and kpa.log are written to the working directory.
+    os.chdir(tempfile.mkdtemp(prefix='kpa-bench-'))
+    try:
+        benchmark = create_benchmark(args.users, args.requests)
+        names = args.workloads.split(',') if args.workloads else None
+        results = benchmark.run(names)
+    finally:
+        server.stop()
+
+    print(format_results(results))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(r['errors'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
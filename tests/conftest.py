@@ -0,0 +1,38 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import tempfile
+import pytest
+from tests.benchmark import configure_environment, create_benchmark
+from tests.fake_openai import FakeOpenAIServer
+
+# Started at import time so the environment is in place before any test
+# imports a module under app/. kpa.db and kpa.log go to a scratch directory.
+fake_openai = FakeOpenAIServer().start()
+configure_environment(fake_openai.url)
+os.chdir(tempfile.mkdtemp(prefix='kpa-tests-'))
+
+
+@pytest.fixture
+def openai_server():
+    fake_openai.latency = 0.0
+    fake_openai.jitter = 0.0
+    fake_openai.failures.clear()
+    yield fake_openai
+    fake_openai.latency = 0.0
+    fake_openai.failures.clear()
+
+
+@pytest.fixture
+def database(tmp_path):
+    from app.services import db
+    db.init_db(str(tmp_path / 'kpa.db'))
+    return db
+
+
+@pytest.fixture(scope='session')
+def benchmark():
+    return create_benchmark(users=3, requests=2)
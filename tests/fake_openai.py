@@ -0,0 +1,206 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# A local stand-in for the OpenAI chat completions API. It answers
+# structured-output requests with values generated from the request's JSON
+# schema (so ScenarioResponse, KubernetesScenario and the evaluate/explain/
+# troubleshoot schemas all parse), plain requests with text, and streaming
+# requests with server-sent events, each after a configurable delay.
+#
+#   python -m tests.fake_openai --port 8089 --latency 0.5
+#   OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=fake python -m app.main
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STREAM_TEXT = "Try listing the pods in the namespace and describing the one that is not ready."
+
+
+def fake_value(schema, defs, name='value'):
+    if '$ref' in schema:
+        return fake_value(defs[schema['$ref'].split('/')[-1]], defs, name)
+    for key in ('anyOf', 'oneOf'):
+        if key in schema:
+            options = [s for s in schema[key] if s.get('type') != 'null']
+            return fake_value(options[0] if options else {}, defs, name)
+    kind = schema.get('type')
+    if kind == 'object':
+        return {key: fake_value(value, defs, key) for key, value in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [fake_value(schema.get('items', {}), defs, name) for _ in range(2)]
+    if kind == 'number':
+        return 0.5
+    if kind == 'integer':
+        return 1
+    if kind == 'boolean':
+        return True
+    if name.endswith('commands'):
+        return "kubectl get pods -n default"
+    return f"Fake {name.replace('_', ' ')} {random.randint(1, 9999)}"
+
+
+def schema_of(response_format):
+    if not response_format or response_format.get('type') != 'json_schema':
+        return None
+    # The SDK nests the schema under json_schema; a bare schema is accepted
+    # as well.
+    return (response_format.get('json_schema') or {}).get('schema') or response_format.get('schema')
+
+
+class FakeOpenAIServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, token_delay=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.requests = 0
+        self.failures = []
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # The next `times` requests are answered with `status` and `headers`
+    # instead of a completion, e.g. fail(429, {'retry-after-ms': '50'}).
+    def fail(self, status, headers=None, times=1):
+        with self._lock:
+            self.failures.extend([(status, headers or {})] * times)
+
+    def next_failure(self):
+        with self._lock:
+            return self.failures.pop(0) if self.failures else None
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def completion(self, body):
+        with self._lock:
+            self.requests += 1
+        schema = schema_of(body.get('response_format'))
+        if schema is not None:
+            content = json.dumps(fake_value(schema, schema.get('$defs', {})))
+        else:
+            content = "This is a fake answer from the local OpenAI stand-in."
+        return {
+            'id': f"chatcmpl-fake-{self.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': content, 'refusal': None}
+            }],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 20, 'total_tokens': 30}
+        }
+
+    def chunks(self, body):
+        with self._lock:
+            self.requests += 1
+        for word in STREAM_TEXT.split(' '):
+            yield {
+                'id': 'chatcmpl-fake-stream',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}]
+            }
+        if (body.get('stream_options') or {}).get('include_usage'):
+            yield {
+                'id': 'chatcmpl-fake-stream',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 20, 'total_tokens': 30}
+            }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if not self.path.endswith('/chat/completions'):
+                    self._json(404, {'error': {'message': f"Unknown path {self.path}"}})
+                    return
+                server.delay()
+                failure = server.next_failure()
+                if failure is not None:
+                    status, headers = failure
+                    self._json(status, {'error': {'message': f"Fake error {status}", 'type': 'fake_error'}}, headers)
+                elif body.get('stream'):
+                    self._stream(body)
+                else:
+                    self._json(200, server.completion(body))
+
+            def _json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('x-ratelimit-limit-requests', '100000')
+                self.send_header('x-ratelimit-remaining-requests', '99999')
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for chunk in server.chunks(body):
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                    if server.token_delay:
+                        time.sleep(server.token_delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake OpenAI API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--token-delay', type=float, default=0.0, help="seconds between streamed tokens")
+    args = parser.parse_args()
+    server = FakeOpenAIServer(args.host, args.port, args.latency, args.jitter, args.token_delay)
+    print(f"Fake OpenAI API listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+from tests.benchmark import SCENARIO
+from tests.fake_openai import STREAM_TEXT
+
+
+def test_generate_scenarios_runs_requests_concurrently(openai_server, database):
+    from app.services.ai import ChatHandler, get_clients
+    get_clients()
+    openai_server.latency = 0.3
+    started = time.perf_counter()
+    response = ChatHandler(None).generate_scenarios('network policies', count=5)
+    elapsed = time.perf_counter() - started
+    assert len(response.scenarios) == 5
+    assert all(c.startswith('kubectl') for s in response.scenarios for c in s.verification_commands)
+    assert elapsed < 0.3 * 3
+
+
+def test_stream_response_yields_tokens_and_stores_exchange(openai_server, database):
+    from app.services.ai import ChatHandler
+    scenario_id = database.store_scenario(SCENARIO)
+    text = ''.join(ChatHandler(None).stream_response('What next?', scenario_id))
+    assert text.strip() == STREAM_TEXT
+    history = database.get_chat_history(scenario_id)
+    assert [m['role'] for m in history] == ['user', 'assistant']
+
+
+def test_evaluate_progress_updates_progress(openai_server, database):
+    from app.services.ai import ChatHandler
+    scenario_id = database.store_scenario(SCENARIO)
+    evaluation = ChatHandler(None).evaluate_progress(scenario_id, ['kubectl get pods'])
+    assert set(evaluation) == {'progress', 'feedback', 'next_hint'}
+    assert database.get_scenario_progress(scenario_id)['status'] == 'in_progress'
+
+
+def test_evaluate_progress_describes_only_the_environment(openai_server, database):
+    from app.services.ai import ChatHandler
+
+    class Cluster:
+        calls = []
+
+        def summary(self, namespaces=None, limit=50):
+            self.calls.append(namespaces)
+            return ['kpa-s1-ab/pod/web phase=Running']
+
+    scenario_id = database.store_scenario(SCENARIO)
+    handler = ChatHandler(None, cluster_cache=Cluster())
+    handler.evaluate_progress(scenario_id, ['kubectl get pods'], namespace='kpa-s1-ab')
+    handler.evaluate_progress(scenario_id, ['kubectl get pods'])
+    assert Cluster.calls == [['kpa-s1-ab']]
+
+
+def test_iter_scenarios_reports_a_batch_that_stops_early(openai_server, database, monkeypatch):
+    import asyncio
+    from app.services.ai import ChatHandler
+
+    async def cancelled(self, messages, index, count):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(ChatHandler, '_generate_scenario', cancelled)
+    results = list(ChatHandler(None).iter_scenarios('pods', count=3))
+    assert len(results) == 3 and all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_iter_scenarios_gives_up_on_a_stalled_batch(openai_server, database, monkeypatch):
+    import asyncio
+    from app.services.ai import ChatHandler
+
+    async def stalled(self, messages, count, emit):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr('app.services.ai.RESULT_WAIT', 0.2)
+    monkeypatch.setattr(ChatHandler, '_fan_out', stalled)
+    results = list(ChatHandler(None).iter_scenarios('pods', count=2))
+    assert len(results) == 2 and all(isinstance(r, TimeoutError) for r in results)
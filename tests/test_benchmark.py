@@ -0,0 +1,26 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import pytest
+from tests.benchmark import format_results, percentile
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+
+
+@pytest.mark.parametrize('workload', [
+    'list_scenarios', 'get_scenario', 'generate_scenarios', 'ai_chat', 'validate', 'terminal', 'chat_stream'
+])
+def test_workload_runs_without_errors(benchmark, workload):
+    result = benchmark.run_workload(workload)
+    assert result['errors'] == 0
+    assert result['requests'] == benchmark.users * benchmark.requests
+    assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+    assert workload in format_results([result])
@@ -0,0 +1,36 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+from app.utils.cache import LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire_after_ttl():
+    cache = LRUCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a', 'gone') == 'gone'
+    assert len(cache) == 0
+
+
+def test_delete_and_delete_where():
+    cache = LRUCache(maxsize=10)
+    for key in [(1, 'x'), (1, 'y'), (2, 'x')]:
+        cache.set(key, True)
+    assert cache.delete((2, 'x')) and not cache.delete((2, 'x'))
+    assert cache.delete_where(lambda key: key[0] == 1) == 2
+    assert len(cache) == 0
@@ -0,0 +1,48 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import threading
+from app.services.cluster_cache import ClusterCache
+
+
+class ForbiddenApi:
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            from kubernetes.client.exceptions import ApiException
+            raise ApiException(status=403, reason='Forbidden')
+        return call
+
+
+class ForbiddenClient:
+    apis = {'core': ForbiddenApi()}
+
+    def load(self):
+        return True
+
+
+def test_forbidden_watch_stops_instead_of_retrying():
+    cache = ClusterCache(ForbiddenClient(), resources=['nodes'])
+    thread = threading.Thread(target=cache._watch_loop, args=('nodes',), daemon=True)
+    thread.start()
+    thread.join(timeout=2)
+    assert not thread.is_alive()
+    assert not cache.synced('nodes')
+
+
+def pod(namespace, name):
+    return {'metadata': {'namespace': namespace, 'name': name, 'labels': {}}}
+
+
+def test_relist_bumps_namespaces_emptied_during_a_watch_gap():
+    cache = ClusterCache(None, resources=['pods'])
+    cache._list = lambda resource: ([pod('dev', 'web'), pod('prod', 'api')], '1')
+    cache._relist('pods')
+    dev, prod = cache.namespace_generation('dev'), cache.namespace_generation('prod')
+
+    cache._list = lambda resource: ([pod('prod', 'api')], '2')
+    cache._relist('pods')
+    assert cache.namespace_generation('dev') > dev
+    assert cache.namespace_generation('prod') > prod
+    assert cache.list('pods', namespace='dev') == []
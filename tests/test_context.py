@@ -0,0 +1,78 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from app.services import context
+from app.services.context import ContextBuilder, count_tokens, truncate
+from tests.benchmark import SCENARIO
+
+
+def store_history(database, scenario_id, count, words=20):
+    database.store_chat_messages([
+        {'scenario_id': scenario_id, 'role': 'user' if i % 2 == 0 else 'assistant',
+         'content': f"message {i} " + 'pods ' * words}
+        for i in range(count)])
+
+
+def test_fallback_token_count_and_truncation(monkeypatch):
+    monkeypatch.setattr(context, 'encoding', lambda: None)
+    assert count_tokens('') == 0
+    assert count_tokens('x' * 40) == 11
+    assert truncate('short', 10) == 'short'
+    assert truncate('x' * 100, 5) == 'x' * 16 + '…'
+
+
+def test_recent_turns_fit_the_budget_and_stay_in_order(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    store_history(database, scenario_id, 30)
+    summary, turns = ContextBuilder(budget=400).chat_context(scenario_id)
+    assert summary == ''
+    assert sum(count_tokens(t['content']) + 4 for t in turns) <= 300
+    assert 0 < len(turns) < 30
+    assert turns[-1]['content'].startswith('message 29 ')
+    numbers = [int(t['content'].split()[1]) for t in turns]
+    assert numbers == sorted(numbers)
+
+
+def test_summary_advances_one_batch_per_request(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    store_history(database, scenario_id, 150, words=2)
+    batches = []
+
+    def summarize(summary, batch):
+        batches.append(len(batch))
+        return f"{summary}+{len(batch)}"
+
+    builder = ContextBuilder(summarize=summarize, budget=3000)
+    summary, turns = builder.chat_context(scenario_id)
+    assert batches == [context.SUMMARY_BATCH] and summary == f"+{context.SUMMARY_BATCH}"
+    assert len(turns) == context.RECENT_TURNS
+
+    summary, _ = builder.chat_context(scenario_id)
+    assert batches == [context.SUMMARY_BATCH] * 2
+    stored = database.get_chat_summary(scenario_id)
+    assert stored['content'] == summary
+    builder.chat_context(scenario_id)
+    builder.chat_context(scenario_id)
+    # Everything before the recent turns is summarized; nothing more to do.
+    assert sum(batches) == 150 - context.RECENT_TURNS
+
+
+def test_summary_failure_keeps_the_stored_summary(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    store_history(database, scenario_id, 60, words=2)
+
+    def broken(summary, batch):
+        raise RuntimeError('model down')
+
+    summary, turns = ContextBuilder(summarize=broken).chat_context(scenario_id)
+    assert summary == '' and len(turns) == context.RECENT_TURNS
+
+
+def test_relevant_notes_prefer_matching_words_within_budget(database):
+    for note in ['Practise network policies', 'Review pod security', 'Struggled with network policy egress']:
+        database.store_note(note)
+    notes = ContextBuilder().relevant_notes('network policy egress rules', budget=1000)
+    assert notes[0] == 'Struggled with network policy egress'
+    assert len(ContextBuilder().relevant_notes('network', budget=count_tokens(notes[0]) + 2)) == 1
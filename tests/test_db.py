@@ -0,0 +1,160 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sqlite3
+import threading
+import time
+import pytest
+from app.services import db
+from tests.benchmark import SCENARIO
+
+
+@pytest.fixture
+def memory_database(database):
+    previous = db.DATABASE
+    db.init_db(':memory:')
+    yield db
+    db.init_db(previous)
+
+
+def test_memory_backend_stands_in_for_a_shared_database(memory_database):
+    assert isinstance(memory_database._backend, db.SQLiteBackend)
+    ids = memory_database.store_scenarios([SCENARIO, SCENARIO])
+    assert ids[1] == ids[0] + 1
+    assert memory_database.get_scenario(ids[1])['title'] == SCENARIO['title']
+    assert memory_database.store_chat_messages([
+        {'scenario_id': ids[0], 'role': 'user', 'content': 'hi'},
+        {'scenario_id': ids[0], 'role': 'assistant', 'content': 'hello'}]) == [1, 2]
+    assert memory_database.store_note('remember') == 1
+
+
+def test_backend_is_chosen_from_the_url(tmp_path):
+    backend = db.create_backend(f"sqlite:///{tmp_path / 'kpa.db'}")
+    assert isinstance(backend, db.SQLiteBackend) and backend.path == str(tmp_path / 'kpa.db')
+    backend.close()
+
+
+def test_postgres_rows_and_placeholders():
+    row = db.PostgresRow(['id', 'title'], (1, 'Pods'))
+    assert row[0] == 1 and row['title'] == 'Pods' and dict(row) == {'id': 1, 'title': 'Pods'}
+    assert db._postgres_sql("SELECT * FROM t WHERE a = ? AND b LIKE '5%'", (1,)) == \
+        "SELECT * FROM t WHERE a = %s AND b LIKE '5%%'"
+    assert db._postgres_sql("SELECT 1", None) == "SELECT 1"
+
+
+def test_cached_scenarios_are_copied_on_the_way_out(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    first = database.get_scenario(scenario_id)
+    first['tasks'].append('tampered')
+    first['solution']['commands'].clear()
+    second = database.get_scenario(scenario_id)
+    assert second['tasks'] == SCENARIO['tasks']
+    assert second['solution'] == SCENARIO['solution']
+    assert database.scenario_cache_stats()['hits'] >= 1
+
+
+def test_shared_backends_expire_cached_scenarios(tmp_path, monkeypatch):
+    monkeypatch.setattr(db.SQLiteBackend, 'shared', True)
+    monkeypatch.setattr(db, 'SCENARIO_CACHE_TTL', 0.05)
+    db.init_db(str(tmp_path / 'kpa.db'))
+    try:
+        scenario_id = db.store_scenario(SCENARIO)
+        assert db.get_scenario(scenario_id) is not None
+        # Deleted by another replica, which cannot touch this cache.
+        with db.get_db() as conn:
+            conn.execute("DELETE FROM scenarios WHERE id = ?", (scenario_id,))
+            conn.commit()
+        assert db.get_scenario(scenario_id) is not None
+        time.sleep(0.1)
+        assert db.get_scenario(scenario_id) is None
+    finally:
+        monkeypatch.undo()
+        db.init_db(str(tmp_path / 'kpa.db'))
+    assert db.scenario_cache.ttl is None
+
+
+def test_deleted_scenarios_leave_the_cache(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    assert database.get_scenario(scenario_id) is not None
+    database.delete_scenario(scenario_id)
+    assert database.get_scenario(scenario_id) is None
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    conn = sqlite3.connect(path)
+    for statement in db.MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.execute("INSERT INTO scenarios (title, description, setup_commands, tasks, hints, solution, "
+                 "verification_commands) VALUES ('Pods', '', '[]', '[]', '[]', '{}', '[]')")
+    conn.executemany("INSERT INTO scenario_progress (scenario_id, status, completed_tasks) VALUES (1, ?, '[]')",
+                     [('in_progress',), ('completed',)])
+    conn.commit()
+    conn.close()
+
+    db.init_db(path)
+    with db.get_db() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(db.MIGRATIONS)
+        rows = conn.execute("SELECT status FROM scenario_progress WHERE scenario_id = 1").fetchall()
+        assert [row[0] for row in rows] == ['completed']
+        chat_plan = ' '.join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM chat_history WHERE scenario_id = ? ORDER BY timestamp, id", (1,)))
+        notes_plan = ' '.join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM notes ORDER BY created_at DESC LIMIT ?", (5,)))
+    assert 'idx_chat_history_scenario_timestamp' in chat_plan
+    assert 'idx_notes_created_at' in notes_plan
+
+    # The upsert relies on the unique index the migration adds.
+    db.update_scenario_progress(1, 'in_progress', ['Create a pod'])
+    progress = db.get_scenario_progress(1)
+    assert progress['status'] == 'in_progress' and progress['completed_tasks'] == ['Create a pod']
+    with db.get_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM scenario_progress").fetchone()[0] == 1
+
+
+def test_every_pooled_connection_uses_wal_and_the_pragmas(database):
+    pool = db._backend.pool
+    connections = [pool.acquire() for _ in range(3)]
+    try:
+        for conn in connections:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+            assert conn.execute('PRAGMA cache_size').fetchone()[0] == -16000
+            assert conn.execute('PRAGMA temp_store').fetchone()[0] == 2
+            assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+    finally:
+        for conn in connections:
+            pool.release(conn)
+
+
+def test_pool_waits_for_a_free_connection_and_times_out():
+    pool = db.ConnectionPool(lambda: sqlite3.connect(':memory:', check_same_thread=False), size=2, timeout=0.1)
+    first, second = pool.acquire(), pool.acquire()
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    assert time.monotonic() - started >= 0.1
+
+    pool.timeout = 5
+    threading.Timer(0.05, pool.release, (first,)).start()
+    assert pool.acquire() is first
+    assert pool._created == 2
+    pool.release(first)
+    pool.release(second)
+    pool.close()
+
+
+def test_transaction_returns_its_connection_to_the_pool(database):
+    with database.transaction() as conn:
+        used = conn
+    with pytest.raises(ValueError):
+        with database.transaction() as conn:
+            assert conn is used
+            conn.execute("INSERT INTO notes (content) VALUES ('rolled back')")
+            raise ValueError('abort')
+    with database.get_db() as conn:
+        assert conn is used and not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0] == 0
+    assert database._backend.pool._created == 1
@@ -0,0 +1,83 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from app.services.environments import EnvironmentProvisioner, plan_stages, scope_command
+from app.services.kubectl import Executor
+from tests.benchmark import SCENARIO
+
+
+def test_setup_commands_are_staged_by_dependency():
+    stages = plan_stages([
+        'kubectl expose deployment web --port=80',
+        'kubectl create deployment web --image=nginx',
+        'kubectl create configmap settings --from-literal=a=b',
+        'kubectl create secret generic token --from-literal=t=x',
+    ])
+    assert stages == [
+        ['kubectl create configmap settings --from-literal=a=b',
+         'kubectl create secret generic token --from-literal=t=x'],
+        ['kubectl create deployment web --image=nginx'],
+        ['kubectl expose deployment web --port=80'],
+    ]
+
+
+def test_commands_are_scoped_to_the_environment():
+    assert scope_command('kubectl get pods', 'kpa-s1-ab') == 'kubectl get pods -n kpa-s1-ab'
+    assert scope_command('kubectl get pods -n other', 'kpa-s1-ab') == 'kubectl get pods -n other'
+    assert scope_command('kubectl get pods | grep web', 'kpa-s1-ab') == 'kubectl get pods -n kpa-s1-ab | grep web'
+    assert scope_command('kubectl create namespace dev', 'kpa-s1-ab') == 'kubectl create namespace dev'
+
+
+def test_namespace_flag_goes_before_command_arguments_and_heredocs():
+    assert (scope_command('kubectl run busybox --image=busybox -- sleep 3600', 'kpa-s1-ab') ==
+            'kubectl run busybox --image=busybox -n kpa-s1-ab -- sleep 3600')
+    assert scope_command('kubectl exec web -- ls /', 'kpa-s1-ab') == 'kubectl exec web -n kpa-s1-ab -- ls /'
+    assert (scope_command('kubectl exec web -- ls -n /tmp', 'kpa-s1-ab') ==
+            'kubectl exec web -n kpa-s1-ab -- ls -n /tmp')
+    heredoc = 'kubectl apply -f - <<EOF\napiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: a\nEOF'
+    assert scope_command(heredoc, 'kpa-s1-ab') == heredoc.replace('-f - <<', '-f - -n kpa-s1-ab <<', 1)
+    assert (scope_command("kubectl get pods -o jsonpath='{.items[*].metadata.name}' > pods.txt", 'kpa-s1-ab') ==
+            "kubectl get pods -o jsonpath='{.items[*].metadata.name}' -n kpa-s1-ab > pods.txt")
+
+
+def test_claim_release_and_collect(database, monkeypatch):
+    monkeypatch.setattr('app.services.environments.RELEASE_GRACE', 0)
+    scenario_id = database.store_scenario(SCENARIO)
+    provisioner = EnvironmentProvisioner(Executor(max_workers=4), size=1)
+
+    env = provisioner.claim(scenario_id, 'sid-1')
+    assert env.state == 'claimed' and env.namespace.startswith(f'kpa-s{scenario_id}-')
+    assert provisioner.environment_for('sid-1') is env
+
+    provisioner.pool.shutdown(wait=True)
+    spare = [e for e in provisioner.environments.values() if e.state == 'ready']
+    assert len(spare) == 1
+
+    provisioner.release('sid-1')
+    assert provisioner.collect() == 1
+    assert env.namespace not in provisioner.environments
+    assert spare[0].namespace in provisioner.environments
+
+
+def test_claim_takes_over_the_environment_being_prepared(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    provisioner = EnvironmentProvisioner(Executor(max_workers=4), size=1)
+
+    provisioner.prepare(scenario_id)
+    prepared = next(iter(provisioner.environments.values()))
+    env = provisioner.claim(scenario_id, 'sid-1')
+    assert env is prepared and env.state == 'claimed'
+
+    provisioner.pool.shutdown(wait=True)
+    assert len(provisioner.environments) == 2
+
+
+def test_claim_respects_the_environment_limit(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    provisioner = EnvironmentProvisioner(Executor(max_workers=4), size=0, max_environments=1)
+
+    assert provisioner.claim(scenario_id, 'sid-1').state == 'claimed'
+    assert provisioner.claim(scenario_id, 'sid-2') is None
+    assert len(provisioner.environments) == 1
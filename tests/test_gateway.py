@@ -0,0 +1,115 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+import pytest
+from app.services.ai import AIGateway, AIUnavailable, CircuitBreaker, TokenBucket, parse_duration
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def complete(gateway):
+    from app.services.ai import MODEL, get_client
+    return gateway.call(get_client().chat.completions.create, model=MODEL, messages=MESSAGES)
+
+
+def test_parse_duration_reads_openai_reset_headers():
+    assert parse_duration('6m0s') == 360
+    assert parse_duration('120ms') == pytest.approx(0.12)
+    assert parse_duration('2.5') == 2.5
+    assert parse_duration(None) is None
+
+
+def test_token_bucket_queues_bursts_beyond_capacity():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    bucket.release()
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+
+
+def test_token_bucket_follows_rate_limit_headers():
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.observe({'x-ratelimit-limit-requests': '600', 'x-ratelimit-remaining-requests': '0',
+                    'x-ratelimit-reset-requests': '2s'})
+    assert bucket.rate == 10
+    assert bucket.reserve() == pytest.approx(2, abs=0.1)
+
+
+def test_circuit_breaker_opens_and_probes_after_reset():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.2)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(AIUnavailable) as error:
+        breaker.check()
+    assert 0 < error.value.retry_after <= 0.2
+    time.sleep(0.25)
+    breaker.check()
+    # Only one probe is let through until it reports back.
+    with pytest.raises(AIUnavailable):
+        breaker.check()
+    breaker.record_success()
+    breaker.check()
+    assert breaker.state == 'closed'
+
+
+def test_rate_limited_call_waits_for_retry_after(openai_server):
+    gateway = AIGateway(TokenBucket(1000, 1000), CircuitBreaker(5, 30), attempts=3)
+    openai_server.fail(429, {'retry-after-ms': '200'})
+    started = time.monotonic()
+    assert complete(gateway).choices[0].message.content
+    assert time.monotonic() - started >= 0.2
+    assert gateway.retries == 1 and gateway.breaker.failures == 0
+
+
+def test_rate_limit_past_the_last_attempt_is_unavailable(openai_server):
+    gateway = AIGateway(TokenBucket(1000, 1000), CircuitBreaker(5, 30), attempts=2)
+    openai_server.fail(429, {'retry-after-ms': '10'}, times=2)
+    with pytest.raises(AIUnavailable) as error:
+        complete(gateway)
+    assert error.value.retry_after == pytest.approx(0.01)
+
+
+def test_server_errors_back_off_and_retry(openai_server, monkeypatch):
+    monkeypatch.setattr('app.services.ai.BACKOFF_BASE', 0.01)
+    gateway = AIGateway(TokenBucket(1000, 1000), CircuitBreaker(5, 30), attempts=3)
+    openai_server.fail(500, times=2)
+    assert complete(gateway).choices[0].message.content
+    assert gateway.retries == 2
+    assert gateway.breaker.state == 'closed' and gateway.breaker.failures == 0
+
+
+def test_repeated_server_errors_open_the_circuit(openai_server, monkeypatch):
+    monkeypatch.setattr('app.services.ai.BACKOFF_BASE', 0.01)
+    gateway = AIGateway(TokenBucket(1000, 1000), CircuitBreaker(2, 30), attempts=2)
+    openai_server.fail(503, times=2)
+    with pytest.raises(AIUnavailable) as error:
+        complete(gateway)
+    assert error.value.retry_after == 30
+    with pytest.raises(AIUnavailable):
+        complete(gateway)
+    assert gateway.rejected == 1 and openai_server.failures == []
+
+
+def test_client_error_on_a_probe_reopens_the_circuit(openai_server):
+    from openai import BadRequestError
+    gateway = AIGateway(TokenBucket(1000, 1000), CircuitBreaker(1, 0.05), attempts=2)
+    openai_server.fail(400, times=1)
+    with pytest.raises(BadRequestError):
+        complete(gateway)
+    assert gateway.breaker.state == 'closed' and gateway.breaker.failures == 0
+
+    gateway.breaker.record_failure()
+    time.sleep(0.1)
+    openai_server.fail(400, times=1)
+    with pytest.raises(BadRequestError):
+        complete(gateway)
+    assert gateway.breaker.failures == 2
+    with pytest.raises(AIUnavailable):
+        complete(gateway)
+    time.sleep(0.1)
+    assert complete(gateway).choices[0].message.content
+    assert gateway.breaker.state == 'closed'
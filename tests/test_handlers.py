@@ -0,0 +1,93 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from flask import Flask
+from app.api.handlers import Handler
+from app.services.kubectl import Executor
+from tests.benchmark import SCENARIO
+
+
+class MissingRowPool:
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    def serves(self, topic, difficulty):
+        return True
+
+    def take(self, topic, difficulty):
+        return self.ids.pop(0) if self.ids else None
+
+
+def test_pooled_scenario_without_a_row_falls_back_to_generation(openai_server, database):
+    from app.services.ai import ChatHandler
+    handler = Handler(Executor(max_workers=2), ChatHandler(None), scenario_pool=MissingRowPool([999999]))
+    with Flask(__name__).test_request_context('/api/generate-scenarios', method='POST', json={'count': 1}):
+        response = handler.handle_generate_scenarios()
+    assert response.status_code == 200
+    scenarios = response.get_json()
+    assert len(scenarios) == 1 and database.get_scenario(scenarios[0]['id']) is not None
+
+
+class BusyChat:
+    def iter_scenarios(self, prompt, count):
+        from app.services.ai import AIUnavailable
+        for _ in range(count):
+            yield AIUnavailable("AI service is rate limited", retry_after=2.2)
+
+
+def test_ai_unavailable_is_503_with_retry_after(database):
+    handler = Handler(Executor(max_workers=2), BusyChat())
+    with Flask(__name__).test_request_context('/api/generate-scenarios', method='POST',
+                                              json={'prompt': 'pods', 'count': 2}):
+        response, status, headers = handler.handle_generate_scenarios()
+    assert status == 503 and headers == {'Retry-After': '3'}
+    assert response.get_json()['retry_after'] == 3
+
+
+def list_page(handler, query='', etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    with Flask(__name__).test_request_context(f'/api/scenarios?{query}', headers=headers):
+        return handler.get_all_scenarios()
+
+
+def test_scenario_list_pages_by_keyset_cursor(database):
+    ids = database.store_scenarios([dict(SCENARIO, title=f"Scenario {i}") for i in range(5)])
+    handler = Handler(Executor(max_workers=2), None)
+    pages, cursor = [], ''
+    while True:
+        body = list_page(handler, f'limit=2&fields=title{cursor}').get_json()
+        pages.append([s['id'] for s in body['scenarios']])
+        if body['next_cursor'] is None:
+            break
+        cursor = f"&cursor={body['next_cursor']}"
+    newest = ids[::-1]
+    assert pages == [newest[0:2], newest[2:4], newest[4:]]
+    assert set(body['scenarios'][0]) == {'id', 'title'}
+    assert list_page(handler, 'fields=title,secret')[1] == 400
+
+
+def test_unchanged_scenario_list_is_answered_with_304(database):
+    scenario_id = database.store_scenario(SCENARIO)
+    handler = Handler(Executor(max_workers=2), None)
+    first = list_page(handler, 'limit=5')
+    etag = first.headers['ETag'].strip('"')
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'no-cache'
+
+    assert list_page(handler, 'limit=5', first.headers['ETag']).status_code == 304
+    assert list_page(handler, 'limit=10', first.headers['ETag']).status_code == 200
+
+    database.delete_scenario(scenario_id)
+    changed = list_page(handler, 'limit=5', first.headers['ETag'])
+    assert changed.status_code == 200 and changed.headers['ETag'].strip('"') != etag
+
+
+def test_validate_rejects_a_body_that_is_not_an_object(database):
+    handler = Handler(Executor(max_workers=2), None)
+    scenario_id = database.store_scenario(SCENARIO)
+    for body in (['failFast'], 'x'):
+        with Flask(__name__).test_request_context(f'/api/scenarios/{scenario_id}/validate', method='POST',
+                                                  json=body):
+            response, status = handler.handle_validate(scenario_id)
+        assert status == 400 and 'error' in response.get_json()
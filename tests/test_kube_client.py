@@ -0,0 +1,96 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import pytest
+from app.services.cluster_cache import LAST_APPLIED
+from app.services.kubectl import KubernetesClient, Unsupported, parse_get, render_jsonpath
+
+DEPLOYMENT = {
+    'metadata': {'name': 'web', 'labels': {'app.kubernetes.io/name': 'web'}},
+    'spec': {'replicas': 3, 'paused': False},
+    'status': {'conditions': [{'type': 'Available', 'status': 'True'},
+                              {'type': 'Progressing', 'status': 'True'}]},
+}
+
+
+def test_parse_get_reads_namespace_selector_and_output():
+    request = parse_get(['kubectl', 'get', 'po', '-n', 'dev', '-l', 'app=web', '-ojson'])
+    assert request['resource'] == 'pods' and request['name'] is None
+    assert (request['namespace'], request['selector'], request['output']) == ('dev', 'app=web', 'json')
+
+    request = parse_get(['kubectl', 'get', 'deployment/web', '--namespace=prod', '-o', 'name'])
+    assert (request['resource'], request['name'], request['namespace']) == ('deployments', 'web', 'prod')
+
+    request = parse_get(['kubectl', 'get', 'svc', 'web', '-A'])
+    assert request['all_namespaces'] and request['name'] == 'web'
+
+
+@pytest.mark.parametrize('args', [
+    ['kubectl', 'describe', 'pod', 'web'],
+    ['kubectl', 'get', 'pods,services'],
+    ['kubectl', 'get', 'configmaps'],
+    ['kubectl', 'get', 'pods', '--watch'],
+    ['kubectl', 'get', 'pods', '-n'],
+    ['kubectl', 'get'],
+])
+def test_parse_get_leaves_other_commands_to_kubectl(args):
+    with pytest.raises(Unsupported):
+        parse_get(args)
+
+
+def test_render_jsonpath_fields_indexes_and_wildcards():
+    assert render_jsonpath('{.spec.replicas}', DEPLOYMENT) == '3'
+    assert render_jsonpath('{.spec.paused}', DEPLOYMENT) == 'false'
+    assert render_jsonpath('{.status.conditions[0].type}', DEPLOYMENT) == 'Available'
+    assert render_jsonpath('{.status.conditions[-1].type}', DEPLOYMENT) == 'Progressing'
+    assert render_jsonpath('{.status.conditions[*].status}', DEPLOYMENT) == 'True True'
+    assert render_jsonpath(r'{.metadata.labels.app\.kubernetes\.io/name}', DEPLOYMENT) == 'web'
+    assert render_jsonpath('name={.metadata.name}{"\\n"}', DEPLOYMENT) == 'name=web\n'
+    assert render_jsonpath('{.spec.missing}', DEPLOYMENT) == ''
+    assert render_jsonpath('{.metadata.labels}', DEPLOYMENT) == '{"app.kubernetes.io/name":"web"}'
+
+
+@pytest.mark.parametrize('template', ['{..name}', '{.items[?(@.x)]}', '{range .items[*]}{end}'])
+def test_render_jsonpath_leaves_advanced_expressions_to_kubectl(template):
+    with pytest.raises(Unsupported):
+        render_jsonpath(template, DEPLOYMENT)
+
+
+class TrimmedCache:
+    def synced(self, resource):
+        return True
+
+    def get(self, resource, name, namespace):
+        return {'metadata': {'name': name, 'namespace': namespace}}
+
+
+class CoreApi:
+    def __init__(self):
+        self.reads = 0
+
+    def read_namespaced_pod(self, name, namespace, **kwargs):
+        self.reads += 1
+        return {'metadata': {'name': name, 'namespace': namespace, 'managedFields': [{'manager': 'kubectl'}],
+                             'annotations': {LAST_APPLIED: '{}'}}}
+
+
+class Serializer:
+    def sanitize_for_serialization(self, obj):
+        return obj
+
+
+@pytest.mark.parametrize('output, from_cache', [
+    ('json', False), ('yaml', False), ('name', True), ('jsonpath={.metadata.name}', True),
+    ('jsonpath={.metadata.annotations}', False),
+])
+def test_full_objects_are_read_from_the_api_not_the_trimmed_cache(output, from_cache):
+    kube = KubernetesClient()
+    kube._available = True
+    api = CoreApi()
+    kube.cache, kube.api_client, kube.apis = TrimmedCache(), Serializer(), {'core': api}
+    stdout = kube.execute(['kubectl', 'get', 'pod', 'web', '-n', 'dev', '-o', output])
+    assert stdout and api.reads == (0 if from_cache else 1)
+    if output in ('json', 'yaml'):
+        assert 'managedFields' in stdout and LAST_APPLIED in stdout
@@ -0,0 +1,38 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+import pytest
+from app.services.kubectl import CommandCancelled, CommandTimeout, Executor
+
+
+def test_commands_run_in_parallel(monkeypatch):
+    monkeypatch.setenv('KPA_FAKE_KUBECTL_LATENCY', '0.5')
+    executor = Executor(max_workers=4)
+    started = time.monotonic()
+    futures = [executor.submit('kubectl get pods') for _ in range(4)]
+    assert all('web-7d4b9c' in future.result() for future in futures)
+    assert time.monotonic() - started < 1.5
+
+
+def test_slow_command_times_out(monkeypatch):
+    monkeypatch.setenv('KPA_FAKE_KUBECTL_LATENCY', '5')
+    with pytest.raises(CommandTimeout):
+        Executor(max_workers=1).execute('kubectl get pods', timeout=0.2)
+
+
+def test_running_command_can_be_cancelled(monkeypatch):
+    monkeypatch.setenv('KPA_FAKE_KUBECTL_LATENCY', '5')
+    executor = Executor(max_workers=1)
+    future = executor.submit('kubectl get pods')
+    time.sleep(0.2)
+    executor.cancel(future)
+    with pytest.raises(CommandCancelled):
+        future.result(timeout=2)
+
+
+def test_only_kubectl_commands_are_accepted():
+    with pytest.raises(ValueError):
+        Executor(max_workers=1).submit('rm -rf /')
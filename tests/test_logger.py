@@ -0,0 +1,62 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import logging
+import queue
+import sys
+from app.utils.logger import RawQueueHandler, SamplingFilter, get_logger
+
+
+def record(level=logging.INFO, lineno=10, msg="line %s", args=(1,)):
+    return logging.LogRecord('KPA.test', level, __file__, lineno, msg, args, None)
+
+
+def test_sampling_limits_info_lines_per_call_site():
+    sampling = SamplingFilter(rate=0.001, burst=2)
+    assert [sampling.filter(record()) for _ in range(4)] == [True, True, False, False]
+    assert sampling.filter(record(lineno=11))
+    assert sampling.filter(record(level=logging.WARNING))
+
+
+def test_passed_line_reports_suppressed_count():
+    sampling = SamplingFilter(rate=0.001, burst=1)
+    assert sampling.filter(record())
+    assert not sampling.filter(record())
+    tokens, last = sampling._buckets[('KPA.test', 10)]
+    sampling._buckets[('KPA.test', 10)] = (1, last)
+    passed = record()
+    assert sampling.filter(passed)
+    assert passed.getMessage() == "line 1 (1 similar lines suppressed)"
+
+
+def test_suppressed_count_with_literal_percent_and_no_args():
+    sampling = SamplingFilter(rate=0.001, burst=1)
+    for msg in ["disk 100% full", "{'cpu': '50%'}"]:
+        sampling._buckets.clear()
+        assert sampling.filter(record(msg=msg, args=()))
+        assert not sampling.filter(record(msg=msg, args=()))
+        tokens, last = sampling._buckets[('KPA.test', 10)]
+        sampling._buckets[('KPA.test', 10)] = (1, last)
+        passed = record(msg=msg, args=())
+        assert sampling.filter(passed)
+        assert passed.getMessage() == f"{msg} (1 similar lines suppressed)"
+
+
+def test_queued_records_are_left_for_the_listener_to_format():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        original = logging.LogRecord('KPA.test', logging.ERROR, __file__, 10, "failed %s", (['x'],),
+                                     sys.exc_info())
+    handler = RawQueueHandler(queue.SimpleQueue())
+    queued = handler.prepare(original)
+    assert queued is not original and original.args == (['x'],)
+    assert queued.msg == "failed ['x']" and queued.args is None
+    assert queued.exc_info is original.exc_info and queued.exc_text is None
+    assert 'ValueError: boom' in logging.Formatter().format(queued)
+
+
+def test_module_loggers_are_children_of_kpa():
+    assert get_logger('app.services.db').name == 'KPA.db'
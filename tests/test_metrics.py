@@ -0,0 +1,39 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from app.utils.metrics import Counter, Gauge, Histogram
+
+
+def test_histogram_renders_cumulative_buckets():
+    latency = Histogram('test_latency_seconds', 'Test latency', ['route'], buckets=(0.1, 1))
+    latency.observe(0.05, route='/a')
+    latency.observe(0.5, route='/a')
+    latency.observe(5, route='/a')
+    text = latency.render()
+    assert 'test_latency_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{route="/a",le="1.0"} 2' in text
+    assert 'test_latency_seconds_bucket{route="/a",le="+Inf"} 3' in text
+    assert 'test_latency_seconds_count{route="/a"} 3' in text
+
+
+def test_counter_and_callback_gauge():
+    calls = Counter('test_calls_total', 'Calls', ['kind'])
+    calls.inc(kind='x')
+    calls.inc(2, kind='x')
+    assert 'test_calls_total{kind="x"} 3' in calls.render()
+    sessions = Gauge('test_sessions', 'Sessions', ['state'], callback=lambda: {('active',): 4})
+    assert 'test_sessions{state="active"} 4' in sessions.render()
+
+
+def test_metrics_endpoint_reports_routes_and_services(benchmark):
+    benchmark.run_workload('get_scenario')
+    benchmark.run_workload('ai_chat')
+    text = benchmark.app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'kpa_http_request_duration_seconds_count{route="/api/scenarios/<int:id>",method="GET",status="200"}' in text
+    assert 'kpa_db_query_seconds_count{function="get_scenario"}' in text
+    assert 'kpa_openai_request_seconds_count{operation="chat",outcome="ok"}' in text
+    assert 'kpa_openai_tokens_total{operation="chat",type="prompt"}' in text
+    assert 'kpa_scenario_cache{stat="hits"}' in text
+    assert 'kpa_terminal_sessions{state="active"}' in text
@@ -0,0 +1,64 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+import pytest
+from app.services import response_cache
+from app.services.response_cache import ResponseCache, normalize
+
+ANSWER = {'explanation': 'A claim for storage.'}
+
+
+@pytest.fixture
+def enabled(database, monkeypatch):
+    monkeypatch.setattr(response_cache, 'CACHE_ENABLED', True)
+
+
+def test_normalize_splits_camel_case_and_punctuation():
+    assert normalize('PersistentVolumeClaim') == 'persistent volume claim'
+    assert normalize('Persistent-Volume claim?') == 'persistent volume claim'
+
+
+def test_rephrased_question_hits_above_threshold(enabled):
+    cache = ResponseCache('explain', 'model', 1)
+    cache.set('PersistentVolumeClaim', ANSWER)
+    assert cache.get('persistent volume claim') == ANSWER
+    assert cache.get('What is a persistent volume claim?') == ANSWER
+    assert cache.get('persistent volume') is None
+    assert cache.stats()['similar_hits'] == 1
+
+
+def test_entries_are_scoped_to_model_and_version(enabled):
+    ResponseCache('explain', 'model', 1).set('Service', ANSWER)
+    assert ResponseCache('explain', 'model', 2).get('Service') is None
+    assert ResponseCache('explain', 'other', 1).get('Service') is None
+
+
+def test_expired_entries_are_not_served(enabled, monkeypatch):
+    cache = ResponseCache('explain', 'model', 1, ttl=60)
+    cache.set('Ingress', ANSWER)
+    now = time.time()
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now + 120)
+    assert cache.get('Ingress') is None
+
+
+def test_exact_only_cache_ignores_similar_questions(enabled):
+    cache = ResponseCache('troubleshoot', 'model', 1, similar=False)
+    output = 'Name: web-1\nNamespace: default\n' + ''.join(f'Label{i}: value{i}\n' for i in range(30)) + 'Reason: STATE'
+    # Similarity matching cannot tell these two apart.
+    similar = ResponseCache('troubleshoot', 'model', 2)
+    similar.set('pod not starting\n' + output.replace('STATE', 'CrashLoopBackOff'), ANSWER)
+    assert similar.get('pod not starting\n' + output.replace('STATE', 'ImagePullBackOff')) == ANSWER
+
+    cache.set('pod not starting\n' + output.replace('STATE', 'CrashLoopBackOff'), ANSWER)
+    assert cache.get('pod not starting\n' + output.replace('STATE', 'ImagePullBackOff')) is None
+    assert cache.get('pod not starting\n' + output.replace('STATE', 'CrashLoopBackOff')) == ANSWER
+
+
+def test_index_is_bounded(enabled):
+    cache = ResponseCache('explain', 'model', 1, max_entries=2)
+    for concept in ('Pod', 'Service', 'Ingress'):
+        cache.set(concept, ANSWER)
+    assert cache.stats()['indexed'] == 2
@@ -0,0 +1,25 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import copy
+import pytest
+from app.services.kubectl import Executor
+from app.services.scenario_pool import ScenarioPool, UnusableScenario
+from tests.benchmark import SCENARIO
+
+
+@pytest.mark.parametrize('field, value', [
+    ('tasks', []),
+    ('verification_commands', []),
+    ('setup_commands', ['helm install web bitnami/nginx']),
+    ('verification_commands', ["kubectl get pods -o 'jsonpath"]),
+])
+def test_lint_rejects_scenarios_that_cannot_run(field, value):
+    scenario = copy.deepcopy(SCENARIO)
+    scenario[field] = value
+    pool = ScenarioPool(None, Executor(max_workers=1))
+    pool.lint(copy.deepcopy(SCENARIO))
+    with pytest.raises(UnusableScenario):
+        pool.lint(scenario)
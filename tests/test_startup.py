@@ -0,0 +1,53 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds allowed for `import app.main` in a fresh interpreter.
+IMPORT_BUDGET = float(os.environ.get('KPA_IMPORT_BUDGET', '2.0'))
+DEFERRED_MODULES = ['openai', 'httpx', 'tiktoken', 'kubernetes', 'pydantic']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app.main
+print(json.dumps({'seconds': time.perf_counter() - started,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+""" % DEFERRED_MODULES
+
+
+def test_import_stays_within_budget(tmp_path):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report['loaded'] == []
+    assert report['seconds'] < IMPORT_BUDGET
+
+
+def test_healthz_answers_before_warm_up(benchmark):
+    response = benchmark.app.test_client().get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json() == {'status': 'ok'}
+
+
+def test_readyz_reports_warm_up(benchmark):
+    client = benchmark.app.test_client()
+    deadline = time.monotonic() + 30
+    response = client.get('/readyz')
+    while response.status_code == 503 and time.monotonic() < deadline:
+        assert response.get_json()['error'] is None
+        time.sleep(0.1)
+        response = client.get('/readyz')
+    assert response.status_code == 200
+    state = response.get_json()
+    assert state['ready'] and state['pending'] == []
+    assert {'database', 'openai', 'watch cache', 'scenario pool'} <= set(state['done'])
@@ -0,0 +1,111 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import threading
+import time
+import zlib
+from app.services import terminal
+from app.services.terminal import OutputBuffer, SessionManager, text_frame
+
+
+def test_output_is_framed_in_chunks_within_the_window():
+    output = OutputBuffer(window=10, capacity=100, chunk_size=4)
+    output.add([('text', 'abcdefghijkl'), ('prompt', '')])
+    assert output.frames() == [('text', 'abcd'), ('text', 'efgh'), ('text', 'ijkl')]
+    assert output.blocked and output.frames() == []
+    output.ack(12)
+    assert output.frames() == [('prompt', '')]
+
+
+def test_oldest_output_is_truncated_past_capacity():
+    output = OutputBuffer(window=100, capacity=5, chunk_size=100)
+    output.add([('text', 'abc'), ('prompt', ''), ('text', 'defgh')])
+    frames = output.frames()
+    assert '3 characters of output truncated' in frames[0][1]
+    assert frames[1:] == [('prompt', ''), ('text', 'defgh')]
+
+
+def test_large_frames_are_compressed(monkeypatch):
+    monkeypatch.setattr(terminal, 'OUTPUT_COMPRESS', True)
+    monkeypatch.setattr(terminal, 'OUTPUT_COMPRESS_MIN', 10)
+    assert text_frame('short') == {'type': 'text', 'content': 'short', 'size': 5}
+    frame = text_frame('x' * 100)
+    assert frame['encoding'] == 'deflate' and frame['size'] == 100
+    assert zlib.decompress(frame['data']).decode() == 'x' * 100
+
+
+def test_concurrent_acquire_for_one_client_starts_one_shell(tmp_path, monkeypatch):
+    monkeypatch.setattr(terminal, 'SESSION_ROOT', str(tmp_path))
+    started = []
+
+    def factory():
+        session = terminal.TerminalSession()
+        started.append(session)
+        time.sleep(0.2)
+        return session
+
+    manager = SessionManager(warm_sessions=0, session_factory=factory)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.acquire('sid-1'))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert len(started) == 1
+        assert sorted(created for _, created in results) == [False, False, True]
+        assert len({id(session) for session, _ in results}) == 1
+    finally:
+        manager.close_all()
+
+
+def test_close_waits_for_the_reader_to_release_the_pty(tmp_path, monkeypatch):
+    monkeypatch.setattr(terminal, 'SESSION_ROOT', str(tmp_path))
+    session = terminal.TerminalSession()
+    session.start()
+    reads = []
+    reader = threading.Thread(target=lambda: reads.append(session.read(timeout=1)))
+    with session._borrow_fd():
+        reader.start()
+        session.close()
+        assert session.fd is not None
+    reader.join()
+    assert session.fd is None
+    assert session.read() is None
+
+
+def test_output_counts_as_activity(tmp_path, monkeypatch):
+    monkeypatch.setattr(terminal, 'SESSION_ROOT', str(tmp_path))
+    session = terminal.TerminalSession()
+    session.start()
+    try:
+        session.last_active = 0
+        session.send_line('echo hello')
+        deadline = time.monotonic() + 5
+        while session.last_active == 0 and time.monotonic() < deadline:
+            session.read()
+        assert session.last_active > 0
+    finally:
+        session.close()
+
+
+def test_in_cluster_sessions_get_a_service_account_kubeconfig(tmp_path, monkeypatch):
+    account = tmp_path / 'serviceaccount'
+    account.mkdir()
+    (account / 'token').write_text('secret')
+    (account / 'namespace').write_text('kpa')
+    monkeypatch.setattr(terminal, 'SESSION_ROOT', str(tmp_path))
+    monkeypatch.setattr(terminal, 'SERVICE_ACCOUNT_DIR', str(account))
+    monkeypatch.setattr(terminal, '_default_kubeconfig', lambda: None)
+    monkeypatch.setenv('KUBERNETES_SERVICE_HOST', '10.0.0.1')
+    session = terminal.TerminalSession()
+    session._prepare_home()
+    with open(os.path.join(session.home, '.kube', 'config')) as f:
+        config = f.read()
+    assert 'server: https://10.0.0.1:443' in config
+    assert f"tokenFile: {account / 'token'}" in config and 'namespace: kpa' in config
+    assert session.kube_context == 'in-cluster'
+    assert session.set_namespace('kpa-s1-ab') and session.namespace == 'kpa-s1-ab'
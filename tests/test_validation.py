@@ -0,0 +1,97 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import pytest
+from app.services.kubectl import Executor
+from app.services.validation import Validator
+
+SLOW = 'kubectl get pods; sleep 3'
+
+
+class FakeClusterCache:
+    def __init__(self):
+        self.generation = 1
+        self.namespaces = {}
+
+    def synced(self, resource):
+        return True
+
+    def namespace_generation(self, namespace):
+        return self.namespaces.get(namespace, 0)
+
+
+@pytest.fixture(scope='module')
+def executor():
+    executor = Executor(max_workers=4)
+    yield executor
+    executor.shutdown()
+
+
+def scenario(*commands, id=1):
+    return {'id': id, 'tasks': [f"task {i}" for i in range(len(commands))],
+            'verification_commands': list(commands)}
+
+
+def test_every_check_is_reported_against_its_task(executor):
+    summary = Validator(executor).validate(scenario('kubectl get pods', 'kubectl get nosuchthing'))
+    assert [r['status'] for r in summary['results']] == ['passed', 'failed']
+    assert [r['task'] for r in summary['results']] == ['task 0', 'task 1']
+    assert not summary['passed'] and summary['message'] == '1/2 checks passed'
+
+
+def test_fail_fast_skips_checks_still_running(executor):
+    summary = Validator(executor).validate(scenario('kubectl get nosuchthing', SLOW), fail_fast=True)
+    assert [r['status'] for r in summary['results']] == ['failed', 'skipped']
+    assert summary['duration'] < 2
+
+
+def test_checks_past_the_deadline_time_out(executor):
+    summary = Validator(executor, deadline=0.5).validate(scenario('kubectl get pods', SLOW))
+    assert [r['status'] for r in summary['results']] == ['passed', 'timeout']
+    assert summary['duration'] < 2
+
+
+def test_results_are_reused_until_a_watched_namespace_changes(executor):
+    cache = FakeClusterCache()
+    validator = Validator(executor, cluster_cache=cache)
+    checks = scenario('kubectl get pods -n dev', 'kubectl get deployments')
+    assert 'cached' not in validator.validate(checks)
+    assert validator.validate(checks)['cached']
+    assert 'cached' not in validator.validate(checks, fail_fast=True)
+
+    cache.namespaces['default'] = 1
+    assert 'cached' not in validator.validate(checks)
+    cache.namespaces['dev'] = 1
+    assert 'cached' not in validator.validate(checks)
+    assert validator.validate(checks)['cached']
+
+
+def test_cache_key_follows_the_environment_namespace(executor):
+    cache = FakeClusterCache()
+    validator = Validator(executor, cluster_cache=cache)
+    checks = scenario('kubectl get pods')
+    validator.validate(checks, namespace='kpa-s1-ab')
+    assert validator.validate(checks, namespace='kpa-s1-ab')['cached']
+    cache.namespaces['kpa-s1-ab'] = 1
+    assert 'cached' not in validator.validate(checks, namespace='kpa-s1-ab')
+
+
+@pytest.mark.parametrize('command', [
+    'kubectl describe pod web',
+    'kubectl get configmaps',
+    'kubectl get pods,services',
+    'kubectl get pods; kubectl get nodes',
+    'kubectl get pods | kubectl apply -f -',
+])
+def test_checks_the_watch_cache_cannot_vouch_for_are_not_cached(executor, command):
+    validator = Validator(executor, cluster_cache=FakeClusterCache())
+    assert validator._cache_key(scenario(command), False) is None
+
+
+def test_cluster_wide_checks_follow_the_global_generation(executor):
+    cache = FakeClusterCache()
+    validator = Validator(executor, cluster_cache=cache)
+    key = validator._cache_key(scenario('kubectl get pods -A', 'kubectl get nodes'), False)
+    assert key == (1, False, (('*', 1),))
@@ -0,0 +1,41 @@
+# Copyright (c) 2024 Robert Cronin
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from app import websocket
+from app.services import terminal
+from app.services.environments import EnvironmentProvisioner
+from app.services.kubectl import Executor
+from app.services.terminal import SessionManager
+from tests.benchmark import SCENARIO
+
+
+def test_environment_is_released_when_the_terminal_cannot_switch(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(terminal, 'SESSION_ROOT', str(tmp_path))
+    monkeypatch.setattr(terminal, '_default_kubeconfig', lambda: None)
+    monkeypatch.delenv('KUBERNETES_SERVICE_HOST', raising=False)
+    manager = SessionManager(warm_sessions=0)
+    provisioner = EnvironmentProvisioner(Executor(max_workers=2), size=0)
+    emitted = []
+    monkeypatch.setattr(websocket, 'session_manager', manager)
+    monkeypatch.setattr(websocket, 'environments', provisioner)
+    monkeypatch.setattr(websocket.socketio, 'emit', lambda event, data, to=None: emitted.append((event, data)))
+    scenario_id = database.store_scenario(SCENARIO)
+    manager.acquire('sid-1')
+    try:
+        websocket.attach_environment('sid-1', scenario_id)
+    finally:
+        manager.close_all()
+    assert emitted == [('environment', {'error': 'Could not switch the terminal to the scenario environment'})]
+    assert provisioner.environment_for('sid-1') is None
+    assert [e.state for e in provisioner.environments.values()] == ['released']
+
+
+def test_chat_payload_that_is_not_an_object_is_an_error(monkeypatch):
+    emitted = []
+    monkeypatch.setattr(websocket, 'emit', lambda event, data: emitted.append((event, data)))
+    for payload in ([], 'x', None):
+        websocket.handle_chat(payload)
+        websocket.handle_chat_cancel(payload)
+    assert emitted == [('chat_error', {'id': None, 'error': 'Invalid chat request'})] * 3